@@ -0,0 +1,214 @@
+"""Benchmarks the download engines against a local HTTP server serving synthetic images, with
+configurable latency, image sizes, server errors and 429 responses, so download throughput can
+be measured without hitting the search engines' image hosts.
+
+Each engine runs in its own process, so its peak RSS is measured on its own. Latencies are
+those of the download attempts, including any wait for a free connection of the pool. Results
+can be saved and compared with a baseline to catch regressions before deploying.
+
+Run from the project directory:
+    python benchmarks/bench_downloads.py [--images 2000] [--latency 50] [--error-rate 0.01] [--throttle-rate 0.01]
+    python benchmarks/bench_downloads.py --save baseline.json
+    python benchmarks/bench_downloads.py --baseline baseline.json [--tolerance 0.2]
+"""
+import argparse
+import contextlib
+import http.server
+import io
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+from typing import Dict, List
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "image_scraper"))
+
+JPEG_HEADER = b"\xff\xd8\xff\xe0\x00\x10JFIF\x00"
+
+
+class SyntheticImageHandler(http.server.BaseHTTPRequestHandler):
+    """Serves /img/<n>.jpg with a size drawn from a log-normal distribution seeded by n, after
+    a latency, or answers with a 500 or a 429 at the configured rates."""
+
+    protocol_version = "HTTP/1.1"
+    options : Dict = {}
+    padding : bytes = b""
+    random = random.Random()
+    random_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def image_size(self, n : int) -> int:
+        options = self.options
+        size = random.Random(f"{options['seed']}:{n}").lognormvariate(math.log(options["size_median"] * 1024), options["size_sigma"])
+        return int(min(max(size, len(JPEG_HEADER)), options["size_max"] * 1024))
+
+    def send_empty(self, status : int, headers : Dict = None) -> None:
+        self.send_response(status)
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        match = re.match(r"^/img/(\d+)\.jpg$", self.path)
+        if match is None:
+            self.send_empty(404)
+            return
+        with self.random_lock:
+            latency = max(0.0, self.random.gauss(self.options["latency"], self.options["jitter"])) / 1000
+            outcome = self.random.random()
+        time.sleep(latency)
+        if outcome < self.options["throttle_rate"]:
+            self.send_empty(429, {"Retry-After": str(self.options["retry_after"])})
+            return
+        if outcome < self.options["throttle_rate"] + self.options["error_rate"]:
+            self.send_empty(500)
+            return
+        n = int(match.group(1))
+        size = self.image_size(n)
+        # Offsets the padding by n, so the images differ
+        offset = n % 1024
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        self.wfile.write(JPEG_HEADER)
+        self.wfile.write(memoryview(self.padding)[offset:offset + size - len(JPEG_HEADER)])
+
+
+def serve(options : Dict, ports : multiprocessing.Queue) -> None:
+    """Runs the image server in its own process, so it does not compete with the engine for the GIL."""
+    SyntheticImageHandler.options = options
+    SyntheticImageHandler.padding = os.urandom(options["size_max"] * 1024 + 1024)
+    SyntheticImageHandler.random = random.Random(options["seed"])
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), SyntheticImageHandler)
+    server.daemon_threads = True
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+def run_engine(engine : str, image_urls : List[str], image_config : Dict, rate_limit_config : Dict, verbose : bool) -> Dict:
+    """Downloads the urls with an engine into a temporary directory and returns the elapsed
+    time, metrics snapshot and peak RSS of the process."""
+    from main import get_download_engine
+    from metrics import METRICS
+    from rate_limit import HostRateLimiter
+
+    with tempfile.TemporaryDirectory() as save_path:
+        config = dict(image_config, save_path=save_path, resume=False, dedup="off", seen_urls={"enabled": False})
+        rate_limiter = HostRateLimiter(**rate_limit_config) if rate_limit_config is not None else None
+        downloader = get_download_engine(engine)(config=config, rate_limiter=rate_limiter)
+        METRICS.reset()
+        output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+        with output:
+            start = time.monotonic()
+            downloader.download_queue(image_urls)
+            elapsed = time.monotonic() - start
+    # ru_maxrss is in kilobytes on Linux
+    return {"elapsed": elapsed, "metrics": METRICS.snapshot(), "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+def summarise(run : Dict) -> Dict:
+    """Returns the throughput and latency figures of an engine run."""
+    counters = run["metrics"]["counters"]
+    latency = run["metrics"]["histograms"].get("download_total_seconds", {"p50": 0, "p99": 0})
+    downloaded = counters.get('download_results_total{status="200"}', 0)
+    return {
+        "images_per_second": round(downloaded / run["elapsed"], 1),
+        "mb_per_second": round(counters.get("download_bytes_total", 0) / run["elapsed"] / 1e6, 2),
+        "p50_ms": round(latency["p50"] * 1000, 1),
+        "p99_ms": round(latency["p99"] * 1000, 1),
+        "peak_rss_mb": round(run["peak_rss_mb"], 1),
+        "downloaded": downloaded,
+        "throttled": sum(value for key, value in counters.items() if key == 'download_attempts_total{status="429"}'),
+        "errors": sum(value for key, value in counters.items() if key.startswith("download_errors_total")),
+    }
+
+def compare(results : Dict, baseline : Dict, tolerance : float) -> List[str]:
+    """Returns the throughput figures that dropped by more than tolerance from the baseline."""
+    regressions = []
+    for engine, result in results.items():
+        for figure in ["images_per_second", "mb_per_second"]:
+            before = baseline.get(engine, {}).get(figure)
+            if before and result[figure] < before * (1 - tolerance):
+                regressions.append(f"{engine} {figure}: {result[figure]} < {before}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Download engine benchmark.")
+    parser.add_argument('--engines', help='download engines to benchmark (defaults to all)', nargs='+', required=False)
+    parser.add_argument('--images', help='number of image urls', type=int, default=2000)
+    parser.add_argument('--latency', help='mean response latency in ms', type=float, default=50)
+    parser.add_argument('--jitter', help='standard deviation of the latency in ms', type=float, default=20)
+    parser.add_argument('--size-median', help='median image size in KB', type=float, default=100)
+    parser.add_argument('--size-sigma', help='sigma of the log-normal image size distribution', type=float, default=1.0)
+    parser.add_argument('--size-max', help='largest image size in KB', type=int, default=5120)
+    parser.add_argument('--error-rate', help='fraction of requests answered with 500', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', help='fraction of requests answered with 429', type=float, default=0.0)
+    parser.add_argument('--retry-after', help='Retry-After seconds of the 429 responses', type=int, default=1)
+    parser.add_argument('--rate-limit', help='paces the requests with the rate_limit settings of config.json', action='store_true')
+    parser.add_argument('--concurrency', help='overrides image.concurrency of config.json: auto or a number of download threads', type=str, required=False)
+    parser.add_argument('--seed', help='seed of the image sizes, latencies and errors', type=int, default=0)
+    parser.add_argument('--save', help='saves the results to a JSON file', type=str, required=False)
+    parser.add_argument('--baseline', help='JSON results to compare with, exiting with 1 on regressions', type=str, required=False)
+    parser.add_argument('--tolerance', help='allowed throughput drop from the baseline', type=float, default=0.2)
+    parser.add_argument('-v', '--verbose', help='shows the output of the engines', action='store_true')
+    args = parser.parse_args()
+
+    with open(os.path.join(ROOT, "image_scraper", "config.json"), encoding='utf-8') as file:
+        config = json.load(file)
+    if args.concurrency is not None:
+        config["image"]["concurrency"] = args.concurrency if args.concurrency == "auto" else int(args.concurrency)
+    if not args.verbose:
+        os.environ["TQDM_DISABLE"] = "1"
+    from main import DOWNLOAD_ENGINES
+    engines = args.engines or list(DOWNLOAD_ENGINES.keys())
+
+    options = {
+        "latency": args.latency, "jitter": args.jitter, "size_median": args.size_median, "size_sigma": args.size_sigma,
+        "size_max": args.size_max, "error_rate": args.error_rate, "throttle_rate": args.throttle_rate,
+        "retry_after": args.retry_after, "seed": args.seed,
+    }
+    ports = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(options, ports), daemon=True)
+    server.start()
+    port = ports.get(timeout=10)
+    image_urls = [ f"http://127.0.0.1:{port}/img/{n}.jpg" for n in range(args.images) ]
+
+    print(f"> {args.images} images, latency {args.latency:.0f}±{args.jitter:.0f} ms, median size {args.size_median:.0f} KB, "
+          f"{args.error_rate:.1%} errors, {args.throttle_rate:.1%} throttled")
+    print(f"  {'ENGINE':<8} {'IMAGES/S':>9} {'MB/S':>8} {'P50 MS':>8} {'P99 MS':>8} {'RSS MB':>8} {'OK':>6} {'429':>5} {'ERRORS':>6}")
+    results = {}
+    try:
+        for engine in engines:
+            rate_limit_config = config.get("rate_limit", {}) if args.rate_limit else None
+            with multiprocessing.Pool(1) as pool:
+                run = pool.apply(run_engine, (engine, image_urls, config["image"], rate_limit_config, args.verbose))
+            results[engine] = result = summarise(run)
+            print(f"  {engine:<8} {result['images_per_second']:>9} {result['mb_per_second']:>8} {result['p50_ms']:>8} {result['p99_ms']:>8} "
+                  f"{result['peak_rss_mb']:>8} {result['downloaded']:>6} {result['throttled']:>5} {result['errors']:>6}")
+    finally:
+        server.terminate()
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as file:
+            json.dump({"options": options, "images": args.images, "results": results}, file, indent=4)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            regressions = compare(results, json.load(file)["results"], args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if len(regressions) > 0:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
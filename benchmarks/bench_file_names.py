@@ -0,0 +1,66 @@
+"""Benchmarks file name allocation in a directory filled with colliding names.
+
+Run from the project directory:
+    python benchmarks/bench_file_names.py [--files 50000]
+"""
+import argparse
+import os
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "image_scraper"))
+from file_names import FileNameIndex
+
+def stat_loop_allocate(directory : str, file_name : str) -> str:
+    """The previous isfile/regex loop of ImagesDownloader.get_full_file_path."""
+    full_file_path = os.path.join(directory, file_name)
+    while(os.path.isfile(full_file_path)):
+        name, ext = os.path.splitext(os.path.basename(full_file_path))
+        copyval = re.search(r"\((.*)\)", name)
+        if copyval is None:
+            file_name = name + "(1)" + ext
+        else:
+            copyval = int(copyval.group(1))+1
+            file_name = re.sub(r"\((.*)\)", r"(%d)" % copyval, name) + ext
+        full_file_path = os.path.join(directory, file_name)
+    return full_file_path
+
+def fill_directory(directory : str, n_files : int) -> None:
+    """Creates image.jpg, image(1).jpg, ... image(n-1).jpg."""
+    for i in range(n_files):
+        file_name = "image.jpg" if i == 0 else f"image({i}).jpg"
+        open(os.path.join(directory, file_name), 'wb').close()
+
+def main():
+    parser = argparse.ArgumentParser(description="File name allocation benchmark.")
+    parser.add_argument('--files', help='number of colliding files in the directory', type=int, default=50000)
+    parser.add_argument('--allocations', help='number of new names to allocate', type=int, default=1000)
+    parser.add_argument('--stat-loop-allocations', help='number of names to allocate with the stat loop', type=int, default=5)
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"> Filling directory with {args.files} colliding names...")
+        fill_directory(directory, args.files)
+        
+        start = time.perf_counter()
+        for _ in range(args.stat_loop_allocations):
+            full_file_path = stat_loop_allocate(directory, "image.jpg")
+            open(full_file_path, 'wb').close()
+        stat_loop_ms = (time.perf_counter() - start) * 1000 / args.stat_loop_allocations
+        
+        start = time.perf_counter()
+        index = FileNameIndex(directory)
+        build_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        for _ in range(args.allocations):
+            index.allocate("image.jpg")
+        index_us = (time.perf_counter() - start) * 1000000 / args.allocations
+        
+    print(f"  stat loop:       {stat_loop_ms:.1f} ms per name")
+    print(f"  index build:     {build_ms:.1f} ms (once per run)")
+    print(f"  index allocate:  {index_us:.2f} us per name")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""Benchmarks Google Images url extraction from a saved result page against the
+BeautifulSoup thumbnail count that runs on the same page source.
+
+Run from the project directory:
+    python benchmarks/bench_google_extract.py [--page saved_page.html] [--repeat 50]
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "image_scraper"))
+from extract import extract_google_image_urls
+
+def best_of(function, source_html : str, repeat : int) -> float:
+    """Returns the fastest of repeat runs in milliseconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(source_html)
+        timings.append((time.perf_counter() - start) * 1000)
+    return min(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description="Google url extraction benchmark.")
+    parser.add_argument('--page', help='saved Google Images result page', type=str, default=os.path.join(ROOT, "tests", "test_files", "google_search.html"))
+    parser.add_argument('--scale', help='number of times the results of the page are repeated', type=int, default=100)
+    parser.add_argument('--repeat', help='number of timed runs', type=int, default=20)
+    args = parser.parse_args()
+    
+    with open(args.page, encoding='utf-8') as file:
+        source_html = file.read()
+    if args.scale > 1:
+        # Grows a small fixture into a multi-megabyte page of distinct results
+        source_html = "".join(source_html.replace("https://", f"https://r{i}.") for i in range(args.scale))
+    
+    n_urls = len(extract_google_image_urls(source_html))
+    print(f"> Page size {len(source_html) / 1e6:.2f} MB, {n_urls} image urls")
+    print(f"  extract_google_image_urls: {best_of(extract_google_image_urls, source_html, args.repeat):.1f} ms")
+    try:
+        from image_search import GoogleSearch
+        count_images = GoogleSearch(driver_config={}, query="benchmark").count_images
+        print(f"  GoogleSearch.count_images: {best_of(count_images, source_html, min(args.repeat, 5)):.1f} ms")
+    except ImportError as e:
+        print(f"  GoogleSearch.count_images: skipped ({e})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Benchmarks the HtmlPage parsers on saved Google and Pinterest result pages: the
+Google thumbnail count and the Pinterest board and search pin extraction, each on a freshly
+parsed page.
+
+Run from the project directory:
+    python benchmarks/bench_html_parsers.py [--google saved_page.html] [--pinterest saved_page.html] [--pinterest-search saved_page.html] [--scale 1000]
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+from typing import List
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "image_scraper"))
+from extract import PARSERS, PINTEREST_THUMBNAIL_PREFIX, HtmlPage, pinterest_original_url
+
+TEST_FILES = os.path.join(ROOT, "tests", "test_files")
+# Pins of a board are rendered in this container, the pins below it are suggestions
+PINTEREST_BOARD_CLASS = "Collection"
+
+def pinterest_image_urls(page : HtmlPage, board=False) -> List[str]:
+    """Returns the original image urls of the pins in a Pinterest page source, in page order and
+    without duplicates, as the scraper harvests them from the browser's DOM."""
+    container_class = PINTEREST_BOARD_CLASS if board else None
+    image_urls = {}
+    for src in page.image_sources(PINTEREST_THUMBNAIL_PREFIX, container_class=container_class):
+        image_urls.setdefault(pinterest_original_url(src), None)
+    return list(image_urls)
+
+def scale_page(source_html : str, scale : int, vary : str) -> str:
+    """Grows a small fixture into a multi-megabyte page by repeating its body, with the url part
+    vary made distinct in each copy."""
+    if scale <= 1:
+        return source_html
+    match = re.search(r"(?is)<body[^>]*>(.*)</body>", source_html)
+    body = "".join(match.group(1).replace(vary, f"{vary}r{i}/") for i in range(scale))
+    return source_html[:match.start(1)] + body + source_html[match.end(1):]
+
+def best_of(function, source_html : str, parser : str, repeat : int) -> float:
+    """Returns the fastest of repeat runs in milliseconds, parsing the page in each run."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(HtmlPage(source_html, parser=parser))
+        timings.append((time.perf_counter() - start) * 1000)
+    return min(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description="HTML parser benchmark.")
+    parser.add_argument('--google', help='saved Google Images result page', type=str, default=os.path.join(TEST_FILES, "google_search.html"))
+    parser.add_argument('--pinterest', help='saved Pinterest board page', type=str, default=os.path.join(TEST_FILES, "pinterest_board.html"))
+    parser.add_argument('--pinterest-search', help='saved Pinterest search page', type=str, default=os.path.join(TEST_FILES, "pinterest_search.html"))
+    parser.add_argument('--scale', help='number of times the body of the pages is repeated', type=int, default=1000)
+    parser.add_argument('--repeat', help='number of timed runs', type=int, default=5)
+    args = parser.parse_args()
+    
+    benchmarks = [
+        ("Google count_images", args.google, "https://", lambda page: page.count_class("div", "BUooTd")),
+        ("Pinterest board pins", args.pinterest, "/236x/", lambda page: len(pinterest_image_urls(page, board=True))),
+        ("Pinterest search pins", args.pinterest_search, "/236x/", lambda page: len(pinterest_image_urls(page))),
+    ]
+    for name, path, vary, function in benchmarks:
+        with open(path, encoding='utf-8') as file:
+            source_html = scale_page(file.read(), args.scale, vary)
+        print(f"> {name}: page size {len(source_html) / 1e6:.2f} MB, {function(HtmlPage(source_html))} results")
+        timings = { parser : best_of(function, source_html, parser, args.repeat) for parser in PARSERS }
+        for parser, timing in timings.items():
+            print(f"  {parser:<5} {timing:8.1f} ms  ({timings['bs4'] / timing:.1f}x)")
+
+if __name__ == "__main__":
+    main()
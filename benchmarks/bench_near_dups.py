@@ -0,0 +1,57 @@
+"""Benchmarks the near-duplicate search of NearDuplicateIndex on random perceptual hashes with
+planted near-duplicates, against comparing every pair in Python on a sample.
+
+Run from the project directory:
+    python benchmarks/bench_near_dups.py [--images 1000000] [--max-distance 3]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "image_scraper"))
+from near_dups import NearDuplicateIndex
+
+def pairwise_seconds(hashes : np.ndarray, max_distance : int) -> float:
+    """Returns the seconds taken to compare every pair of the hashes in Python."""
+    values = [ int(h) for h in hashes ]
+    start = time.perf_counter()
+    for i in range(len(values)):
+        for j in range(i + 1, len(values)):
+            bin(values[i] ^ values[j]).count("1") <= max_distance
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Near-duplicate search benchmark.")
+    parser.add_argument('--images', help='number of image hashes', type=int, default=1000000)
+    parser.add_argument('--duplicates', help='fraction of the images that are near-duplicates', type=float, default=0.05)
+    parser.add_argument('--max-distance', help='most bits in which near-duplicates differ', type=int, default=3)
+    parser.add_argument('--sample', help='number of hashes compared pairwise in Python', type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    n_duplicates = int(args.images * args.duplicates)
+    hashes = rng.integers(0, 2**63, args.images - n_duplicates, dtype=np.int64).astype(np.uint64) << np.uint64(1)
+    flipped = rng.integers(0, 64, (n_duplicates, args.max_distance)).astype(np.uint64)
+    flips = np.bitwise_or.reduce(np.uint64(1) << flipped, axis=1)
+    hashes = np.concatenate([hashes, hashes[:n_duplicates] ^ flips])
+
+    index = NearDuplicateIndex(tempfile.gettempdir())
+    index.hashes = hashes
+    index.paths = [ str(i) for i in range(len(hashes)) ]
+    index.pixels = np.zeros(len(hashes), dtype=np.int64)
+    start = time.perf_counter()
+    groups = index.find(max_distance=args.max_distance)
+    elapsed = time.perf_counter() - start
+    print(f"> {len(hashes)} hashes, {n_duplicates} planted near-duplicates within {args.max_distance} bits")
+    print(f"  NearDuplicateIndex.find: {elapsed:.2f} s, {sum(len(group) - 1 for group in groups)} duplicates in {len(groups)} groups")
+
+    sample_seconds = pairwise_seconds(hashes[:args.sample], args.max_distance)
+    n_pairs, n_sample_pairs = len(hashes) * (len(hashes) - 1) / 2, args.sample * (args.sample - 1) / 2
+    print(f"  Pairwise in Python: {sample_seconds:.2f} s for {args.sample} hashes, about {sample_seconds * n_pairs / n_sample_pairs / 3600:.0f} h for all")
+
+if __name__ == "__main__":
+    main()
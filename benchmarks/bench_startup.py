@@ -0,0 +1,72 @@
+"""Benchmarks the startup time of the CLI commands, which import only the modules they use,
+against the startup time of the interpreter itself.
+
+Run from the project directory:
+    python benchmarks/bench_startup.py [--repeat 10] [--max-ms 100]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+PACKAGE = os.path.join(ROOT, "image_scraper")
+CONFIG_PATH = os.path.join(PACKAGE, "config.json")
+
+def import_command(*modules : str):
+    return [sys.executable, "-c", f"import sys; sys.path.insert(0, {PACKAGE!r}); import {', '.join(modules)}"]
+
+# Commands run without network access, with the imports of the commands that download or scrape.
+# configure -r rewrites config.json, which is restored after the runs. download -url imports
+# requests once it sends its request, which is timed as well.
+COMMANDS = [
+    ("image_scraper --help", [sys.executable, PACKAGE, "--help"], True),
+    ("configure --help", [sys.executable, PACKAGE, "configure", "--help"], True),
+    ("configure -r", [sys.executable, PACKAGE, "configure", "-r"], True),
+    ("download --help", [sys.executable, PACKAGE, "download", "--help"], True),
+    ("download -url imports", import_command("main", "image"), True),
+    ("download -url request imports", import_command("main", "image", "requests"), False),
+    ("download --engine async imports", import_command("main", "aio_image"), False),
+    ("scrape imports", import_command("main", "image_search", "batch", "aio_image"), False),
+]
+
+def wall_times(command, repeat : int):
+    """Returns the wall times in milliseconds of repeat runs of a command."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description="CLI startup benchmark.")
+    parser.add_argument('--repeat', help='number of timed runs of each command', type=int, default=10)
+    parser.add_argument('--max-ms', help='startup time allowed to the light commands on top of the interpreter, exiting with 1 above it', type=float, default=100)
+    args = parser.parse_args()
+
+    baseline = min(wall_times([sys.executable, "-c", "pass"], args.repeat))
+    print(f"> Interpreter startup: {baseline:.0f} ms")
+    print(f"  {'COMMAND':<34} {'MIN MS':>8} {'MEDIAN MS':>10} {'OVERHEAD MS':>12}")
+    slow = []
+    with open(CONFIG_PATH, 'rb') as file:
+        config = file.read()
+    try:
+        results = [ (name, wall_times(command, args.repeat), light) for name, command, light in COMMANDS ]
+    finally:
+        with open(CONFIG_PATH, 'wb') as file:
+            file.write(config)
+    for name, timings, light in results:
+        overhead = min(timings) - baseline
+        print(f"  {name:<34} {min(timings):>8.0f} {statistics.median(timings):>10.0f} {overhead:>12.0f}")
+        if light and overhead > args.max_ms:
+            slow.append(name)
+    for name in slow:
+        print(f"Too slow: {name} takes more than {args.max_ms:.0f} ms on top of the interpreter")
+    if len(slow) > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
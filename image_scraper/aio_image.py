@@ -0,0 +1,270 @@
+import aiohttp
+import asyncio
+import time
+
+from concurrent.futures import Future
+from tqdm import tqdm
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
+
+from image import (ALREADY_REPORTED, BAD_REQUEST, INSUFFICIENT_STORAGE, NOT_MODIFIED, PAYLOAD_TOO_LARGE, REQUEST_TIMEOUT,
+                   SERVICE_UNAVAILABLE, BodyTooLarge, ImagesDownloader, PartFile)
+from metrics import METRICS
+from prefilter import ImageRejected
+from retry import CIRCUIT_OPEN, CONNECTION, TIMEOUT, Retry
+from url_stream import UrlStream
+
+def create_trace_config() -> aiohttp.TraceConfig:
+    """Returns a trace config that records the DNS and connect time of a request in the timing
+    dict passed as its trace_request_ctx."""
+    trace_config = aiohttp.TraceConfig()
+    
+    def start(phase):
+        async def on_start(session, context, params):
+            context.started = time.monotonic()
+        return on_start
+    
+    def end(phase):
+        async def on_end(session, context, params):
+            if context.trace_request_ctx is not None:
+                context.trace_request_ctx[phase] = time.monotonic() - context.started
+        return on_end
+    
+    trace_config.on_dns_resolvehost_start.append(start("dns"))
+    trace_config.on_dns_resolvehost_end.append(end("dns"))
+    trace_config.on_connection_create_start.append(start("connect"))
+    trace_config.on_connection_create_end.append(end("connect"))
+    return trace_config
+
+class RangeRejected(Exception):
+    """Raised when a server rejects the Range request of a partial file."""
+    pass
+
+
+class AsyncImagesDownloader(ImagesDownloader):
+    """Downloads images on a single event loop with a shared connection pool. The pool opens at
+    most max_in_flight connections and max_per_host per host, and with concurrency "auto" the
+    requests in flight are held below adaptive limits as well."""
+
+    # Image config params
+    # self.save_path
+    # self.concurrency
+    # self.adaptive_concurrency
+    # self.max_in_flight
+    # self.max_per_host
+    # self.max_body_size
+    # self.chunk_size
+    # self.dedup
+    # self.resume
+    # self.revalidate
+    # self.timeout
+    # self.retry_timeout
+    # self.retry
+    # self.circuit_breaker
+    # self.seen_urls
+    # self.prefilter
+    # self.near_dedup
+    # self.shards
+    # self.stream
+    # self.writer
+
+    async def download_attempt_async(self, session : aiohttp.ClientSession, image_url : str, attempt : int = 0) -> Tuple[Union[int, Future], Optional[str]]:
+        """Makes one attempt at fetching the image without blocking the event loop and hands the
+        body to the writer pool. Returns the response status, or the future of the status of a
+        body being written, and the error class of a retryable failure."""
+        timing = {}
+        start = time.monotonic()
+        METRICS.add("downloads_in_flight", 1)
+        try:
+            status, error = await self._download_attempt_async(session, image_url, attempt, timing)
+        finally:
+            METRICS.add("downloads_in_flight", -1)
+        timing["total"] = time.monotonic() - start
+        self.record_fetch(image_url, attempt, status, error, timing)
+        return status, error
+
+    async def _download_attempt_async(self, session : aiohttp.ClientSession, image_url : str, attempt : int, timing : Dict) -> Tuple[int, Optional[str]]:
+        # The manifest, the indexes and the part files are on disk, so they are read and written
+        # in worker threads and the event loop only buffers the body
+        loop = asyncio.get_running_loop()
+        if await loop.run_in_executor(None, self.is_downloaded, image_url):
+            return ALREADY_REPORTED, None
+        timeout = self.timeout if attempt == 0 else self.retry_timeout
+        start = time.monotonic()
+        request_headers = await loop.run_in_executor(None, self.request_headers, image_url)
+        try:
+            async with session.get(image_url, headers=request_headers, timeout=aiohttp.ClientTimeout(total=timeout), ssl=False,
+                                   trace_request_ctx=timing) as r:
+                timing["ttfb"] = time.monotonic() - start
+                part_file = await loop.run_in_executor(None, self._open_response, image_url, request_headers, r.status, r.headers)
+                if isinstance(part_file, tuple):
+                    return part_file
+                try:
+                    body_start = time.monotonic()
+                    async for chunk in r.content.iter_chunked(self.chunk_size):
+                        timing["bytes"] = timing.get("bytes", 0) + len(chunk)
+                        if part_file.buffer(chunk):
+                            await loop.run_in_executor(None, part_file.spill)
+                    timing["body"] = time.monotonic() - body_start
+                except BaseException:
+                    await loop.run_in_executor(None, part_file.release)
+                    raise
+        except RangeRejected:
+            # Retried once the connection is released, without a Range as the partial file is gone
+            return await self._download_attempt_async(session, image_url, attempt, timing)
+        except BodyTooLarge:
+            return PAYLOAD_TOO_LARGE, None
+        except ImageRejected as e:
+            return self.rejected_status(e.reason), None
+        except asyncio.TimeoutError:
+            return REQUEST_TIMEOUT, TIMEOUT
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError):
+            return SERVICE_UNAVAILABLE, CONNECTION
+        except aiohttp.ClientError as e:
+            # e.g. an invalid url or a redirect loop, which retrying does not help
+            print(f"Request failed at {image_url}: {e!r}")
+            return BAD_REQUEST, None
+        except OSError as e:
+            print(e)
+            return INSUFFICIENT_STORAGE, None
+        # The connection is back in the pool before waiting for a free writer
+        try:
+            await self.writer_pool.acquire_async()
+        except BaseException:
+            await loop.run_in_executor(None, part_file.release)
+            raise
+        return self.writer_pool.submit(self.write_part_file, image_url, r.status, r, part_file, block=False), None
+
+    def _open_response(self, image_url : str, request_headers : Dict[str, str], status : int, headers) -> Union[PartFile, Tuple[int, Optional[str]]]:
+        """Returns the part file to stream the body of a response into, or the status and error
+        class of a response whose body is not read. Raises RangeRejected for a rejected Range."""
+        if self.range_rejected(image_url, request_headers, status, headers):
+            raise RangeRejected()
+        if status >= 400:
+            return self.failed_status(image_url, status, headers)
+        if status == NOT_MODIFIED:
+            return NOT_MODIFIED, None
+        rejected_status = self.prefilter_status(headers)
+        if rejected_status is not None:
+            return rejected_status, None
+        return self.open_part_file(image_url, status, headers)
+
+    async def download_image_async(self, session : aiohttp.ClientSession, image_url : str) -> int:
+        """Downloads the image, retrying failures with backoff. Waiting retries only hold a
+        coroutine, so other downloads carry on."""
+        retry = Retry(image_url)
+        while True:
+            wait = self.circuit_breakers.wait_time(retry.host)
+            if wait > 0:
+                if self.retry_policy.backoff(CIRCUIT_OPEN, retry) is None:
+                    return SERVICE_UNAVAILABLE
+                await asyncio.sleep(wait)
+                continue
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire_async(image_url)
+            if self.adaptive is not None:
+                await self.adaptive.acquire_async(image_url)
+            start = time.monotonic()
+            error = None
+            try:
+                status, error = await self.download_attempt_async(session, image_url, retry.attempt)
+            finally:
+                if self.adaptive is not None:
+                    self.adaptive.release(image_url, time.monotonic() - start, error)
+            if isinstance(status, Future):
+                status = await asyncio.wrap_future(status)
+            self.circuit_breakers.record(retry.host, error)
+            delay = self.retry_policy.backoff(error, retry) if error is not None else None
+            if delay is None:
+                return status
+            retry.attempt += 1
+            await asyncio.sleep(delay)
+
+    async def download_url_async(self, session : aiohttp.ClientSession, image_url : str) -> int:
+        """Downloads a url unless it was already seen."""
+        loop = asyncio.get_running_loop()
+        image_url = await loop.run_in_executor(None, self.accept_url, image_url)
+        if image_url is None:
+            METRICS.inc("download_results_total", status=ALREADY_REPORTED)
+            return ALREADY_REPORTED
+        status = await self.download_image_async(session, image_url)
+        await loop.run_in_executor(None, self.record_result, image_url, status)
+        METRICS.inc("download_results_total", status=status)
+        return status
+
+    async def _download_all(self, image_urls : List[str]) -> List[int]:
+        """Downloads all urls concurrently within the global and per host limits."""
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight, limit_per_host=self.max_per_host, ssl=False)
+        async with aiohttp.ClientSession(connector=connector, trace_configs=[create_trace_config()]) as session:
+            tasks = [ asyncio.ensure_future(self.download_url_async(session, url)) for url in image_urls ]
+            for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+                await task
+            return [ task.result() for task in tasks ]
+
+    async def download_stream(self, image_urls : AsyncIterator[str]) -> None:
+        """Downloads urls on the running event loop as they are yielded, so downloads run
+        whenever the search awaits."""
+        print("> Downloading images as they are found (async)...")
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight, limit_per_host=self.max_per_host, ssl=False)
+        async with aiohttp.ClientSession(connector=connector, trace_configs=[create_trace_config()]) as session:
+            with tqdm() as progress:
+                tasks = []
+                async for image_url in image_urls:
+                    task = asyncio.ensure_future(self.download_url_async(session, image_url))
+                    task.add_done_callback(lambda _: progress.update())
+                    tasks.append(task)
+                status_codes = await asyncio.gather(*tasks)
+        self.writer_pool.flush()
+        print("> Event loop complete")
+        self.remove_near_duplicates()
+        self.print_summary(status_codes)
+
+    async def _download_file(self, url_stream : UrlStream, progress : tqdm) -> None:
+        """Downloads the urls of a stream with at most stream.window downloads in flight."""
+        window = asyncio.Semaphore(self.stream.get("window", 1000))
+        tasks = set()
+        
+        def finish(task, image_url):
+            tasks.discard(task)
+            window.release()
+            url_stream.finish(image_url, task.result())
+            progress.update()
+        
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight, limit_per_host=self.max_per_host, ssl=False)
+        async with aiohttp.ClientSession(connector=connector, trace_configs=[create_trace_config()]) as session:
+            for offset, image_url in url_stream:
+                await window.acquire()
+                url_stream.start(image_url, offset)
+                task = asyncio.ensure_future(self.download_url_async(session, image_url))
+                task.add_done_callback(lambda task, image_url=image_url: finish(task, image_url))
+                tasks.add(task)
+            await asyncio.gather(*tasks)
+    
+    def download_file(self, file_name : str) -> None:
+        """Runs the downloads of a url file on an asyncio event loop as its lines are read."""
+        print(f"> Streaming images from {file_name} (async)...")
+        url_stream = self.create_url_stream(file_name)
+        try:
+            with tqdm(initial=sum(url_stream.counts.values())) as progress:
+                asyncio.run(self._download_file(url_stream, progress))
+        except BaseException:
+            # Saves how far an interrupted run got
+            url_stream.checkpoint()
+            raise
+        url_stream.complete()
+        self.writer_pool.flush()
+        print("> Event loop complete")
+        self.remove_near_duplicates()
+        if url_stream.n_invalid > 0:
+            print(f"> Skipped {url_stream.n_invalid} invalid lines.")
+        self.print_summary(url_stream.counts)
+
+    def download_queue(self, image_urls) -> None:
+        """Runs the image downloads on an asyncio event loop."""
+        print("> Downloading images in queue (async)...")
+        if image_urls is None or len(image_urls) == 0:
+            raise Exception("Error: [ImageDownloader] image_urls queue is empty. ")
+        status_codes = asyncio.run(self._download_all(image_urls))
+        self.writer_pool.flush()
+        print("> Event loop complete")
+        self.remove_near_duplicates()
+        self.print_summary(status_codes)
@@ -0,0 +1,253 @@
+import asyncio
+import threading
+import time
+
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from http.client import responses
+from multiprocessing.util import Finalize
+from tqdm import tqdm
+from typing import Callable, Dict, List, Optional, Tuple
+
+from concurrency import AdaptiveConcurrency
+from image import ALREADY_REPORTED, ImagesDownloader
+from image_search import GoogleSearch, PinterestSearch
+from metrics import METRICS
+from rate_limit import HostRateLimiter, share_rate_limits
+from retry import HostCircuitBreakers, RetryPolicy, RetryScheduler
+from utils import tabulate
+from webdriver import WebDriverPool
+from work_queue import QUERY, WorkItem, WorkQueue
+
+SEARCH_ENGINES = {
+    "Google": GoogleSearch,
+    "Pinterest": PinterestSearch,
+}
+
+# Browser session of a worker process
+_driver_pool : WebDriverPool = None
+
+def _initialise_worker(webdriver_config : Dict, rate_limit_config : Dict) -> None:
+    """Gives the worker process its own browser session, which is quit when the process exits.
+    Page loads are paced by a rate limiter of the worker process, given its share of the rates."""
+    global _driver_pool
+    _driver_pool = WebDriverPool(driver_config=webdriver_config, pool_size=1, max_uses=webdriver_config.get("max_uses", 20),
+                                 rate_limiter=HostRateLimiter(**rate_limit_config))
+    Finalize(_driver_pool, _driver_pool.close, exitpriority=10)
+
+def _search_query(engine : str, query : str, driver_config : Dict) -> Tuple[List[str], Dict, Dict]:
+    """Searches a query in a worker process and returns the image urls, the search details and
+    the metrics recorded by the worker since its previous search."""
+    search = SEARCH_ENGINES[engine](query=query, driver_config=driver_config, driver_pool=_driver_pool)
+    try:
+        image_urls = asyncio.run(search.get_search_image_urls())
+    finally:
+        snapshot = METRICS.snapshot()
+        METRICS.reset()
+    return image_urls, search.get_details(), snapshot
+
+
+class BatchScraper:
+    """Scrapes many queries on a pool of worker processes, each running its own browser.
+
+    Searches are spread over the workers with at most max_concurrency searches of an engine
+    running at once, and the urls they find are downloaded by one shared download stage into
+    a subfolder per query while the other searches are still running. The downloaders of the
+    queries share the indexes of the save_path, passed to create_downloader with the query.
+
+    With a work_queue, queries are also leased from its query items a few at a time, so the
+    batches of other processes or machines sharing the queue split them. A query is acked
+    once its searches and downloads are done.
+    """
+
+    def __init__(self, driver_configs : Dict[str, Dict], image_config : Dict,
+                 create_downloader : Callable[[str, Optional[ImagesDownloader]], ImagesDownloader],
+                 workers : int = 2, export_urls : bool = False, rate_limiter : HostRateLimiter = None,
+                 search : Callable[[str, str, Dict], Tuple[List[str], Dict, Dict]] = _search_query,
+                 work_queue : WorkQueue = None, worker_id : str = None, poll_interval : float = 5):
+        self._driver_configs = driver_configs
+        self._create_downloader = create_downloader
+        self._search = search # Runs in the worker processes
+        self._workers = workers
+        self._export_urls = export_urls
+        self._rate_limiter = rate_limiter
+        self._retry_policy = RetryPolicy(**image_config.get("retry", {}))
+        self._circuit_breakers = HostCircuitBreakers(**image_config.get("circuit_breaker", {}))
+        self._max_workers = image_config.get("concurrency", 10)
+        self._concurrency = None
+        if self._max_workers == "auto":
+            self._concurrency = AdaptiveConcurrency(image_config.get("max_in_flight", 100), image_config.get("max_per_host", 10),
+                                                    **image_config.get("adaptive_concurrency", {}))
+        self._downloaders : Dict[str, ImagesDownloader] = {} # Downloader of each query
+        self._url_queries : Dict[str, str] = {} # Query that found each url
+        self._status_codes : Dict[str, Counter] = {} # Status counts of each query
+        self._searches_left : Counter = Counter() # Searches of each query not finished yet
+        self._downloads_left : Counter = Counter() # Downloads of each query not finished yet
+        self._failed_searches : Counter = Counter() # Failed searches of each query
+        self._work_queue = work_queue
+        self._worker_id = worker_id
+        self._poll_interval = poll_interval
+        self._leased : Dict[str, WorkItem] = {} # Work item of each query leased from the work queue
+        self._last_heartbeat = time.monotonic()
+        self._lock = threading.Lock()
+        self._progress : tqdm = None
+
+    def run(self, queries : List[str], webdriver_config : Dict, rate_limit_config : Dict = None) -> None:
+        """Searches every query on every engine, and those leased from the work queue until none
+        is left queued, and downloads the images found."""
+        engines = list(self._driver_configs.keys())
+        source = f"{len(queries)} queries" if self._work_queue is None else "queries from the work queue"
+        print(f"> Scraping {source} on {', '.join(engines)} with {self._workers} workers...")
+        pending = { engine : deque(queries) for engine in engines }
+        in_flight = Counter()
+        searches = {}
+        failed = []
+        for query in queries:
+            self._searches_left[query] += len(engines)
+
+        def lease_queries() -> None:
+            """Leases queries from the work queue to keep every worker busy."""
+            if self._work_queue is None:
+                return
+            n_free = self._workers - max(len(engine_queries) for engine_queries in pending.values())
+            items = self._work_queue.lease(self._worker_id, n_free, kind=QUERY) if n_free > 0 else []
+            with self._lock:
+                for item in items:
+                    self._leased[item.value] = item
+                    self._searches_left[item.value] += len(engines)
+            for engine in engines:
+                pending[engine].extend(item.value for item in items)
+
+        def submit_searches(executor) -> None:
+            """Submits searches round robin over the engines, within the worker and engine limits."""
+            submitted = True
+            while submitted and len(searches) < self._workers:
+                submitted = False
+                for engine in engines:
+                    cap = self._driver_configs[engine].get("max_concurrency", self._workers)
+                    if len(pending[engine]) > 0 and in_flight[engine] < cap and len(searches) < self._workers:
+                        query = pending[engine].popleft()
+                        future = executor.submit(self._search, engine, query, self._driver_configs[engine])
+                        searches[future] = (engine, query)
+                        in_flight[engine] += 1
+                        submitted = True
+
+        try:
+            with ProcessPoolExecutor(max_workers=self._workers, initializer=_initialise_worker, initargs=(webdriver_config, share_rate_limits(rate_limit_config or {}, self._workers))) as executor, \
+                 tqdm(total=0, desc="Downloading images") as self._progress, \
+                 RetryScheduler(self._download_attempt, self._retry_policy, self._circuit_breakers, max_workers=self._max_workers,
+                                on_result=self._on_result, limiter=self._rate_limiter, concurrency=self._concurrency) as scheduler:
+                lease_queries()
+                submit_searches(executor)
+                while len(searches) > 0:
+                    done, _ = wait(searches, timeout=self._poll_interval, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        engine, query = searches.pop(future)
+                        in_flight[engine] -= 1
+                        try:
+                            image_urls, _, snapshot = future.result()
+                        except Exception as e:
+                            print(f"Search failed for '{query}' on {engine}: {e!r}")
+                            failed.append((engine, query))
+                            self._failed_searches[query] += 1
+                            self._submit_downloads(scheduler, query, [])
+                            continue
+                        METRICS.merge(snapshot)
+                        self._submit_downloads(scheduler, query, image_urls)
+                        if self._export_urls:
+                            self.export_urls(engine, query, image_urls)
+                    self._heartbeat()
+                    lease_queries()
+                    submit_searches(executor)
+        finally:
+            if self._work_queue is not None:
+                # Queries not done are left to the workers sharing the queue
+                self._work_queue.release(self._worker_id)
+        print("> Executor complete")
+        if len(self._downloaders) > 0:
+            # The downloaders of the queries share the index of the save_path and the writer pool
+            downloader = next(iter(self._downloaders.values()))
+            downloader.writer_pool.shutdown()
+            downloader.remove_near_duplicates()
+        self.print_summary(failed)
+
+    def _submit_downloads(self, scheduler : RetryScheduler, query : str, image_urls : List[str]) -> None:
+        """Queues the urls found by a search of a query on the shared download stage. Urls already
+        queued by another search are reported without being downloaded again."""
+        with self._lock:
+            self._searches_left[query] -= 1
+            if query not in self._downloaders and len(image_urls) > 0:
+                self._downloaders[query] = self._create_downloader(query, next(iter(self._downloaders.values()), None))
+                self._status_codes[query] = Counter()
+            new_urls = []
+            for image_url in image_urls:
+                image_url = self._downloaders[query].accept_url(image_url)
+                if image_url is None or image_url in self._url_queries:
+                    self._status_codes[query][ALREADY_REPORTED] += 1
+                else:
+                    self._url_queries[image_url] = query
+                    new_urls.append(image_url)
+            self._downloads_left[query] += len(new_urls)
+            self._progress.total += len(new_urls)
+            self._progress.refresh()
+            self._finish_if_done(query)
+        for image_url in new_urls:
+            scheduler.submit(image_url)
+
+    def _download_attempt(self, image_url : str, attempt : int):
+        return self._downloaders[self._url_queries[image_url]].download_attempt(image_url, attempt)
+
+    def _on_result(self, image_url : str, status : int) -> None:
+        query = self._url_queries[image_url]
+        self._downloaders[query].record_result(image_url, status)
+        with self._lock:
+            self._status_codes[query][status] += 1
+            self._downloads_left[query] -= 1
+            self._progress.update()
+            self._finish_if_done(query)
+        self._heartbeat()
+
+    def _finish_if_done(self, query : str) -> None:
+        """Closes the files of a query's subfolder once its searches and downloads are done, so
+        the open files stay bounded however many queries a batch has, and acks the query if it
+        was leased. Requires the lock."""
+        if self._searches_left[query] > 0 or self._downloads_left[query] > 0:
+            return
+        if query in self._downloaders:
+            self._downloaders[query].close()
+        item = self._leased.pop(query, None)
+        if item is not None:
+            self._work_queue.ack(self._worker_id, item, failed=self._failed_searches[query] == len(self._driver_configs))
+
+    def _heartbeat(self) -> None:
+        """Extends the leases of the queries every poll_interval, while they are searched or downloaded."""
+        if self._work_queue is None:
+            return
+        with self._lock:
+            if time.monotonic() - self._last_heartbeat < self._poll_interval:
+                return
+            self._last_heartbeat = time.monotonic()
+        self._work_queue.heartbeat(self._worker_id)
+
+    def export_urls(self, engine : str, query : str, image_urls : List[str]) -> None:
+        file_name = "{}_{}_image_urls.txt".format(query.lower().replace(' ','_'), engine.lower())
+        with open(file_name,'w') as file:
+            for url in image_urls:
+                file.write(f"{url}\n")
+
+    def print_summary(self, failed : List[Tuple[str, str]]) -> None:
+        """Prints the images downloaded per query and the number of images per response status."""
+        totals = Counter()
+        for status_codes in self._status_codes.values():
+            totals.update(status_codes)
+        downloaded = { query : f"{status_codes[200]}/{sum(status_codes.values())}" for query, status_codes in self._status_codes.items() }
+        tabulate(downloaded, headers=("QUERY", "DOWNLOADED"))
+        tabulate({ responses[code] : total for code, total in totals.items() }, headers=("STATUS", "TOTAL IMAGES"))
+        open_hosts = self._circuit_breakers.open_hosts()
+        if len(open_hosts) > 0:
+            tabulate(open_hosts, headers=("OPEN CIRCUIT HOST", "FAILURES"))
+        if self._concurrency is not None:
+            tabulate(self._concurrency.limits(), headers=("CONCURRENCY", "LIMIT"))
+        if len(failed) > 0:
+            tabulate(dict(Counter(engine for engine, _ in failed)), headers=("FAILED SEARCHES", "TOTAL"))
+        print(f"\n> Successfully downloaded {totals[200]} images for {len(self._status_codes)} queries.")
@@ -0,0 +1,71 @@
+import re
+
+from typing import Callable, Dict
+from urllib.parse import parse_qsl, unquote, urlsplit, urlunsplit
+
+# Query parameters that only track where a link was shared or clicked
+TRACKING_PARAMS = ["fbclid", "gclid", "dclid", "msclkid", "igshid", "mc_cid", "mc_eid", "ref_src", "_hsenc", "_hsmi"]
+TRACKING_PREFIXES = ["utm_"]
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+# Pinterest serves the sizes of a pin, e.g. /236x/ or /736x/, next to the /originals/ upload, at
+# /<size>/<aa>/<bb>/<cc>/<hash>[-<slug>].<ext>
+PINTEREST_IMAGE_PATTERN = re.compile(r"^/[^/]+/([0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]+)[^/.]*(\.[A-Za-z0-9]+)$")
+
+def _is_tracking_param(name : str) -> bool:
+    name = name.lower()
+    return name in TRACKING_PARAMS or any(name.startswith(prefix) for prefix in TRACKING_PREFIXES)
+
+def _rewrite_pinterest(url : str) -> str:
+    """Returns the url of the original upload of a Pinterest image of any size."""
+    parts = urlsplit(url)
+    match = PINTEREST_IMAGE_PATTERN.match(parts.path)
+    if match is None:
+        return url
+    return urlunsplit((parts.scheme, parts.netloc, f"/originals/{match.group(1)}{match.group(2)}", "", ""))
+
+def _rewrite_google(url : str) -> str:
+    """Returns the image url of a Google Images result link."""
+    parts = urlsplit(url)
+    if parts.path == "/imgres":
+        image_url = dict(parse_qsl(parts.query)).get("imgurl")
+        if image_url:
+            return rewrite_url(image_url)
+    return url
+
+# Rewrites of the links of each search engine host to the image they point to
+HOST_REWRITES : Dict[str, Callable[[str], str]] = {
+    "i.pinimg.com": _rewrite_pinterest,
+    "www.google.com": _rewrite_google,
+}
+
+def rewrite_url(url : str) -> str:
+    """Returns the url of the image a search engine link points to, e.g. the original upload
+    of a Pinterest thumbnail, or the url itself. This is the url that gets downloaded."""
+    url = url.strip()
+    rewrite = HOST_REWRITES.get((urlsplit(url).hostname or "").lower())
+    return rewrite(url) if rewrite is not None else url
+
+def canonicalize_url(url : str) -> str:
+    """Returns the canonical form of an image url, the key under which variants of a url are
+    only downloaded once. The url itself is downloaded, not its canonical form.
+
+    Search engine links are rewritten first. Then the scheme and host are lowercased, default
+    ports, fragments and tracking parameters are dropped and the remaining query parameters
+    are sorted.
+    """
+    parts = urlsplit(rewrite_url(url))
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if ":" in host:
+        # IPv6 addresses keep their brackets
+        host = f"[{host}]"
+    if parts.port is not None and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    if parts.username is not None:
+        host = f"{parts.netloc.rsplit('@', 1)[0]}@{host}"
+    # Parameters are kept as encoded, since servers may not decode every encoding the same
+    params = [ param for param in parts.query.split("&") if param and not _is_tracking_param(unquote(param.split("=", 1)[0])) ]
+    query = "&".join(sorted(params))
+    return urlunsplit((scheme, host, parts.path or "/", query, ""))
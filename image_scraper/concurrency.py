@@ -0,0 +1,179 @@
+import collections
+import threading
+import time
+
+from typing import TYPE_CHECKING, Deque, Dict, Optional
+
+from retry import CONNECTION, SERVER, THROTTLED, TIMEOUT, get_host
+
+if TYPE_CHECKING:
+    import asyncio
+
+# Errors telling that a host is overloaded
+CONGESTION_ERRORS = [TIMEOUT, CONNECTION, SERVER, THROTTLED]
+
+class AimdLimit:
+    """A concurrency limit adjusted by additive increase and multiplicative decrease.
+
+    The limit grows by one every limit successful requests while it is fully used. It is cut
+    by backoff on errors, and by latency_backoff when the smoothed latency reaches
+    latency_tolerance times its baseline: once the limit is past what the other side can
+    serve, more requests in flight only queue up, so the throughput stays flat while the
+    latency grows. The limit is cut at most once per smoothed latency, so the burst of errors
+    of one overload counts once. The latency can be any positive measure, such as the ratio
+    of a latency to its baseline.
+    """
+
+    def __init__(self, initial : int, min_limit : int = 1, max_limit : int = 100, backoff : float = 0.5,
+                 latency_backoff : float = 0.9, latency_tolerance : float = 2.0, smoothing : float = 0.1):
+        self.min_limit : int = min_limit
+        self.max_limit : int = max(max_limit, min_limit)
+        self.limit : float = float(min(max(initial, min_limit), self.max_limit))
+        self.peak : int = int(self.limit)
+        self.in_flight : int = 0
+        self._backoff : float = backoff
+        self._latency_backoff : float = latency_backoff
+        self._latency_tolerance : float = latency_tolerance
+        self._smoothing : float = smoothing
+        self.latency : Optional[float] = None # Exponentially weighted moving average
+        self.baseline : Optional[float] = None # Lowest smoothed latency, drifting up slowly
+        self._last_decrease : float = 0
+
+    @property
+    def value(self) -> int:
+        return int(self.limit)
+
+    def record(self, latency : Optional[float], congested : bool = False, cooldown : float = None) -> None:
+        """Adjusts the limit after a request that took latency seconds. The limit is cut at most
+        once per cooldown seconds, the smoothed latency by default."""
+        now = time.monotonic()
+        if latency is not None:
+            self.latency = latency if self.latency is None else self.latency + self._smoothing * (latency - self.latency)
+            if self.baseline is None or self.latency < self.baseline:
+                self.baseline = self.latency
+            else:
+                self.baseline += self._smoothing / 100 * (self.latency - self.baseline)
+        slow = self.baseline is not None and self.latency > self.baseline * self._latency_tolerance
+        if congested or slow:
+            if now - self._last_decrease >= (cooldown if cooldown is not None else self.latency or 0):
+                self.limit = max(self.min_limit, self.limit * (self._backoff if congested else self._latency_backoff))
+                self._last_decrease = now
+        elif self.in_flight + 1 >= self.value:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.peak = max(self.peak, self.value)
+
+
+class AdaptiveConcurrency:
+    """Thread safe AIMD limits on the requests in flight, in total and per host.
+
+    Each host limit reacts to the errors and latency of its host. The global limit reacts to
+    the latency of requests relative to the baseline of their host, which grows for all hosts
+    at once when the local bandwidth or CPU runs out. At most max_hosts host limits are kept:
+    the limits of the hosts idle for the longest are dropped first, and start over from
+    host_initial if their host is requested again.
+    """
+
+    def __init__(self, max_in_flight : int = 100, max_per_host : int = 10, initial : int = 8, host_initial : int = 4,
+                 backoff : float = 0.5, latency_tolerance : float = 2.0, max_hosts : int = 1000):
+        self._host_config : Dict = {"initial": host_initial, "max_limit": max_per_host, "backoff": backoff, "latency_tolerance": latency_tolerance}
+        self._max_hosts : int = max_hosts
+        self.total = AimdLimit(initial, max_limit=max_in_flight, backoff=backoff, latency_tolerance=latency_tolerance)
+        self.hosts : Dict[str, AimdLimit] = collections.OrderedDict() # Least recently used first
+        self._lock = threading.Lock()
+        self._waiters : Dict[str, Deque["asyncio.Future"]] = collections.OrderedDict()
+
+    def _get(self, host : str) -> AimdLimit:
+        if host not in self.hosts:
+            self._evict()
+            self.hosts[host] = AimdLimit(**self._host_config)
+        else:
+            self.hosts.move_to_end(host)
+        return self.hosts[host]
+
+    def _evict(self) -> None:
+        """Drops the limits of the least recently used idle hosts past max_hosts. Requires the lock."""
+        n_evicted = len(self.hosts) + 1 - self._max_hosts
+        for host in list(self.hosts):
+            if n_evicted <= 0:
+                break
+            if self.hosts[host].in_flight == 0 and host not in self._waiters:
+                del self.hosts[host]
+                n_evicted -= 1
+
+    def _try_acquire(self, host : str) -> bool:
+        """Takes a slot of the host and a global slot if both are free. Requires the lock."""
+        limit = self._get(host)
+        if limit.in_flight >= limit.value or self.total.in_flight >= self.total.value:
+            return False
+        limit.in_flight += 1
+        self.total.in_flight += 1
+        return True
+
+    def try_acquire(self, url : str) -> bool:
+        """Takes a slot for a request to the host of the url, if one is free."""
+        with self._lock:
+            return self._try_acquire(get_host(url))
+
+    def wait_time(self, url : str) -> float:
+        """Returns about how long a slot of the host of the url takes to free up."""
+        with self._lock:
+            limit = self._get(get_host(url))
+            return min(1.0, max(0.01, (limit.latency or 0.1) / max(limit.in_flight, 1)))
+
+    async def acquire_async(self, url : str) -> None:
+        """Waits for a slot on the event loop, in the order the requests to a host came in."""
+        import asyncio
+        host = get_host(url)
+        with self._lock:
+            if host not in self._waiters and self._try_acquire(host):
+                return
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.setdefault(host, collections.deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(url, None) # The slot was handed over as the task was cancelled
+            raise
+
+    def release(self, url : str, latency : Optional[float], error : Optional[str] = None) -> None:
+        """Frees the slot of a finished request and adjusts the limits."""
+        host = get_host(url)
+        congested = error in CONGESTION_ERRORS
+        with self._lock:
+            limit = self._get(host)
+            limit.in_flight -= 1
+            self.total.in_flight -= 1
+            baseline = limit.baseline
+            limit.record(latency, congested)
+            ratio = latency / baseline if latency is not None and baseline else None
+            # Errors of one host do not lower the global limit
+            self.total.record(ratio, cooldown=limit.latency)
+            self._wake()
+
+    def _wake(self) -> None:
+        """Hands the free slots to the waiting requests, taking turns between hosts. Requires the lock."""
+        for host in list(self._waiters):
+            waiters = self._waiters[host]
+            while waiters:
+                if waiters[0].done():
+                    waiters.popleft() # Cancelled
+                elif self._try_acquire(host):
+                    waiters.popleft().set_result(None)
+                else:
+                    break
+            if not waiters:
+                del self._waiters[host]
+            else:
+                self._waiters.move_to_end(host)
+
+    def limits(self, top : int = 10) -> Dict[str, str]:
+        """Returns the limit reached and the peak limit in total and of the top hosts with the
+        highest peak limits."""
+        with self._lock:
+            limits = {"All hosts": f"{self.total.value} (peak {self.total.peak})"}
+            hosts = sorted(self.hosts.items(), key=lambda item: (-item[1].peak, item[0]))
+            limits.update({ host : f"{limit.value} (peak {limit.peak})" for host, limit in hosts[:top] })
+            if len(hosts) > top:
+                limits["Other hosts"] = str(len(hosts) - top)
+            return limits
@@ -1,7 +1,10 @@
 import json
+import os
 
 from typing import Dict
 
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json")
+
 class Config:
     
     def __init__(self, dictionary):
@@ -19,11 +22,11 @@ def update_dictionary(prev: Dict, new: Dict):
 
 def save_config_json(config_dict : Dict):
     json_config = json.loads(json.dumps(config_dict))
-    with open("image_scraper/config.json",'w', encoding='utf-8') as file:
+    with open(CONFIG_PATH,'w', encoding='utf-8') as file:
         json.dump(json_config, file, sort_keys=True, ensure_ascii=False, indent=4)
 
 def update_config_json(new : Dict):
-    with open("image_scraper/config.json", 'r', encoding='utf-8') as file:
+    with open(CONFIG_PATH, 'r', encoding='utf-8') as file:
         prev = json.load(file)
     updated = update_dictionary(prev, new)
     save_config_json(updated)
@@ -32,11 +35,106 @@ def reset_defaults():
     default_config = {
         "image": {
             "save_path": "images/",
-            "create_subfolder": True
+            "create_subfolder": True,
+            "engine": "threads",
+            "concurrency": "auto",
+            "adaptive_concurrency": {
+                "initial": 8,
+                "host_initial": 4,
+                "backoff": 0.5,
+                "latency_tolerance": 2.0,
+                "max_hosts": 1000
+            },
+            "max_in_flight": 100,
+            "max_per_host": 10,
+            "max_body_size": 52428800,
+            "chunk_size": 65536,
+            "dedup": "skip",
+            "resume": True,
+            "revalidate": False,
+            "timeout": 10,
+            "retry_timeout": 20,
+            "retry": {
+                "base_delay": 0.5,
+                "max_delay": 30,
+                "budgets": {
+                    "timeout": 2,
+                    "connection": 2,
+                    "server": 2,
+                    "throttled": 3,
+                    "circuit_open": 3
+                }
+            },
+            "circuit_breaker": {
+                "failure_threshold": 5,
+                "cooldown": 30
+            },
+            "seen_urls": {
+                "enabled": True,
+                "capacity": 10000000,
+                "error_rate": 0.001
+            },
+            "near_dedup": {
+                "action": "off",
+                "max_distance": 3,
+                "workers": 0
+            },
+            "writer": {
+                "workers": 4,
+                "queue_size": 64,
+                "spool_size": 1048576,
+                "fsync": "off",
+                "fsync_batch": 64
+            },
+            "stream": {
+                "window": 1000,
+                "checkpoint_interval": 10
+            },
+            "shards": {
+                "enabled": False,
+                "max_size": 1073741824
+            },
+            "prefilter": {
+                "enabled": False,
+                "min_width": 0,
+                "min_height": 0,
+                "mime_types": ["image/jpeg", "image/png", "image/gif", "image/webp"],
+                "max_bytes": 0,
+                "sniff_bytes": 65536
+            },
+            "queue": {
+                "lease_timeout": 300,
+                "max_attempts": 3,
+                "batch_size": 100,
+                "poll_interval": 5
+            }
+        },
+        "rate_limit": {
+            "default": {
+                "rate": 20,
+                "burst": 20
+            },
+            "hosts": {
+                "i.pinimg.com": {
+                    "rate": 50,
+                    "burst": 50
+                },
+                "www.google.com": {
+                    "rate": 1,
+                    "burst": 2
+                },
+                "www.pinterest.com": {
+                    "rate": 1,
+                    "burst": 2
+                }
+            }
         },
         "webdriver": {
             "browser": "Chrome",
             "path": "drivers/chromedriver",
+            "pool_size": 2,
+            "max_uses": 20,
+            "workers": 2
         },
         "search": {
             "Google": {
@@ -44,19 +142,29 @@ def reset_defaults():
                 "undetect_limit": 10,
                 "load_sleep": 2,
                 "iterate_sleep": 0.2,
-                "webdriverwait_sleep": 2
+                "webdriverwait_sleep": 2,
+                "poll_interval": 0.1,
+                "network_idle": 0.5,
+                "max_busy_timeouts": 2,
+                "extraction": "source",
+                "parser": "lxml",
+                "max_concurrency": 2
             },
             "Pinterest": {
                 "scroll_limit": 200000,
                 "undetect_limit": 10,
                 "load_sleep": 3,
                 "iterate_sleep": 0.2,
-                "webdriverwait_sleep": 2
+                "webdriverwait_sleep": 2,
+                "poll_interval": 0.1,
+                "network_idle": 0.5,
+                "max_busy_timeouts": 2,
+                "max_concurrency": 1
             }
         }
     }
     json_config = json.loads(json.dumps(default_config))
-    with open("image_scraper/config.json", 'w', encoding='utf-8') as file:
+    with open(CONFIG_PATH, 'w', encoding='utf-8') as file:
         json.dump(json_config, file, sort_keys=True, ensure_ascii=False, indent=4)
 
 if __name__ == "__main__":
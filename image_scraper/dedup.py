@@ -0,0 +1,71 @@
+import os
+import sqlite3
+import threading
+
+from typing import Optional
+
+class DedupIndex:
+    """A persistent content-addressed index of the images saved under a save_path.
+
+    Maps sha256 digests to saved files and downloaded urls to digests, so duplicate
+    content and urls seen in previous runs can be recognised without writing them again.
+    """
+
+    FILE_NAME = ".image_index.sqlite3"
+
+    def __init__(self, directory : str):
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(directory, self.FILE_NAME), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS files (sha256 TEXT PRIMARY KEY, path TEXT NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, sha256 TEXT NOT NULL)")
+        self._conn.commit()
+
+    def _existing_path(self, relative_path : Optional[str]) -> Optional[str]:
+        """Returns the full path of an indexed file if it is still on disk."""
+        if relative_path is None:
+            return None
+        full_path = os.path.join(self._directory, relative_path)
+        return full_path if os.path.isfile(full_path) else None
+
+    def lookup_hash(self, sha256 : str) -> Optional[str]:
+        """Returns the path of a saved file with the given digest."""
+        with self._lock:
+            row = self._conn.execute("SELECT path FROM files WHERE sha256 = ?", (sha256,)).fetchone()
+        return self._existing_path(row[0] if row else None)
+
+    def lookup_url(self, url : str) -> Optional[str]:
+        """Returns the path of the saved file previously downloaded from the url."""
+        with self._lock:
+            row = self._conn.execute("SELECT files.path FROM urls JOIN files USING (sha256) WHERE urls.url = ?", (url,)).fetchone()
+        return self._existing_path(row[0] if row else None)
+
+    def add(self, sha256 : str, full_file_path : str, url : str = None) -> None:
+        """Records a saved file and the url it was downloaded from."""
+        relative_path = os.path.relpath(full_file_path, self._directory)
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO files (sha256, path) VALUES (?, ?)", (sha256, relative_path))
+            if url is not None:
+                self._conn.execute("INSERT OR REPLACE INTO urls (url, sha256) VALUES (?, ?)", (url, sha256))
+            self._conn.commit()
+
+    def add_url(self, sha256 : str, url : str) -> None:
+        """Records a url whose content is already indexed."""
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO urls (url, sha256) VALUES (?, ?)", (url, sha256))
+            self._conn.commit()
+
+    def move(self, full_file_path : str, new_full_file_path : str) -> None:
+        """Points the digest and urls of a removed file at another file, e.g. the image kept in
+        place of a near-duplicate."""
+        with self._lock:
+            self._conn.execute("UPDATE files SET path = ? WHERE path = ?",
+                               (os.path.relpath(new_full_file_path, self._directory), os.path.relpath(full_file_path, self._directory)))
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
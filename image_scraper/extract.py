@@ -0,0 +1,92 @@
+import functools
+import json
+import re
+
+from typing import List
+from urllib.parse import urlsplit
+
+from canonical import rewrite_url
+
+# Google embeds each result's original image as ["<url>",<height>,<width>] in the inline
+# AF_initDataCallback script data. Urls are JSON escaped, e.g. '=' is written as \u003d.
+GOOGLE_IMAGE_PATTERN = re.compile(r'\["(https?://(?:[^"\\]|\\.)+?)",(\d+),(\d+)\]')
+# Thumbnails and page assets are served from Google's static content domain
+GOOGLE_STATIC_DOMAIN = "gstatic.com"
+
+PINTEREST_THUMBNAIL_PREFIX = "https://i.pinimg.com/236x/"
+
+PARSERS = ["lxml", "bs4"]
+
+def _class_path(tag : str, class_name : str) -> str:
+    """Returns an XPath selecting the tag elements with the class name."""
+    return f"//{tag}[contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')]"
+
+@functools.lru_cache(maxsize=None)
+def _compile(expression : str):
+    from lxml import etree
+    return etree.XPath(expression)
+
+
+class HtmlPage:
+    """A page source that is parsed at most once and shared by the extractors run on it.
+
+    The lxml parser runs compiled XPath queries on the C tree, while the bs4 parser is the
+    slower BeautifulSoup tree the scrapers used before.
+    """
+    
+    def __init__(self, source_html : str, parser : str = "lxml"):
+        if parser not in PARSERS:
+            raise ValueError(f"Unknown parser '{parser}', expected one of {PARSERS}")
+        self.source_html : str = source_html
+        self.parser : str = parser
+        self._tree = None
+    
+    @property
+    def tree(self):
+        if self._tree is None:
+            if self.parser == "lxml":
+                import lxml.html
+                self._tree = lxml.html.fromstring(self.source_html)
+            else:
+                from bs4 import BeautifulSoup
+                self._tree = BeautifulSoup(self.source_html, 'lxml')
+        return self._tree
+    
+    def count_class(self, tag : str, class_name : str) -> int:
+        """Returns the number of tag elements with the class name."""
+        if self.parser == "lxml":
+            return int(_compile(f"count({_class_path(tag, class_name)})")(self.tree))
+        return len(self.tree.find_all(tag, {"class": class_name}))
+    
+    def image_sources(self, prefix : str, container_class : str = None) -> List[str]:
+        """Returns the src of the img elements starting with the prefix, optionally only those
+        inside div elements with the container class."""
+        if self.parser == "lxml":
+            path = _class_path("div", container_class) if container_class is not None else ""
+            return [ str(src) for src in _compile(f"{path}/descendant::img[starts-with(@src, $prefix)]/@src")(self.tree, prefix=prefix) ]
+        containers = self.tree.find_all("div", {"class": container_class}) if container_class is not None else [self.tree]
+        return [ img["src"] for container in containers for img in container.find_all("img", src=True) if img["src"].startswith(prefix) ]
+
+
+def _json_unescape(string : str) -> str:
+    try:
+        return json.loads(f'"{string}"')
+    except ValueError:
+        return string
+
+def extract_google_image_urls(source_html : str) -> List[str]:
+    """Returns the full resolution image urls embedded in a Google Images page source,
+    in page order and without duplicates or Google's thumbnails."""
+    image_urls = []
+    seen = set()
+    for match in GOOGLE_IMAGE_PATTERN.finditer(source_html):
+        url = _json_unescape(match.group(1))
+        if url in seen or urlsplit(url).netloc.endswith(GOOGLE_STATIC_DOMAIN):
+            continue
+        seen.add(url)
+        image_urls.append(url)
+    return image_urls
+
+def pinterest_original_url(thumbnail_url : str) -> str:
+    """Returns the original image url of a Pinterest 236x thumbnail url."""
+    return rewrite_url(thumbnail_url)
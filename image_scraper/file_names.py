@@ -0,0 +1,62 @@
+import os
+import re
+import threading
+
+from typing import Callable, Dict, Set, Tuple
+
+class FileNameIndex:
+    """Hands out unique file names in a directory.
+
+    The directory is listed once when the index is created, recording the highest copy number
+    `name(N).ext` of each name. Names handed out are reserved immediately, so concurrent
+    downloads never get the same name, and a new copy never rescans the existing ones. Other
+    processes saving to the directory are not seen by the index, so files are placed with
+    claim, which moves on to the next name when the file turns out to exist.
+    """
+
+    COPY_PATTERN = re.compile(r"^(.*)\((\d+)\)$")
+
+    def __init__(self, directory : str):
+        self._directory : str = directory
+        self._lock = threading.Lock()
+        self._taken : Set[str] = set(os.listdir(directory)) if os.path.isdir(directory) else set()
+        self._next_copy : Dict[Tuple[str, str], int] = {}
+        for file_name in self._taken:
+            base, ext, copy = self._split(file_name)
+            if copy >= self._next_copy.get((base, ext), 1):
+                self._next_copy[(base, ext)] = copy + 1
+
+    def _split(self, file_name : str) -> Tuple[str, str, int]:
+        """Splits `name(N).ext` into the name, extension and copy number."""
+        name, ext = os.path.splitext(file_name)
+        copy_match = self.COPY_PATTERN.match(name)
+        if copy_match is None:
+            return name, ext, 0
+        return copy_match.group(1), ext, int(copy_match.group(2))
+
+    def allocate(self, file_name : str) -> str:
+        """Reserves a free name based on file_name and returns its full path."""
+        with self._lock:
+            if file_name not in self._taken:
+                self._taken.add(file_name)
+                return os.path.join(self._directory, file_name)
+            base, ext, _ = self._split(file_name)
+            copy = self._next_copy.get((base, ext), 1)
+            while f"{base}({copy}){ext}" in self._taken:
+                copy += 1
+            file_name = f"{base}({copy}){ext}"
+            self._taken.add(file_name)
+            self._next_copy[(base, ext)] = copy + 1
+            return os.path.join(self._directory, file_name)
+
+    def claim(self, file_name : str, place : Callable[[str], None]) -> str:
+        """Allocates a name based on file_name and calls place with its full path, which must
+        raise FileExistsError instead of replacing an existing file. Returns the path placed."""
+        while True:
+            full_file_path = self.allocate(file_name)
+            try:
+                place(full_file_path)
+                return full_file_path
+            except FileExistsError:
+                # Taken by another process since the directory was listed
+                continue
@@ -1,118 +1,811 @@
-import concurrent.futures
+import functools
+import hashlib
 import os
 import re
-import requests
-import sys
+import secrets
+import threading
+import time
 
-from http.client import responses
+from collections import Counter
+from concurrent.futures import Future
+from http import HTTPStatus
 from pathlib import Path
 from tqdm import tqdm
-from typing import Dict, List
-from urllib3.exceptions import InsecureRequestWarning
-requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+from typing import TYPE_CHECKING, AsyncIterator, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
 
 from config import Config
-from utils import timer
+from canonical import canonicalize_url, rewrite_url
+from concurrency import AdaptiveConcurrency
+from dedup import DedupIndex
+from file_names import FileNameIndex
+from manifest import RunManifest
+from metrics import METRICS
+from prefilter import DIMENSIONS, MIME_TYPE, PENDING, ImageFilter, ImageRejected
+from rate_limit import HostRateLimiter
+from retry import CIRCUIT_OPEN, CONNECTION, TIMEOUT, HostCircuitBreakers, Retry, RetryPolicy, RetryScheduler, classify_status, get_host
+from seen_urls import SeenUrls
+from shards import ShardWriter
+from utils import tabulate, timer
+from work_queue import LEASED, QUEUED, WorkItem, WorkQueue
+from writer import OFF, shared_writer_pool
+
+if TYPE_CHECKING:
+    import requests
+    from url_stream import UrlStream
+
+PARTIAL_CONTENT = 206
+ALREADY_REPORTED = 208
+NOT_MODIFIED = 304
+BAD_REQUEST = 400
+REQUEST_TIMEOUT = 408
+PRECONDITION_FAILED = 412 # Reported for images below the prefilter's min_width or min_height
+PAYLOAD_TOO_LARGE = 413
+UNSUPPORTED_MEDIA_TYPE = 415
+RANGE_NOT_SATISFIABLE = 416
+SERVICE_UNAVAILABLE = 503 # Also reported for connection failures
+INSUFFICIENT_STORAGE = 507
+
+# Statuses of urls whose image is in the save_path, added to the seen urls
+SAVED_STATUSES = [200, PARTIAL_CONTENT, NOT_MODIFIED, ALREADY_REPORTED]
+
+# Statuses of the images rejected by the prefilter
+PREFILTER_STATUS = {
+    MIME_TYPE: UNSUPPORTED_MEDIA_TYPE,
+    DIMENSIONS: PRECONDITION_FAILED,
+}
+
+@functools.lru_cache(maxsize=None)
+def import_requests():
+    """Imports requests on the first request, since it takes longer to import than the rest of
+    the downloader and the async engine does not use it. Images are fetched without verifying
+    certificates, so the warnings about it are turned off."""
+    import requests
+    from urllib3.exceptions import InsecureRequestWarning
+    requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+    return requests
+
+class BodyTooLarge(Exception):
+    """Raised when an image body exceeds the configured max_body_size."""
+    pass
+
+
+class PartFile:
+    """A temporary file that image chunks are streamed into before being moved to the final path.
+    Passing resume_path appends to the partial file of an interrupted download, and passing an
+    image_filter screens the first bytes of a new body of the declared content_type. The first
+    spool_size bytes of a new body are kept in memory, so the file is only created once the
+    body outgrows them, or when it is committed or kept to resume from."""
+    
+    def __init__(self, directory : str, max_body_size : int = None, resume_path : str = None, image_filter : ImageFilter = None,
+                 spool_size : int = 0, content_type : str = None):
+        self._max_body_size = max_body_size
+        self._image_filter = image_filter if resume_path is None else None
+        self._content_type : Optional[str] = content_type
+        self._prefix : bytes = b"" # First bytes kept until the image filter has decided
+        self._sha256 = hashlib.sha256()
+        self._spool_size : int = spool_size
+        self._chunks : List[bytes] = [] # Chunks not written to the file yet
+        self.size : int = 0
+        self.committed : bool = False
+        self.resumable : bool = False # Kept on disk when released before commit
+        self._file = None
+        if resume_path is None:
+            self.path : str = os.path.join(directory, f".{secrets.token_hex(8)}.part")
+        else:
+            with open(resume_path, 'rb') as part_file:
+                for chunk in iter(lambda: part_file.read(1024 * 1024), b''):
+                    self._sha256.update(chunk)
+                    self.size += len(chunk)
+            self._file = open(resume_path, 'ab')
+            self.path = resume_path
+    
+    def write(self, chunk : bytes) -> None:
+        """Writes a chunk, aborting once the body grows past max_body_size."""
+        if self.buffer(chunk):
+            self.spill()
+    
+    def buffer(self, chunk : bytes) -> bool:
+        """Keeps a chunk in memory, aborting once the body grows past max_body_size. Returns
+        whether the chunks kept have to be spilled to the file, unlike write it never touches
+        the disk."""
+        self.size += len(chunk)
+        if self._max_body_size and self.size > self._max_body_size:
+            self.resumable = False
+            raise BodyTooLarge(f"Body exceeds {self._max_body_size} bytes.")
+        if self._image_filter is not None:
+            self._screen(chunk)
+        self._sha256.update(chunk)
+        self._chunks.append(chunk)
+        return self._file is not None or self.size > self._spool_size
+    
+    def spill(self) -> None:
+        """Creates the file if needed and writes the chunks kept in memory."""
+        if self._file is None:
+            Path(os.path.dirname(self.path)).mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, 'xb')
+        for chunk in self._chunks:
+            self._file.write(chunk)
+        self._chunks = []
+    
+    def _screen(self, chunk : bytes, complete : bool = False) -> None:
+        """Raises ImageRejected once the first bytes fail the image filter."""
+        self._prefix += chunk
+        reason = self._image_filter.check_prefix(self._prefix, complete, self._content_type)
+        if reason == PENDING:
+            return
+        self._image_filter = None
+        self._prefix = b""
+        if reason is not None:
+            self.resumable = False
+            raise ImageRejected(reason)
+    
+    def finish(self) -> None:
+        """Screens a body that ended before the image filter could decide."""
+        if self._image_filter is not None:
+            self._screen(b"", complete=True)
+    
+    def hexdigest(self) -> str:
+        """Returns the sha256 digest of the chunks written so far."""
+        return self._sha256.hexdigest()
+    
+    def spooled_body(self) -> Optional[bytes]:
+        """Returns the body if it is all kept in memory, or None once it has a file."""
+        return b"".join(self._chunks) if self._file is None else None
+    
+    def close(self, fsync : bool = False) -> None:
+        """Writes the file and closes it, keeping it on disk to be read."""
+        self.spill()
+        if fsync:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._file.close()
+    
+    def commit(self, full_file_path : str, fsync : bool = False) -> str:
+        """Closes the file, flushing it to the disk first if fsync is set, and moves it to its
+        final path. Raises FileExistsError, keeping the file, if the final path exists."""
+        if self._file is None or not self._file.closed:
+            self.close(fsync)
+        # Creating the final file claims its name, which os.replace alone would overwrite
+        open(full_file_path, 'xb').close()
+        os.replace(self.path, full_file_path)
+        self.committed = True
+        return full_file_path
+    
+    def discard(self) -> None:
+        """Closes and removes the file unless it has been committed."""
+        if self.committed:
+            return
+        self._chunks = []
+        self.resumable = False
+        if self._file is not None:
+            self._file.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+    
+    def release(self) -> None:
+        """Closes the file, keeping it for a Range request if resumable and removing it otherwise."""
+        if self.committed:
+            return
+        if self.resumable:
+            self.close()
+        else:
+            self.discard()
+
 
 class ImagesDownloader(Config):
     
     # Image config params
     # self.save_path
+    # self.concurrency
+    # self.adaptive_concurrency
+    # self.max_in_flight
+    # self.max_per_host
+    # self.max_body_size
+    # self.chunk_size
+    # self.dedup
+    # self.resume
+    # self.revalidate
+    # self.timeout
+    # self.retry_timeout
+    # self.retry
+    # self.circuit_breaker
+    # self.seen_urls
+    # self.prefilter
+    # self.near_dedup
+    # self.shards
+    # self.stream
+    # self.writer
     
-    def __init__(self, config : Dict, image_urls : List[str] = None, image_name : str = None, subfolder : str = None):
+    concurrency = 10 # Download threads, or "auto" to adapt the requests in flight to the hosts
+    adaptive_concurrency = {}
+    max_in_flight = 100
+    max_per_host = 10
+    max_body_size = 50 * 1024 * 1024
+    chunk_size = 64 * 1024
+    dedup = "skip"
+    resume = True
+    revalidate = False
+    timeout = 10
+    retry_timeout = 20
+    retry = {}
+    circuit_breaker = {}
+    seen_urls = {}
+    prefilter = {}
+    near_dedup = {}
+    shards = {}
+    stream = {}
+    writer = {}
+    
+    DEDUP_MODES = ["off", "skip", "link"]
+    NEAR_DEDUP_ACTIONS = ["off", "report", "quarantine", "skip"]
+    
+    def __init__(self, config : Dict, image_urls : List[str] = None, image_name : str = None, subfolder : str = None,
+                 rate_limiter : HostRateLimiter = None, shared : "ImagesDownloader" = None):
+        """Passing shared, a downloader of the same save_path and config, e.g. of another query
+        in a batch, reuses its indexes of the save_path instead of opening them again."""
         super().__init__(config)
+        self.rate_limiter = rate_limiter
         self.image_names = image_name
         self.queue = image_urls
-        self.save_path = os.path.join(self.save_path, subfolder.replace(' ','_')) if subfolder is not None else None
+        if self.concurrency != "auto" and not (isinstance(self.concurrency, int) and self.concurrency > 0):
+            raise ValueError("concurrency: must be 'auto' or a number of download threads.")
+        self.adaptive = AdaptiveConcurrency(self.max_in_flight, self.max_per_host, **self.adaptive_concurrency) if self.concurrency == "auto" else None
+        if self.dedup not in self.DEDUP_MODES:
+            raise ValueError("dedup: must be one of %r." % self.DEDUP_MODES)
+        if self.near_dedup.get("action", "off") not in self.NEAR_DEDUP_ACTIONS:
+            raise ValueError("near_dedup action: must be one of %r." % self.NEAR_DEDUP_ACTIONS)
+        if shared is not None:
+            self.dedup_index, self.near_dup_index, self.seen_index = shared.dedup_index, shared.near_dup_index, shared.seen_index
+            self._accepted, self._accepted_lock = shared._accepted, shared._accepted_lock
+        else:
+            self.dedup_index = DedupIndex(self.save_path) if self.dedup != "off" else None
+            self.near_dup_index = None
+            if self.near_dedup.get("action", "off") != "off":
+                # Imports numpy and Pillow only when near-duplicates are looked for
+                from near_dups import NearDuplicateIndex
+                self.near_dup_index = NearDuplicateIndex(self.save_path)
+            seen_config = { key : value for key, value in self.seen_urls.items() if key != "enabled" }
+            self.seen_index = SeenUrls(self.save_path, **seen_config) if self.seen_urls.get("enabled", False) and not self.revalidate else None
+            self._accepted : Set[str] = set() # Canonical urls accepted in this run and not saved yet
+            self._accepted_lock = threading.Lock()
+        prefilter_config = { key : value for key, value in self.prefilter.items() if key != "enabled" }
+        self.image_filter = ImageFilter(**prefilter_config) if self.prefilter.get("enabled", False) else None
+        if self.image_filter is not None and self.image_filter.max_bytes:
+            self.max_body_size = min(self.max_body_size or self.image_filter.max_bytes, self.image_filter.max_bytes)
+        self.save_path = os.path.join(self.save_path, subfolder.replace(' ','_')) if subfolder is not None else self.save_path
+        self.manifest = RunManifest(self.save_path) if self.resume else None
+        shard_config = { key : value for key, value in self.shards.items() if key != "enabled" }
+        self.shard_writer = ShardWriter(self.save_path, **shard_config) if self.shards.get("enabled", False) else None
+        writer_config = { key : value for key, value in self.writer.items() if key != "spool_size" }
+        self.writer_pool = shared_writer_pool(**writer_config)
+        self.retry_policy = RetryPolicy(**self.retry)
+        self.circuit_breakers = HostCircuitBreakers(**self.circuit_breaker)
+        self._file_names : FileNameIndex = None
+        self._file_names_lock = threading.Lock()
     
-    # TODO: Extensive testing
-    def get_full_file_path(self, image_url : str, r : requests.models.Response) -> str:
-        """Finds or creates an adequate image filename and returns the full file path for the image."""
+    def failed_status(self, image_url : str, status : int, headers) -> Tuple[int, Optional[str]]:
+        """Returns the status and error class of a failed response, slowing down the rate
+        limit of the host when it asks to."""
+        error = classify_status(status)
+        if self.rate_limiter is not None and status in [429, 503]:
+            self.rate_limiter.throttle(image_url, headers.get('Retry-After'))
+        return status, error
+    
+    def content_length_exceeded(self, headers) -> bool:
+        """Checks the Content-Length header against max_body_size before the body is read."""
+        length = headers.get('Content-Length')
+        if not self.max_body_size or length is None or not length.isdigit():
+            return False
+        return int(length) > self.max_body_size
+    
+    def prefilter_status(self, headers) -> Optional[int]:
+        """Returns the status of a response rejected by the prefilter from its headers, or None."""
+        if self.content_length_exceeded(headers):
+            return PAYLOAD_TOO_LARGE
+        reason = self.image_filter.check_content_type(headers.get('Content-Type')) if self.image_filter is not None else None
+        return self.rejected_status(reason) if reason is not None else None
+    
+    def rejected_status(self, reason : str) -> int:
+        METRICS.inc("prefilter_rejected_total", reason=reason)
+        return PREFILTER_STATUS[reason]
+    
+    def accept_url(self, image_url : str) -> Optional[str]:
+        """Returns the url to download for a url, or None if a variant of it was saved to the
+        save_path by a previous run or was already handed to the downloaders in this run."""
+        image_url = rewrite_url(image_url)
+        if self.seen_index is None:
+            return image_url
+        key = canonicalize_url(image_url)
+        with self._accepted_lock:
+            if key in self._accepted or key in self.seen_index:
+                return None
+            self._accepted.add(key)
+        return image_url
+    
+    def record_result(self, image_url : str, status : int) -> None:
+        """Adds the urls whose image was saved to the seen urls. Failed urls are only remembered
+        for this run, so later runs try them again."""
+        if self.seen_index is not None and status in SAVED_STATUSES:
+            key = canonicalize_url(image_url)
+            self.seen_index.add(key)
+            with self._accepted_lock:
+                self._accepted.discard(key)
+    
+    def is_downloaded(self, image_url : str) -> bool:
+        """Checks whether the url was saved in a previous run and does not need revalidating."""
+        if self.revalidate:
+            return False
+        if self.manifest is not None and self.manifest.is_complete(image_url):
+            return True
+        if self.shard_writer is not None and self.shard_writer.index.lookup(image_url) is not None:
+            return True
+        return self.dedup_index is not None and self.dedup_index.lookup_url(image_url) is not None
+    
+    def request_headers(self, image_url : str) -> Dict[str, str]:
+        """Returns conditional headers for a completed url or Range headers for a partial one."""
+        entry = self.manifest.get(image_url) if self.manifest is not None else None
+        if entry is None:
+            return {}
+        if entry.complete:
+            headers = {}
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+            return headers
+        validator = entry.etag or entry.last_modified
+        if validator and entry.part_path and os.path.isfile(entry.part_path):
+            return {'Range': f"bytes={os.path.getsize(entry.part_path)}-", 'If-Range': validator}
+        return {}
+    
+    def range_rejected(self, image_url : str, request_headers : Dict[str, str], status : int, headers) -> bool:
+        """Checks whether the server rejected the Range request of a partial file, or answered it
+        from another offset. The partial file and its manifest entry are then removed, so the
+        next request fetches the whole image instead of sending the same Range again."""
+        if 'Range' not in request_headers:
+            return False
+        # Range is "bytes=<size>-" and a matching Content-Range "bytes <size>-<end>/<length>"
+        offset = request_headers['Range'][len("bytes="):]
+        if status != RANGE_NOT_SATISFIABLE and (status != PARTIAL_CONTENT or headers.get('Content-Range', '').startswith(f"bytes {offset}")):
+            return False
+        entry = self.manifest.get(image_url)
+        if entry is not None and entry.part_path and os.path.isfile(entry.part_path):
+            os.remove(entry.part_path)
+        self.manifest.remove(image_url)
+        return True
+    
+    def open_part_file(self, image_url : str, status : int, headers) -> PartFile:
+        """Opens the part file to stream a response into, appending to the partial file of an
+        interrupted download if the server honoured the Range request."""
+        entry = self.manifest.get(image_url) if self.manifest is not None else None
+        part_path = entry.part_path if entry is not None and entry.part_path and os.path.isfile(entry.part_path) else None
+        if status == PARTIAL_CONTENT and part_path is not None:
+            part_file = PartFile(self.save_path, self.max_body_size, resume_path=part_path)
+        else:
+            if part_path is not None:
+                os.remove(part_path)
+            part_file = PartFile(self.save_path, self.max_body_size, image_filter=self.image_filter, spool_size=self.writer.get("spool_size", 0),
+                                 content_type=headers.get('Content-Type'))
+        etag, last_modified = headers.get('ETag'), headers.get('Last-Modified')
+        if self.manifest is not None and (etag or last_modified) and headers.get('Accept-Ranges') == 'bytes':
+            part_file.resumable = True
+            self.manifest.start(image_url, part_file.path, etag=etag, last_modified=last_modified)
+        return part_file
+    
+    def _record_complete(self, image_url : str, full_file_path : str, headers) -> None:
+        if self.manifest is not None:
+            self.manifest.complete(image_url, full_file_path, etag=headers.get('ETag'), last_modified=headers.get('Last-Modified'))
+    
+    def commit_part_file(self, image_url : str, r, part_file : PartFile) -> str:
+        """Moves a part file to its image file, or appends it to the current shard when shards
+        are enabled. Returns the path of the file holding the image."""
+        if self.shard_writer is None:
+            fsync = self.writer_pool.fsync != OFF
+            full_file_path = self.file_names.claim(self.get_file_name(image_url, r), lambda path: part_file.commit(path, fsync=fsync))
+            self.writer_pool.renamed(os.path.dirname(full_file_path))
+            return full_file_path
+        extension = os.path.splitext(self.get_file_name(image_url, r))[1].lower()
+        # A body kept in memory is appended as it is, without a temporary file
+        image = part_file.spooled_body()
+        if image is None:
+            part_file.close()
+            image = part_file.path
+        shard_path = self.shard_writer.add(image_url, image, part_file.hexdigest(), extension, fsync=self.writer_pool.fsync != OFF)
+        part_file.discard()
+        return shard_path
+    
+    def write_part_file(self, image_url : str, status : int, r, part_file : PartFile) -> int:
+        """Saves a fetched image on the writer pool. Returns the response status, or the status
+        of a duplicate, rejected or unwritable image."""
+        try:
+            return status if self.save_part_file(image_url, r, part_file) else ALREADY_REPORTED
+        except ImageRejected as e:
+            return self.rejected_status(e.reason)
+        except OSError as e:
+            print(e)
+            return INSUFFICIENT_STORAGE
+        except Exception as e:
+            print(f"Unexpected exception saving {image_url}: {e!r}")
+            return 500
+        finally:
+            part_file.release()
+    
+    def save_part_file(self, image_url : str, r, part_file : PartFile) -> bool:
+        """Moves a completely streamed image into place, skipping or linking duplicate content.
+        Returns False if the content was already saved."""
+        part_file.finish()
+        if self.dedup_index is None:
+            full_file_path = self.commit_part_file(image_url, r, part_file)
+            self._record_complete(image_url, full_file_path, r.headers)
+            return True
+        sha256 = part_file.hexdigest()
+        existing_path = self.dedup_index.lookup_hash(sha256)
+        if existing_path is None:
+            full_file_path = self.commit_part_file(image_url, r, part_file)
+            self.dedup_index.add(sha256, full_file_path, url=image_url)
+            self._record_complete(image_url, full_file_path, r.headers)
+            return True
+        part_file.discard()
+        if self.shard_writer is not None:
+            # Shards hold the content once and point the duplicate url at it
+            self.shard_writer.add_url(image_url, sha256)
+        elif self.dedup == "link":
+            try:
+                target_path = existing_path
+                existing_path = self.file_names.claim(self.get_file_name(image_url, r), lambda path: os.link(target_path, path))
+            except OSError as e:
+                print(e)
+        self.dedup_index.add_url(sha256, image_url)
+        self._record_complete(image_url, existing_path, r.headers)
+        return False
+    
+    @property
+    def file_names(self) -> FileNameIndex:
+        """The file name index of save_path, built on first use."""
+        with self._file_names_lock:
+            if self._file_names is None:
+                self._file_names = FileNameIndex(self.save_path)
+            return self._file_names
+    
+    def get_file_name(self, image_url : str, r : "requests.Response") -> str:
+        """Returns the file name of the url, with the extension of its Content-Type if it has none."""
         file_name = re.search("[^/\\&\?]+\.\w{3,4}(?=([\?&].*$|$))", image_url)
         if file_name is not None:
-            file_name = file_name.group(0)
+            return file_name.group(0)
+        image_type = r.headers['Content-Type'].split('/')[1]
+        return image_url.split('/')[-1].split('?')[0] + "." + image_type
+    
+    def get_full_file_path(self, image_url : str, r : "requests.Response") -> str:
+        """Finds or creates an adequate image filename and returns the full file path for the image."""
+        return self.file_names.allocate(self.get_file_name(image_url, r))
+    
+    def download_attempt(self, image_url : str, attempt : int = 0) -> Tuple[Union[int, Future], Optional[str]]:
+        """Makes one attempt at fetching the image and hands the body to the writer pool. Returns
+        the response status, or the future of the status of a body being written, and the error
+        class of a retryable failure."""
+        timing = {}
+        start = time.monotonic()
+        METRICS.add("downloads_in_flight", 1)
+        try:
+            status, error = self._download_attempt(image_url, attempt, timing)
+        finally:
+            METRICS.add("downloads_in_flight", -1)
+        timing["total"] = time.monotonic() - start
+        self.record_fetch(image_url, attempt, status, error, timing)
+        return status, error
+    
+    def record_fetch(self, image_url : str, attempt : int, status : Union[int, Future], error : Optional[str], timing : Dict) -> None:
+        """Records an attempt, once its body is written if it was handed to the writer pool."""
+        if isinstance(status, Future):
+            status.add_done_callback(lambda write: self.record_attempt(image_url, attempt, write.result(), error, timing))
         else:
-            image_type = r.headers['Content-Type'].split('/')[1]
-            file_name = image_url.split('/')[-1].split('?')[0] + "." + image_type
-        full_file_path = os.path.join(self.save_path, file_name)
-        # Detects and handles duplicate image filenames
-        while(os.path.isfile(full_file_path)):
-            name, ext = os.path.splitext(os.path.basename(full_file_path))
-            copyval = re.search(r"\((.*)\)", name)
-            if copyval is None:
-                file_name = name + "(1)" + ext
-            else: 
-                copyval = int(copyval.group(1))+1
-                file_name = re.sub(r"\((.*)\)", r"(%d)" % copyval, name) + ext
-            full_file_path = os.path.join(self.save_path, file_name)
-        return full_file_path
+            self.record_attempt(image_url, attempt, status, error, timing)
     
-    def download_image(self, image_url, timeout=10, file_name=None) -> int:
-        """Requests and downloads the image."""
+    def record_attempt(self, image_url : str, attempt : int, status : int, error : Optional[str], timing : Dict) -> None:
+        """Records the metrics and trace of a download attempt. Timings are in seconds: time to
+        first byte from the start of the request, body from the first byte and total for the
+        whole attempt, with dns and connect where the engine reports them."""
+        METRICS.inc("download_attempts_total", status=status)
+        if error is not None:
+            METRICS.inc("download_errors_total", error=error)
+        for phase in ["dns", "connect", "ttfb", "body", "total"]:
+            if phase in timing:
+                METRICS.observe(f"download_{phase}_seconds", timing[phase])
+        if timing.get("bytes"):
+            METRICS.inc("download_bytes_total", timing["bytes"])
+        METRICS.trace(url=image_url, host=get_host(image_url), attempt=attempt, status=status, error=error,
+                      **{ phase : round(value, 6) if isinstance(value, float) else value for phase, value in timing.items() })
+    
+    def _download_attempt(self, image_url : str, attempt : int, timing : Dict) -> Tuple[int, Optional[str]]:
+        requests = import_requests()
+        if self.is_downloaded(image_url):
+            return ALREADY_REPORTED, None
+        timeout = self.timeout if attempt == 0 else self.retry_timeout
+        start = time.monotonic()
+        request_headers = self.request_headers(image_url)
         try:
-            r = requests.get(image_url, timeout=timeout, verify=False)
-        except requests.exceptions.ReadTimeout:
-            if timeout < 20:
-                return self.download_image(image_url=image_url, timeout=20, file_name=file_name)
-            else:
-                return 418
-        except Exception as e:
-            print(f"Fatal exception at {image_url}.")
-            err = sys.exc_info()[0]
-            err_str = err.__name__
-            print(e)
-            print(err)
-            print(err_str)
-            sys.exit(1)
+            r = requests.get(image_url, headers=request_headers, timeout=timeout, verify=False, stream=True)
+            timing["ttfb"] = time.monotonic() - start
+        except requests.exceptions.Timeout:
+            return REQUEST_TIMEOUT, TIMEOUT
+        except requests.exceptions.ConnectionError:
+            return SERVICE_UNAVAILABLE, CONNECTION
+        except requests.exceptions.RequestException as e:
+            print(f"Request failed at {image_url}: {e}")
+            return BAD_REQUEST, None
         
-        try:
-            r.raise_for_status()
-            image_bytes = r.content
-            Path(self.save_path).mkdir(parents=True, exist_ok=True)
-            full_file_path = self.get_full_file_path(image_url, r)
-            try: 
-                with open(full_file_path, 'wb') as image_file:
-                    image_file.write(image_bytes)
-            except Exception as e:
+        if self.range_rejected(image_url, request_headers, r.status_code, r.headers):
+            r.close()
+            # The partial file is gone, so this request has no Range
+            return self._download_attempt(image_url, attempt, timing)
+        with r:
+            if r.status_code >= 400:
+                return self.failed_status(image_url, r.status_code, r.headers)
+            if r.status_code == NOT_MODIFIED:
+                return NOT_MODIFIED, None
+            status = self.prefilter_status(r.headers)
+            if status is not None:
+                return status, None
+            try:
+                part_file = self.open_part_file(image_url, r.status_code, r.headers)
+                try:
+                    body_start = time.monotonic()
+                    for chunk in r.iter_content(chunk_size=self.chunk_size):
+                        timing["bytes"] = timing.get("bytes", 0) + len(chunk)
+                        part_file.write(chunk)
+                    timing["body"] = time.monotonic() - body_start
+                except BaseException:
+                    part_file.release()
+                    raise
+            except BodyTooLarge:
+                return PAYLOAD_TOO_LARGE, None
+            except ImageRejected as e:
+                return self.rejected_status(e.reason), None
+            except requests.exceptions.Timeout:
+                return REQUEST_TIMEOUT, TIMEOUT
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                return SERVICE_UNAVAILABLE, CONNECTION
+            except OSError as e:
                 print(e)
-        # TODO: Exception log during debug
-        except requests.exceptions.HTTPError as e:
-            # print(e)
-            pass
-        except requests.exceptions.ConnectionError as e:
-            # print(e)
-            pass
-        except requests.exceptions.Timeout as e:
-            # print(e)
-            pass
-        except requests.exceptions.RequestException as e:
-            print(e)
-            pass
-        finally:
-            return r.status_code
-
+                return INSUFFICIENT_STORAGE, None
+        # The response is closed before waiting for a free writer
+        return self.writer_pool.submit(self.write_part_file, image_url, r.status_code, r, part_file), None
+    
+    def download_image(self, image_url : str) -> int:
+        """Downloads the image, retrying failures with backoff."""
+        retry = Retry(image_url)
+        while True:
+            wait = self.circuit_breakers.wait_time(retry.host)
+            if wait > 0:
+                if self.retry_policy.backoff(CIRCUIT_OPEN, retry) is None:
+                    return SERVICE_UNAVAILABLE
+                time.sleep(wait)
+                continue
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(image_url)
+            status, error = self.download_attempt(image_url, retry.attempt)
+            if isinstance(status, Future):
+                status = status.result()
+            self.circuit_breakers.record(retry.host, error)
+            delay = self.retry_policy.backoff(error, retry) if error is not None else None
+            if delay is None:
+                return status
+            retry.attempt += 1
+            time.sleep(delay)
 
     def download_queue(self, image_urls) -> None:
         """Creates threads to execute the image download."""
         print("> Downloading images in queue...")
         if image_urls is None or len(image_urls) == 0:
             raise Exception("Error: [ImageDownloader] image_urls queue is empty. ")
-        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-            status_codes = list(tqdm(executor.map(self.download_image, image_urls), total=len(image_urls)))
+        status_codes = []
+        with tqdm(total=len(image_urls)) as progress:
+            with self._create_scheduler(status_codes, progress) as scheduler:
+                for image_url in image_urls:
+                    self._submit(scheduler, image_url, status_codes, progress)
         # TODO: If logging then create a csv
+        self.writer_pool.flush()
         print("> Executor complete")
-        unique = list(set(status_codes))
-        results = { responses[code] : status_codes.count(code) for code in unique }
+        self.remove_near_duplicates()
+        self.print_summary(status_codes)
+    
+    async def download_stream(self, image_urls : AsyncIterator[str]) -> None:
+        """Downloads urls as they are yielded, so downloads run while the search is still going."""
+        print("> Downloading images as they are found...")
+        status_codes = []
+        with tqdm() as progress:
+            with self._create_scheduler(status_codes, progress) as scheduler:
+                async for image_url in image_urls:
+                    self._submit(scheduler, image_url, status_codes, progress)
+        self.writer_pool.flush()
+        print("> Executor complete")
+        self.remove_near_duplicates()
+        self.print_summary(status_codes)
+    
+    def download_work_queue(self, work_queue : WorkQueue, worker_id : str, batch_size : int = 100, poll_interval : float = 5) -> None:
+        """Downloads the urls of a work queue shared with other workers, leasing at most batch_size
+        urls at a time. Runs until no url is left queued or leased by another worker."""
+        print(f"> Downloading images from the work queue as '{worker_id}'...")
+        status_codes = []
+        # Items of each url in flight, since items whose urls are rewritten to the same url share its download
+        leased : Dict[str, List[WorkItem]] = {}
+        n_leased = 0
+        lock = threading.Lock()
+        slot_freed = threading.Event()
         
-        # TODO: Tabulate function in utils
-        min_width = 8
-        width = max(max(map(len, [responses[code] for code in unique])), min_width)
-        print(f"\n {'STATUS':>{width}} | {'TOTAL IMAGES':<{width}}")
-        print(" {}+{}".format('='*(width+1),'='*(width+1)))
-        for k,v in results.items():
-            print(f" {k:>{width}} | {v:<{width}}")
+        def acknowledge(image_url, status):
+            nonlocal n_leased
+            with lock:
+                items = leased.pop(image_url)
+                n_leased -= len(items)
+            for i, item in enumerate(items):
+                work_queue.ack(worker_id, item, status=status, failed=status >= 400)
+                if i > 0:
+                    status_codes.append(ALREADY_REPORTED)
+                    progress.update()
+            slot_freed.set()
         
-        print(f"\n> Successfully downloaded {results['OK']} images.")
+        try:
+            with tqdm(total=0) as progress:
+                with self._create_scheduler(status_codes, progress, on_result=acknowledge) as scheduler:
+                    last_heartbeat = time.monotonic()
+                    while True:
+                        with lock:
+                            n_free = batch_size - n_leased
+                        items = work_queue.lease(worker_id, n_free) if n_free > 0 else []
+                        progress.total += len(items)
+                        progress.refresh()
+                        for item in items:
+                            image_url = self.accept_url(item.value)
+                            if image_url is None:
+                                work_queue.ack(worker_id, item, status=ALREADY_REPORTED)
+                                status_codes.append(ALREADY_REPORTED)
+                                progress.update()
+                                continue
+                            with lock:
+                                in_flight = image_url in leased
+                                leased.setdefault(image_url, []).append(item)
+                                n_leased += 1
+                            if not in_flight:
+                                scheduler.submit(image_url)
+                        with lock:
+                            idle = n_leased == 0
+                        if idle:
+                            counts = work_queue.counts()
+                            if counts.get(QUEUED, 0) == 0 and counts.get(LEASED, 0) == 0:
+                                break
+                        if len(items) == 0:
+                            # Waits for a free slot, or for leases of other workers to expire
+                            slot_freed.wait(poll_interval)
+                            slot_freed.clear()
+                        if time.monotonic() - last_heartbeat > poll_interval:
+                            work_queue.heartbeat(worker_id)
+                            last_heartbeat = time.monotonic()
+        finally:
+            work_queue.release(worker_id)
+        self.writer_pool.flush()
+        print("> Executor complete")
+        # Near-duplicates are left to the dedup command, since other workers share the save_path
+        self.print_summary(status_codes)
+    
+    def create_url_stream(self, file_name : str) -> "UrlStream":
+        """Opens a url file to stream, resuming from the checkpoint of a previous run on it."""
+        # Imports validators only when a url file is read
+        from url_stream import UrlStream
+        checkpoint_path = os.path.join(self.save_path, "." + os.path.basename(file_name) + ".checkpoint.json")
+        url_stream = UrlStream(file_name, checkpoint_path=checkpoint_path, checkpoint_interval=self.stream.get("checkpoint_interval", 10))
+        if url_stream.start_offset > 0:
+            print(f"> Resuming {file_name} from byte {url_stream.start_offset}...")
+        return url_stream
+    
+    def download_file(self, file_name : str) -> None:
+        """Downloads the urls of a file as they are read, with at most stream.window urls
+        pending at a time, so memory stays constant whatever the size of the file."""
+        print(f"> Streaming images from {file_name}...")
+        url_stream = self.create_url_stream(file_name)
+        try:
+            with tqdm(initial=sum(url_stream.counts.values())) as progress:
+                with self._create_scheduler(None, progress, on_result=url_stream.finish, max_pending=self.stream.get("window", 1000)) as scheduler:
+                    for offset, url in url_stream:
+                        image_url = self.accept_url(url)
+                        url_stream.start(image_url or url, offset)
+                        if image_url is None:
+                            METRICS.inc("download_results_total", status=ALREADY_REPORTED)
+                            url_stream.finish(url, ALREADY_REPORTED)
+                            progress.update()
+                        else:
+                            scheduler.submit(image_url)
+        except BaseException:
+            # Saves how far an interrupted run got
+            url_stream.checkpoint()
+            raise
+        url_stream.complete()
+        self.writer_pool.flush()
+        print("> Executor complete")
+        self.remove_near_duplicates()
+        if url_stream.n_invalid > 0:
+            print(f"> Skipped {url_stream.n_invalid} invalid lines.")
+        self.print_summary(url_stream.counts)
+    
+    def _create_scheduler(self, status_codes : Optional[List[int]], progress : tqdm, on_result : Callable[[str, int], None] = None,
+                          max_pending : int = None) -> RetryScheduler:
+        """Creates a scheduler that collects the status codes of finished downloads."""
+        def collect_result(image_url, status):
+            self.record_result(image_url, status)
+            METRICS.inc("download_results_total", status=status)
+            if status_codes is not None:
+                status_codes.append(status)
+            progress.update()
+            if on_result is not None:
+                on_result(image_url, status)
+        return RetryScheduler(self.download_attempt, self.retry_policy, self.circuit_breakers, max_workers=self.concurrency,
+                              on_result=collect_result, limiter=self.rate_limiter, max_pending=max_pending, concurrency=self.adaptive)
+
+    def _submit(self, scheduler : RetryScheduler, image_url : str, status_codes : List[int], progress : tqdm) -> None:
+        """Queues a url on the scheduler, or reports it as already seen."""
+        image_url = self.accept_url(image_url)
+        if image_url is None:
+            METRICS.inc("download_results_total", status=ALREADY_REPORTED)
+            status_codes.append(ALREADY_REPORTED)
+            progress.update()
+        else:
+            scheduler.submit(image_url)
+
+    def remove_near_duplicates(self) -> None:
+        """Hashes the new images of the save_path and reports, quarantines or removes the resized
+        and recompressed copies among all its images, keeping the largest of each group."""
+        if self.near_dup_index is None:
+            return
+        print("> Finding near-duplicate images...")
+        action = self.near_dedup["action"]
+        with METRICS.time("near_dedup_seconds"):
+            n_hashed = self.near_dup_index.update(workers=self.near_dedup.get("workers"))
+            groups = self.near_dup_index.find(max_distance=self.near_dedup.get("max_distance", 3))
+            n_removed = self.near_dup_index.remove_duplicates(groups, action, redirect=self._redirect_duplicate)
+        summary = {"Hashed": n_hashed, "Groups": len(groups), "Duplicates": sum(len(group) - 1 for group in groups)}
+        if action == "report":
+            for group in groups:
+                print(f"  {group[0]} <- {', '.join(group[1:])}")
+        else:
+            summary[action.capitalize()] = n_removed
+        tabulate(summary, headers=("NEAR-DUPLICATES", "TOTAL"))
+    
+    def close(self) -> None:
+        """Closes the manifest and shards of the subfolder, e.g. once a query of a batch is done.
+        The indexes of the save_path are left open for the downloaders sharing them."""
+        if self.manifest is not None:
+            self.manifest.close()
+            self.manifest = None
+        if self.shard_writer is not None:
+            self.shard_writer.close()
+            self.shard_writer.index.close()
+            self.shard_writer = None
+    
+    def _redirect_duplicate(self, full_file_path : str, kept_file_path : str) -> None:
+        """Points the records of a near-duplicate removed by the "skip" action at the image kept
+        in its place, so later runs do not download it again."""
+        if self.dedup_index is not None:
+            self.dedup_index.move(full_file_path, kept_file_path)
+        # The manifest of the subfolder the duplicate was saved to, which is another query's in a batch
+        directory = os.path.dirname(full_file_path)
+        if os.path.isfile(os.path.join(directory, RunManifest.FILE_NAME)):
+            manifest = RunManifest(directory)
+            manifest.move(full_file_path, kept_file_path)
+            manifest.close()
+    
+    def print_summary(self, status_codes : Iterable[int]) -> None:
+        """Prints the number of images per response status, given the statuses or their counts."""
+        results = { HTTPStatus(code).phrase : count for code, count in Counter(status_codes).items() }
+        tabulate(results, headers=("STATUS", "TOTAL IMAGES"))
+        open_hosts = self.circuit_breakers.open_hosts()
+        if len(open_hosts) > 0:
+            tabulate(open_hosts, headers=("OPEN CIRCUIT HOST", "FAILURES"))
+        throttled_hosts = self.rate_limiter.rates() if self.rate_limiter is not None else {}
+        if len(throttled_hosts) > 0:
+            tabulate(throttled_hosts, headers=("THROTTLED HOST", "REQUESTS/S"))
+        if self.adaptive is not None:
+            tabulate(self.adaptive.limits(), headers=("CONCURRENCY", "LIMIT"))
+        print(f"\n> Successfully downloaded {results.get('OK', 0)} images.")
 
         
 def run():
@@ -120,7 +813,7 @@ def run():
     url = "https://i.pinimg.com/originals/bf/82/f6/bf82f6956a32819af48c2572243e8286.jpg"
     
     downloader = ImagesDownloader(save_path=save_path)
-    downloader.download_image(image_url=url, file_name="test1.jpg")
+    downloader.download_image(image_url=url)
 
 if __name__ == "__main__":
     run()
\ No newline at end of file
@@ -1,22 +1,23 @@
 import asyncio
-import os
 import re
-import time
 import urllib
-from bs4 import BeautifulSoup
 
-from typing import Dict, List
+from typing import AsyncIterator, Dict, List
 
-from webdriver import WebDriver
+from extract import PINTEREST_THUMBNAIL_PREFIX, HtmlPage, extract_google_image_urls, pinterest_original_url
+from metrics import METRICS
+from utils import tabulate
+from webdriver import WebDriver, WebDriverPool
 
 class ImageSearch:
     """Base class for image scrapers."""
     
-    def __init__(self, name, query, driver_config : Dict, verbose=False):
+    def __init__(self, name, query, driver_config : Dict, verbose=False, driver_pool : WebDriverPool = None):
         self._name : str = name
         self._query : str = query
         self._verbose : bool = verbose
         self._driver_config : Dict = driver_config
+        self._driver_pool : WebDriverPool = driver_pool
         self._driver : WebDriver = None # Webdriver instance
         self._debug_success : int = 0
         self._debug_fail : int = 0
@@ -25,11 +26,21 @@ class ImageSearch:
         """Returns the full search URL for the search engine."""
         return base_url + urllib.parse.urlencode({'q': self._query}, quote_via=quote_via)
         
-    def initialise_webdriver(self, url) -> None:
-        """Instantiates a WebDriver object."""
-        self._driver = WebDriver(self._driver_config)
-        self._driver.get(url)
-        time.sleep(0.5)
+    async def initialise_webdriver(self, url) -> None:
+        """Instantiates or leases a WebDriver object and loads the url."""
+        if self._driver is None:
+            if self._driver_pool is not None:
+                self._driver = await self._driver_pool.acquire_async(self._driver_config)
+            else:
+                self._driver = WebDriver(self._driver_config)
+        await self._driver.get(url)
+        await asyncio.sleep(0.5)
+    
+    def release_webdriver(self) -> None:
+        """Returns a leased WebDriver to the pool."""
+        if self._driver is not None and self._driver_pool is not None:
+            self._driver_pool.release(self._driver)
+            self._driver = None
 
     def get_details(self):
         deets = {
@@ -45,8 +56,12 @@ class ImageSearch:
 
 class GoogleSearch(ImageSearch):
     
-    def __init__(self, driver_config : Dict, query, url=None, verbose=False):
-        super().__init__(name="Google", query=query, driver_config=driver_config, verbose=verbose)
+    # Thumbnail clicks are used instead of the page source when fewer urls than this ratio of
+    # the detected thumbnails can be extracted from it
+    MIN_EXTRACTED_RATIO = 0.5
+    
+    def __init__(self, driver_config : Dict, query, url=None, verbose=False, driver_pool : WebDriverPool = None):
+        super().__init__(name="Google", query=query, driver_config=driver_config, verbose=verbose, driver_pool=driver_pool)
         self._quote_via = urllib.parse.quote_plus
         self._name : str = "Google"
         self._url : str = self.generate_url() if url is None else url
@@ -56,15 +71,13 @@ class GoogleSearch(ImageSearch):
         base_url = "https://www.google.com/search?tbm=isch&"
         return super().generate_url(base_url, self._quote_via)
     
-    def count_images(self, source_html) -> int:
+    def count_images(self, page : HtmlPage) -> int:
         """Returns count of images."""
-        bs = BeautifulSoup(source_html, 'lxml')
-        image_elements = bs.find_all("div", {"class": "BUooTd"})
-        return len(image_elements)
+        return page.count_class("div", "BUooTd")
     
     async def initialise_source_html(self) -> str:
         """Initialises the class webdriver object and returns the source html."""
-        super().initialise_webdriver(self._url)
+        await super().initialise_webdriver(self._url)
         print(self.format_message(f"Initialising {self._name} web page..."))
         
         await self._driver.scroll_to_bottom()
@@ -78,51 +91,67 @@ class GoogleSearch(ImageSearch):
     
     async def get_search_image_urls(self) -> List[str]:
         """Scrapes Google Search and returns a list of urls for the images."""
+        return [ url async for url in self.iter_search_image_urls() ]
+    
+    async def iter_search_image_urls(self) -> AsyncIterator[str]:
+        """Scrapes Google Search and yields the urls of the images as they are retrieved."""
         print(self.format_message(f"Starting search for images of '{self._query}'..."))
-        super().initialise_webdriver(self._url)
-        
-        source_html = await self.initialise_source_html()
-        n_detected = self.count_images(source_html)
-        
-        print(self.format_message(f"Number of google images detected = {n_detected}"))
+        try:
+            source_html = await self.initialise_source_html()
+            with METRICS.time("parse_seconds", engine=self._name):
+                page = HtmlPage(source_html, parser=self._driver_config.get("parser", "lxml"))
+                n_detected = self.count_images(page)
+                image_urls = extract_google_image_urls(page.source_html) if self._driver_config.get("extraction", "source") == "source" else []
+            print(self.format_message(f"Number of google images detected = {n_detected}"))
+            
+            if len(image_urls) > 0 and len(image_urls) >= n_detected * self.MIN_EXTRACTED_RATIO:
+                for image_url in image_urls:
+                    yield image_url
+                print(self.format_message(f"Image urls retrieval complete. Number of image urls extracted from the page source = {len(image_urls)}"))
+                self._debug_success = len(image_urls)
+                self._debug_fail = max(n_detected - self._debug_success, 0)
+            else:
+                async for image_url in self._iter_clicked_image_urls(n_detected):
+                    yield image_url
+        finally:
+            self.release_webdriver()
+    
+    async def _iter_clicked_image_urls(self, n_detected : int) -> AsyncIterator[str]:
+        """Clicks on the image thumbnails and yields the full resolution urls."""
         # Clicks on images and get full resolution images
         img_xpath = "//*[@id=\"Sva75c\"]/div/div/div[3]/div[2]/c-wiz/div/div[1]/div[1]/div[2]/div[1]/a/img"
         click_class = "BUooTd"
         print(self.format_message(f"Clicking on images and attempting to retrieve urls..."))
-        image_elements, exceptions = await self._driver.click_and_get_elements(click_by="class name",
-                                                              click_condition=click_class,
-                                                              save_xpath=img_xpath,
-                                                              save_attr="src",
-                                                              save_condition_regex="(^https?://)(?!encrypted-tbn0.gstatic.com)",
-                                                              description=self.format_message("Clicking images"))
-
-        image_urls = [ re.search('src="(.*?)"', element).group(1) for element in image_elements if re.search('src="(.*?)"', element) is not None ]
-        
-        unique_err = list(set(exceptions))
-        err_summary = { err_string : exceptions.count(err_string) for err_string in unique_err }
-        min_width = 8
-        width = max(map(len,unique_err))
-        width = max(width, min_width)
-        
-        print(f"\n {'EXCEPTION TYPE':<{width}} | {'TOTAL':<{width}}")
-        print(" {}+{}".format('='*(width+1),'='*(width+1)))
-        for k,v in err_summary.items():
-            print(f" {k:>{width}} | {v:<{width}}")
+        n_retrieved = 0
+        exceptions = []
+        async for element, err_str in self._driver.iter_click_and_get_elements(click_by="class name",
+                                                                              click_condition=click_class,
+                                                                              save_xpath=img_xpath,
+                                                                              save_attr="src",
+                                                                              save_condition_regex="(^https?://)(?!encrypted-tbn0.gstatic.com)",
+                                                                              description=self.format_message("Clicking images")):
+            if err_str is not None:
+                exceptions.append(err_str)
+                continue
+            src = re.search('src="(.*?)"', element)
+            if src is not None:
+                n_retrieved += 1
+                yield src.group(1)
+        
+        err_summary = { err_string : exceptions.count(err_string) for err_string in set(exceptions) }
+        tabulate(err_summary, headers=("EXCEPTION TYPE", "TOTAL"))
         print("")
         
-        print(self.format_message(f"Image urls retrieval complete. Number of image urls successfully retrieved = {len(image_urls)}"))
-        self._debug_success = len(image_urls)
+        print(self.format_message(f"Image urls retrieval complete. Number of image urls successfully retrieved = {n_retrieved}"))
+        self._debug_success = n_retrieved
         self._debug_fail = n_detected - self._debug_success
-
-        return image_urls
         
 
 class PinterestSearch(ImageSearch):
     
-    def __init__(self, driver_config : Dict, query=None, url=None, verbose=False):
-        super().__init__(name="Pinterest", query=query, driver_config=driver_config, verbose=verbose)
+    def __init__(self, driver_config : Dict, query=None, url=None, verbose=False, driver_pool : WebDriverPool = None):
+        super().__init__(name="Pinterest", query=query, driver_config=driver_config, verbose=verbose, driver_pool=driver_pool)
         self._quote_via = urllib.parse.quote
-        self._source_html = None
         self._url : str = self.generate_url() if url is None else url
     
     def generate_url(self) -> str:
@@ -130,48 +159,69 @@ class PinterestSearch(ImageSearch):
         base_url = "https://www.pinterest.com/search/pins/?"
         return super().generate_url(base_url, self._quote_via)
     
-    async def initialise_source_html(self, scroll=True, expectation=None) -> str:
-        super().initialise_webdriver(self._url)
-        print(self.format_message(f"Initialising {self._name} web page..."))
-
-        if expectation is not None:
-            await self._driver.scroll_to_element(expectation)
-        elif scroll:
-            await self._driver.scroll_to_bottom()
-        
-        print(self.format_message(f"Initialising {self._name} web page complete."))
-        return self._driver.get_page_source()
+    async def get_board_image_urls(self, board_name=None) -> List[str]:
+        """Scrapes a Pinterest board and returns a list of urls for the images."""
+        return [ url async for url in self.iter_board_image_urls(board_name=board_name) ]
     
-    async def get_board_image_urls(self, board_name=None, save_source=False):
+    async def iter_board_image_urls(self, board_name=None) -> AsyncIterator[str]:
+        """Scrapes a Pinterest board and yields the urls of the images as they are scrolled into view."""
         print(self.format_message(f"Fetching pinterest board image urls..."))
         expectation = ("xpath", "//section[@data-test-id='secondaryBoardGrid']")
-        self._source_html = await self.initialise_source_html(expectation=expectation)
-        
-        if board_name == None:
-            bs = BeautifulSoup(self._source_html, "lxml")
-            board_name = bs.find('h1').text
-            board_name = board_name.lower().replace(' ','_')
-        self._query = board_name
-        
-        return await self.get_search_image_urls(board=True)
+        try:
+            await super().initialise_webdriver(self._url)
+            if board_name == None:
+                title = await self._driver.wait_for_element("tag name", "h1", self._driver.webdriverwait_sleep)
+                # Falls back to the board's name in the url, e.g. pinterest.com/<user>/<board>/
+                board_name = title.text if title is not None else urllib.parse.unquote(self._url.rstrip('/').split('/')[-1])
+                board_name = board_name.lower().replace(' ','_')
+            self._query = board_name
+            # Pins below the board belong to the "More ideas" section
+            async for image_url in self._iter_harvested_image_urls(self._driver.iter_scroll_to_element(expectation), "div.Collection img"):
+                yield image_url
+        finally:
+            self.release_webdriver()
     
-    async def get_search_image_urls(self, board=False):
+    async def get_search_image_urls(self, board=False) -> List[str]:
         """Scrapes Pinterest Search and returns a list of urls for the images."""
-        if self._source_html is None:
-            print(self.format_message(f"Starting search for images of '{self._query}'..."))
-            self._source_html = await self.initialise_source_html()
-        
-        bs = BeautifulSoup(self._source_html, "lxml")
+        return [ url async for url in self.iter_search_image_urls(board=board) ]
+    
+    async def iter_search_image_urls(self, board=False) -> AsyncIterator[str]:
+        """Scrapes Pinterest Search and yields the urls of the images as they are scrolled into view."""
         if board:
-            bs = bs.find('div', {'class': "Collection"})
-        image_elements = bs.find_all('img', {'src': re.compile("https://i.pinimg.com/236x/*")})
-        urls = [ e.attrs['src'] for e in image_elements ]
-        image_urls = [ os.path.splitext(url)[0].replace('/236x/','/originals/').split('-')[0] + os.path.splitext(url)[1] for url in urls ]
+            async for image_url in self.iter_board_image_urls():
+                yield image_url
+            return
+        print(self.format_message(f"Starting search for images of '{self._query}'..."))
+        try:
+            await super().initialise_webdriver(self._url)
+            async for image_url in self._iter_harvested_image_urls(self._driver.iter_scroll_to_bottom(), "img"):
+                yield image_url
+        finally:
+            self.release_webdriver()
+    
+    async def _iter_harvested_image_urls(self, scroll_steps : AsyncIterator[None], selector : str) -> AsyncIterator[str]:
+        """Collects the pins in the DOM before and after every scroll step, since Pinterest removes
+        pins that are scrolled out of view, and yields their original image urls."""
+        print(self.format_message(f"Scrolling and collecting pins..."))
+        image_urls = set()
+        harvest_steps = self._iter_scroll_steps(scroll_steps)
+        async for _ in harvest_steps:
+            with METRICS.time("parse_seconds", engine=self._name):
+                sources = self._driver.harvest_image_sources(selector, PINTEREST_THUMBNAIL_PREFIX)
+            for src in sources:
+                image_url = pinterest_original_url(src)
+                if image_url not in image_urls:
+                    image_urls.add(image_url)
+                    yield image_url
         
         print(self.format_message(f"Image urls retrieval complete. Number of image urls successfully retrieved = {len(image_urls)}"))
         self._debug_success = len(image_urls)
-        
-        return image_urls
+    
+    async def _iter_scroll_steps(self, scroll_steps : AsyncIterator[None]) -> AsyncIterator[None]:
+        """Yields once before scrolling and after every scroll step."""
+        yield
+        async for _ in scroll_steps:
+            yield
 
 
 class UnsplashSearch(ImageSearch):
@@ -1,32 +1,40 @@
 import argparse
-import asyncio
+import importlib
 import json
 import os
-from re import search
 import sys
-import validators
 
-from typing import Dict, List
+from typing import TYPE_CHECKING, Dict, List, Tuple
 
-from config import Config, reset_defaults, update_config_json
-from image import ImagesDownloader
-from image_search import GoogleSearch, PinterestSearch
-from utils import timer
-from webdriver import WebDriver
+from config import CONFIG_PATH, Config, reset_defaults, update_config_json
+from metrics import METRICS
+
+# The modules of the browser, download and dedup stages import selenium, requests, aiohttp,
+# lxml and numpy, so the subcommands import them when they need them
+if TYPE_CHECKING:
+    from image import ImagesDownloader
+    from rate_limit import HostRateLimiter
+    from webdriver import WebDriverPool
 
 class ScraperConfig:
     
+    _cached : Tuple = (None, None) # Modification time and size of config.json, and its validated config
+    
     def __init__(self):
         self.config : Config = self._load_config()
+        self._rate_limiter : "HostRateLimiter" = None
         
     def _load_config(self) -> Config:
-        """Loads config.json and creats appropriate config files."""
-        with open("image_scraper/config.json", 'r', encoding='utf-8') as file:
-            config_obj = Config(json.load(file))
-            if self.config_isvalid(config_obj):
-                return config_obj
-            else:
+        """Loads and validates config.json, reusing the validated config until the file changes."""
+        stat = os.stat(CONFIG_PATH)
+        key = (stat.st_mtime_ns, stat.st_size)
+        if ScraperConfig._cached[0] != key:
+            with open(CONFIG_PATH, 'r', encoding='utf-8') as file:
+                config_obj = Config(json.load(file))
+            if not self.config_isvalid(config_obj):
                 raise Exception("Configuration is invalid. Please check check config.json or run `image_scraper config -r` to reset defaults.")
+            ScraperConfig._cached = (key, config_obj)
+        return ScraperConfig._cached[1]
     
     def config_isvalid(self, config : Config) -> bool:
         valid = self._config_isvalid(config, ["image", "search", "webdriver"])
@@ -45,14 +53,54 @@ class ScraperConfig:
         return sum(check)==len(check)
     
     def get_driver_config(self, search_engine) -> Dict:
-        driver_config = self.config.webdriver
+        driver_config = dict(self.config.webdriver)
         driver_config.update(self.config.search[search_engine])
         return driver_config
+    
+    def create_driver_pool(self, min_size : int = 1) -> "WebDriverPool":
+        """Creates a pool of browser sessions shared by the search engines. The pool holds at
+        least min_size sessions so concurrent searches on one event loop never wait on each other."""
+        from webdriver import WebDriverPool
+        return WebDriverPool(driver_config=self.config.webdriver,
+                             pool_size=max(self.config.webdriver.get("pool_size", 1), min_size),
+                             max_uses=self.config.webdriver.get("max_uses", 20),
+                             rate_limiter=self.get_rate_limiter())
+    
+    def get_rate_limit_config(self) -> Dict:
+        return getattr(self.config, "rate_limit", {})
+    
+    def get_rate_limiter(self) -> "HostRateLimiter":
+        """Returns the per host rate limiter shared by the downloads and page loads of the run."""
+        from rate_limit import HostRateLimiter
+        if self._rate_limiter is None:
+            self._rate_limiter = HostRateLimiter(**self.get_rate_limit_config())
+        return self._rate_limiter
 
    
-def download_image_urls(config : ScraperConfig, image_urls : List[str], subfolder : str=None):
+# Module and class of each download engine
+DOWNLOAD_ENGINES = {
+    "threads": ("image", "ImagesDownloader"),
+    "async": ("aio_image", "AsyncImagesDownloader"),
+}
+
+def get_download_engine(engine : str) -> type:
+    """Imports and returns the downloader class of a download engine."""
+    module_name, class_name = DOWNLOAD_ENGINES[engine]
+    return getattr(importlib.import_module(module_name), class_name)
+
+def create_downloader(config : ScraperConfig, subfolder : str=None, engine : str=None, revalidate : bool=False,
+                      shared : "ImagesDownloader"=None) -> "ImagesDownloader":
+    """Creates an ImagesDownloader object for the given download engine."""
+    image_config = dict(config.config.image)
+    if revalidate:
+        image_config["revalidate"] = True
+    if engine is None:
+        engine = image_config.get("engine", "threads")
+    return get_download_engine(engine)(config=image_config, subfolder=subfolder, rate_limiter=config.get_rate_limiter(), shared=shared)
+
+def download_image_urls(config : ScraperConfig, image_urls : List[str], subfolder : str=None, engine : str=None, revalidate : bool=False):
     """Creates an ImagesDownloader object and executes downloader given a list of urls."""
-    downloader = ImagesDownloader(config=config.config.image, subfolder=subfolder)
+    downloader = create_downloader(config, subfolder=subfolder, engine=engine, revalidate=revalidate)
     downloader.download_queue(image_urls=image_urls)
 
 def configure(args):
@@ -61,6 +109,7 @@ def configure(args):
         reset_defaults()
         print("Successfully reset default configurations.")
     if args.chromedriver_path:
+        from webdriver import WebDriver
         test_config = {"browser": "Chrome", "path": args.chromedriver_path}
         print("Attempting to create a selenium driver...")
         WebDriver(driver_config=test_config)
@@ -73,46 +122,155 @@ def download(args) -> None:
     """Subparser controller: Downloads images given url(s)."""
     config = ScraperConfig()
     if args.url:
-        ImagesDownloader(config=config.config.image).download_image(image_url=args.url)
+        from image import ImagesDownloader
+        ImagesDownloader(config=config.config.image, rate_limiter=config.get_rate_limiter()).download_image(image_url=args.url)
     if args.pinterest_board:
+        import asyncio
+        from image_search import PinterestSearch
         driver_config = config.get_driver_config("Pinterest")
-        pinterest = PinterestSearch(driver_config=driver_config, url=args.pinterest_board)
+        driver_pool = config.create_driver_pool()
+        pinterest = PinterestSearch(driver_config=driver_config, url=args.pinterest_board, driver_pool=driver_pool)
         
         loop = asyncio.get_event_loop()
         image_urls = loop.run_until_complete(asyncio.gather(pinterest.get_board_image_urls()))
+        driver_pool.close()
         
         image_urls = [ url for sublist in image_urls for url in sublist ]
         subfolder_name = args.name if args.name is not None else pinterest.get_details()["query"]
-        download_image_urls(config=config, image_urls=image_urls, subfolder=subfolder_name)
-    if args.from_file:
+        download_image_urls(config=config, image_urls=image_urls, subfolder=subfolder_name, engine=args.engine, revalidate=args.revalidate)
+    if args.queue:
+        download_work_queue(config, args)
+    elif args.from_file and args.stream:
+        subfolder_name = args.name if args.name is not None else os.path.splitext(os.path.basename(args.from_file))[0]
+        downloader = create_downloader(config, subfolder=subfolder_name, engine=args.engine, revalidate=args.revalidate)
+        downloader.download_file(args.from_file)
+    elif args.from_file:
         print(f"Downloading images from {args.from_file}...")
-        image_urls = []
         subfolder_name = args.name if args.name is not None else os.path.splitext(os.path.basename(args.from_file))[0]
-        with open(args.from_file) as file:
-            for line in file:
-                if validators.url(line.strip()):
-                    image_urls.append(line.strip())
-        download_image_urls(config=config, image_urls=image_urls, subfolder=subfolder_name) 
+        download_image_urls(config=config, image_urls=read_image_urls(args.from_file), subfolder=subfolder_name, engine=args.engine, revalidate=args.revalidate)
+
+def dedup(args) -> None:
+    """Subparser controller: Finds the near-duplicate images of a save_path."""
+    config = ScraperConfig()
+    image_config = dict(config.config.image)
+    if args.path:
+        image_config["save_path"] = args.path
+    near_dedup = dict(image_config.get("near_dedup", {}))
+    near_dedup["action"] = args.action if args.action is not None else near_dedup.get("action", "off")
+    if near_dedup["action"] == "off":
+        near_dedup["action"] = "report"
+    if args.max_distance is not None:
+        near_dedup["max_distance"] = args.max_distance
+    if args.workers is not None:
+        near_dedup["workers"] = args.workers
+    image_config["near_dedup"] = near_dedup
+    from image import ImagesDownloader
+    ImagesDownloader(config=image_config).remove_near_duplicates()
+
+def read_image_urls(file_name : str) -> List[str]:
+    """Returns the valid urls of a file with one url per line."""
+    import validators
+    image_urls = []
+    with open(file_name) as file:
+        for line in file:
+            if validators.url(line.strip()):
+                image_urls.append(line.strip())
+    return image_urls
+
+def download_work_queue(config : ScraperConfig, args) -> None:
+    """Queues the urls of --from-file, if given, in the shared work queue and downloads urls
+    from the queue until it is drained."""
+    import socket
+    from utils import tabulate
+    from work_queue import SqliteWorkQueue
+    queue_config = config.config.image.get("queue", {})
+    work_queue = SqliteWorkQueue(args.queue, lease_timeout=queue_config.get("lease_timeout", 300), max_attempts=queue_config.get("max_attempts", 3))
+    if args.from_file:
+        from url_stream import UrlStream
+        # The urls are read lazily, so files of any size are queued in constant memory
+        n_added = work_queue.put(url for _, url in UrlStream(args.from_file))
+        print(f"Queued {n_added} new urls from {args.from_file} in {args.queue}.")
+    subfolder_name = args.name if args.name is not None else os.path.splitext(os.path.basename(args.queue))[0]
+    downloader = create_downloader(config, subfolder=subfolder_name, engine=args.engine, revalidate=args.revalidate)
+    downloader.download_work_queue(work_queue, worker_id=f"{socket.gethostname()}:{os.getpid()}",
+                                   batch_size=queue_config.get("batch_size", 100),
+                                   poll_interval=queue_config.get("poll_interval", 5))
+    tabulate(work_queue.counts(), headers=("QUEUE STATE", "TOTAL URLS"))
+    work_queue.close()
         
+def read_queries(file_name : str) -> List[str]:
+    """Returns the queries of a file with one query per line, skipping blank and # lines."""
+    with open(file_name, encoding='utf-8') as file:
+        queries = [ line.strip() for line in file ]
+    return [ query for query in queries if query and not query.startswith('#') ]
+
+def scrape_batch(config : ScraperConfig, args) -> None:
+    """Scrapes the queries of a file on a pool of worker processes."""
+    from batch import BatchScraper
+    if (args.engine or config.config.image.get("engine", "threads")) != "threads":
+        raise ValueError("engine: --queries-file downloads on the threads engine, run it with --engine threads.")
+    engines = [ engine for engine, selected in [("Google", args.google), ("Pinterest", args.pinterest)] if selected ] or ["Google"]
+    driver_configs = { engine : config.get_driver_config(engine) for engine in engines }
+    workers = args.workers if args.workers is not None else config.config.webdriver.get("workers", 2)
+    queries = read_queries(args.queries_file)
+    work_queue = None
+    queue_config = config.config.image.get("queue", {})
+    if args.queue:
+        import socket
+        from work_queue import QUERY, SqliteWorkQueue
+        work_queue = SqliteWorkQueue(args.queue, lease_timeout=queue_config.get("lease_timeout", 300), max_attempts=queue_config.get("max_attempts", 3))
+        # The queries are leased from the queue instead, where other workers may lease them too
+        n_added = work_queue.put(queries, kind=QUERY)
+        print(f"Queued {n_added} new queries from {args.queries_file} in {args.queue}.")
+        queries = []
+    batch = BatchScraper(driver_configs=driver_configs,
+                         image_config=config.config.image,
+                         create_downloader=lambda query, shared: create_downloader(config, subfolder=query, engine="threads", revalidate=args.revalidate, shared=shared),
+                         workers=workers,
+                         export_urls=args.export_urls,
+                         rate_limiter=config.get_rate_limiter(),
+                         work_queue=work_queue,
+                         worker_id=f"{socket.gethostname()}:{os.getpid()}" if work_queue is not None else None,
+                         poll_interval=queue_config.get("poll_interval", 5))
+    batch.run(queries, webdriver_config=config.config.webdriver, rate_limit_config=config.get_rate_limit_config())
+    if work_queue is not None:
+        from utils import tabulate
+        tabulate(work_queue.counts(kind=QUERY), headers=("QUEUE STATE", "TOTAL QUERIES"))
+        work_queue.close()
+
 def scrape(args) -> None:
     """Subparser controller: Retrieves image urls from the search engine and downloads them in a file."""
     config = ScraperConfig()
     search_engines = []
+    if args.queries_file:
+        scrape_batch(config, args)
     if args.search:
+        import asyncio
+        from image_search import GoogleSearch, PinterestSearch
+        from utils import merge_async_iterators
+        driver_pool = config.create_driver_pool(min_size=max(args.google + args.pinterest, 1))
         if args.google:
             driver_config = config.get_driver_config("Google")
-            search_engines.append(GoogleSearch(query=args.search, driver_config=driver_config))
+            search_engines.append(GoogleSearch(query=args.search, driver_config=driver_config, driver_pool=driver_pool))
         if args.pinterest:
             driver_config = config.get_driver_config("Pinterest")
-            search_engines.append(PinterestSearch(query=args.search, driver_config=driver_config))
+            search_engines.append(PinterestSearch(query=args.search, driver_config=driver_config, driver_pool=driver_pool))
         if len(search_engines) == 0:
             # Default search engine
             driver_config = config.get_driver_config("Google")
-            search_engines.append(GoogleSearch(query=args.search, driver_config=driver_config))
+            search_engines.append(GoogleSearch(query=args.search, driver_config=driver_config, driver_pool=driver_pool))
         
+        image_urls = []
+        async def found_image_urls():
+            async for url in merge_async_iterators(*(search.iter_search_image_urls() for search in search_engines)):
+                image_urls.append(url)
+                yield url
+        
+        # Downloads start as soon as the first urls are found
+        downloader = create_downloader(config, subfolder=args.search, engine=args.engine, revalidate=args.revalidate)
         loop = asyncio.get_event_loop()
-        image_urls = loop.run_until_complete(asyncio.gather(*(search.get_search_image_urls() for search in search_engines)))
-        image_urls = [ url for sublist in image_urls for url in sublist ]
+        loop.run_until_complete(downloader.download_stream(found_image_urls()))
+        driver_pool.close()
         
         if args.export_urls:
             file_name = "{}_image_urls.txt".format(args.search.lower().replace(' ','_'))
@@ -121,7 +279,19 @@ def scrape(args) -> None:
                         file.write(f"{url}\n")
                 print(f"Image urls save in file '{file_name}'.")
 
-        download_image_urls(config=config, image_urls=image_urls, subfolder=args.search)
+def add_metrics_arguments(parser : argparse.ArgumentParser) -> None:
+    parser.add_argument('--metrics', help='writes the run metrics (latency histograms, bytes/s, errors) to a JSON file', type=str, required=False)
+    parser.add_argument('--prometheus', help='writes the run metrics to a Prometheus textfile', type=str, required=False)
+    parser.add_argument('--trace', help='appends a JSON line per download attempt to the file', type=str, required=False)
+
+def export_metrics(args) -> None:
+    """Writes the metrics files requested on the command line."""
+    if getattr(args, "metrics", None):
+        METRICS.write_json(args.metrics)
+        print(f"Metrics saved in file '{args.metrics}'.")
+    if getattr(args, "prometheus", None):
+        METRICS.write_prometheus(args.prometheus)
+    METRICS.close()
 
 def file_path(string):
     """Checks if the string is a valid file."""
@@ -142,19 +312,42 @@ def main():
     search_parser.add_argument('-g', '--google', help='search query on google', action='store_true',required=False)
     search_parser.add_argument('-p', '--pinterest', help='search query on pinterest', action='store_true', required=False)
     search_parser.add_argument('-e', '--export-urls', help='exports retrieved urls and saves as image_urls.txt', action='store_true', required=False)
-    search_parser.add_argument('-s', '--search', help='query to search for on indicated search engine(s)', type=str, required=True)
+    search_queries = search_parser.add_mutually_exclusive_group(required=True)
+    search_queries.add_argument('-s', '--search', help='query to search for on indicated search engine(s)', type=str)
+    search_queries.add_argument('-qf', '--queries-file', help='file with one query per line to search for on worker processes', type=file_path)
+    search_parser.add_argument('-q', '--queue', help='work queue file shared with other --queries-file workers (its queries are added to it)', type=str, required=False)
+    search_parser.add_argument('-w', '--workers', help='number of worker processes for --queries-file (defaults to webdriver.workers in config.json)', type=int, required=False)
+    search_parser.add_argument('--engine', help='download engine (defaults to image.engine in config.json)', choices=DOWNLOAD_ENGINES.keys(), required=False)
+    search_parser.add_argument('--revalidate', help='revalidate images downloaded in previous runs with conditional requests', action='store_true', required=False)
+    add_metrics_arguments(search_parser)
     search_parser.set_defaults(func=scrape)
 
     download_parser = subparsers.add_parser("download", aliases=["dl"],
                                            description="Downloads images given a url",
                                            help="downloads images given url(s)")
     download_parser.add_argument('-f', '--from-file', help='download images from file with urls', type=file_path, required=False)
+    download_parser.add_argument('-s', '--stream', help='reads --from-file lazily with a bounded window of urls in flight, checkpointing its position to resume from', action='store_true', required=False)
+    download_parser.add_argument('-q', '--queue', help='work queue file shared with other download workers (urls of --from-file are added to it)', type=str, required=False)
     download_parser.add_argument('-n', '--name', help='name of the subfolder to store downloaded images', type=str, required=False)
     download_parser.add_argument('-pb', '--pinterest-board', help='scrape images from a pinterest board url', type=str, required=False)
     download_parser.add_argument('-url', '--url', help='image url to download', type=str,required=False)
     download_parser.add_argument('-v', '--verbose', help='verbose', action='store_true', required=False)
+    download_parser.add_argument('--engine', help='download engine (defaults to image.engine in config.json)', choices=DOWNLOAD_ENGINES.keys(), required=False)
+    download_parser.add_argument('--revalidate', help='revalidate images downloaded in previous runs with conditional requests', action='store_true', required=False)
+    add_metrics_arguments(download_parser)
     download_parser.set_defaults(func=download)
     
+    dedup_parser = subparsers.add_parser("dedup",
+                                         description="Finds resized and recompressed copies of the same image in a save path.",
+                                         help="finds near-duplicate images")
+    dedup_parser.add_argument('-p', '--path', help='folder of the images (defaults to image.save_path in config.json)', type=str, required=False)
+    dedup_parser.add_argument('-a', '--action', help='reports the near-duplicates, moves them to the .quarantine folder or removes them (defaults to report)',
+                              choices=["report", "quarantine", "skip"], required=False)
+    dedup_parser.add_argument('-d', '--max-distance', help='most bits in which the perceptual hashes of near-duplicates differ', type=int, required=False)
+    dedup_parser.add_argument('-w', '--workers', help='number of hashing processes (defaults to the number of CPUs)', type=int, required=False)
+    add_metrics_arguments(dedup_parser)
+    dedup_parser.set_defaults(func=dedup)
+    
     config_parser = subparsers.add_parser("configure", aliases=["config"],
                                           description="Image Scraper Configuration",
                                           help="configure settings of the scraper.")
@@ -164,7 +357,12 @@ def main():
     config_parser.set_defaults(func=configure)
     
     args = parser.parse_args()
-    args.func(args)
+    if getattr(args, "trace", None):
+        METRICS.open_trace(args.trace)
+    try:
+        args.func(args)
+    finally:
+        export_metrics(args)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,88 @@
+import os
+import sqlite3
+import threading
+
+from collections import namedtuple
+from typing import Optional
+
+ManifestEntry = namedtuple("ManifestEntry", ["url", "path", "part_path", "etag", "last_modified", "complete"])
+
+class RunManifest:
+    """A persistent record of the urls downloaded into a subfolder.
+
+    Each url maps to its saved file and the ETag/Last-Modified validators it was served with,
+    or to the partial file of a download that was interrupted, so reruns can skip completed
+    urls, revalidate them with conditional requests and resume partial files with Range.
+    """
+
+    FILE_NAME = ".manifest.sqlite3"
+
+    def __init__(self, directory : str):
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(directory, self.FILE_NAME), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+                                url TEXT PRIMARY KEY,
+                                path TEXT,
+                                part_path TEXT,
+                                etag TEXT,
+                                last_modified TEXT,
+                                complete INTEGER NOT NULL DEFAULT 0)""")
+        self._conn.commit()
+
+    def _full_path(self, relative_path : Optional[str]) -> Optional[str]:
+        return os.path.join(self._directory, relative_path) if relative_path is not None else None
+
+    def _relative_path(self, full_path : Optional[str]) -> Optional[str]:
+        return os.path.relpath(full_path, self._directory) if full_path is not None else None
+
+    def get(self, url : str) -> Optional[ManifestEntry]:
+        """Returns the entry of the url with full paths, if any."""
+        with self._lock:
+            row = self._conn.execute("SELECT url, path, part_path, etag, last_modified, complete FROM entries WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        entry = ManifestEntry(*row)
+        return entry._replace(path=self._full_path(entry.path), part_path=self._full_path(entry.part_path), complete=bool(entry.complete))
+
+    def is_complete(self, url : str) -> bool:
+        """Checks whether the url was downloaded and its file is still on disk."""
+        entry = self.get(url)
+        return entry is not None and entry.complete and os.path.isfile(entry.path)
+
+    def start(self, url : str, part_path : str, etag : str = None, last_modified : str = None) -> None:
+        """Records the partial file a url is being streamed into."""
+        with self._lock:
+            self._conn.execute("""INSERT INTO entries (url, part_path, etag, last_modified, complete) VALUES (?, ?, ?, ?, 0)
+                                  ON CONFLICT(url) DO UPDATE SET part_path=excluded.part_path, etag=excluded.etag,
+                                  last_modified=excluded.last_modified, complete=0""",
+                               (url, self._relative_path(part_path), etag, last_modified))
+            self._conn.commit()
+
+    def complete(self, url : str, path : str, etag : str = None, last_modified : str = None) -> None:
+        """Records the saved file of a url."""
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO entries (url, path, part_path, etag, last_modified, complete) VALUES (?, ?, NULL, ?, ?, 1)",
+                               (url, self._relative_path(path), etag, last_modified))
+            self._conn.commit()
+
+    def remove(self, url : str) -> None:
+        """Forgets a url, e.g. when its partial file can no longer be resumed."""
+        with self._lock:
+            self._conn.execute("DELETE FROM entries WHERE url = ?", (url,))
+            self._conn.commit()
+
+    def move(self, path : str, new_path : str) -> None:
+        """Points the urls saved to a removed file at another file, e.g. the image kept in place
+        of a near-duplicate, so reruns skip them."""
+        with self._lock:
+            self._conn.execute("UPDATE entries SET path = ? WHERE path = ? AND complete = 1",
+                               (self._relative_path(new_path), self._relative_path(path)))
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,200 @@
+import bisect
+import contextlib
+import json
+import os
+import threading
+import time
+
+from typing import Dict, Iterator, List, Tuple
+
+# Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PROMETHEUS_PREFIX = "image_scraper_"
+
+LabelKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+def _key(name : str, labels : Dict) -> LabelKey:
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+def _format_key(key : LabelKey) -> str:
+    name, labels = key
+    if len(labels) == 0:
+        return name
+    return name + "{" + ",".join(f'{label}="{value}"' for label, value in labels) + "}"
+
+def _parse_key(string : str) -> LabelKey:
+    if "{" not in string:
+        return string, ()
+    name, labels = string[:-1].split("{", 1)
+    return name, tuple(tuple(label.split("=", 1)) for label in labels.replace('"', '').split(","))
+
+
+class Histogram:
+    """Latency observations counted in fixed buckets."""
+
+    def __init__(self, buckets : Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets : Tuple[float, ...] = buckets
+        self.counts : List[int] = [0] * (len(buckets) + 1) # The last bucket is +Inf
+        self.sum : float = 0
+        self.count : int = 0
+
+    def observe(self, value : float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q : float) -> float:
+        """Returns the q quantile, interpolated within its bucket."""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count > 0 and cumulative + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def to_dict(self) -> Dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "p50": round(self.quantile(0.5), 6),
+            "p90": round(self.quantile(0.9), 6),
+            "p99": round(self.quantile(0.99), 6),
+            "counts": list(self.counts),
+        }
+
+    def merge(self, histogram : Dict) -> None:
+        self.counts = [ a + b for a, b in zip(self.counts, histogram["counts"]) ]
+        self.sum += histogram["sum"]
+        self.count += histogram["count"]
+
+
+class Metrics:
+    """Thread safe counters, gauges and latency histograms of a run.
+
+    Metrics are named like Prometheus metrics and take labels as keyword arguments. They are
+    exported as JSON or as a Prometheus textfile, and a JSONL trace with one record per
+    download attempt can be written as well.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters : Dict[LabelKey, float] = {}
+        self._gauges : Dict[LabelKey, float] = {}
+        self._histograms : Dict[LabelKey, Histogram] = {}
+        self._started : float = time.monotonic()
+        self._trace_file = None
+
+    def inc(self, name : str, value : float = 1, **labels) -> None:
+        """Increases a counter."""
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def add(self, name : str, value : float, **labels) -> None:
+        """Changes a gauge, e.g. the number of requests in flight."""
+        key = _key(name, labels)
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + value
+
+    def observe(self, name : str, seconds : float, **labels) -> None:
+        """Records a latency in a histogram."""
+        key = _key(name, labels)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(seconds)
+
+    @contextlib.contextmanager
+    def time(self, name : str, **labels) -> Iterator[None]:
+        """Records the duration of the block in a histogram."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def open_trace(self, path : str) -> None:
+        """Writes a JSON line per traced event to the file from now on."""
+        self._trace_file = open(path, 'a', encoding='utf-8')
+
+    def trace(self, **record) -> None:
+        if self._trace_file is not None:
+            line = json.dumps(dict(record, time=round(time.time(), 3)), ensure_ascii=False)
+            with self._lock:
+                self._trace_file.write(line + "\n")
+
+    def snapshot(self) -> Dict:
+        """Returns the metrics as a JSON serialisable dict."""
+        with self._lock:
+            elapsed = time.monotonic() - self._started
+            snapshot = {
+                "elapsed_seconds": round(elapsed, 3),
+                "counters": { _format_key(key) : value for key, value in sorted(self._counters.items()) },
+                "gauges": { _format_key(key) : value for key, value in sorted(self._gauges.items()) },
+                "histograms": { _format_key(key) : histogram.to_dict() for key, histogram in sorted(self._histograms.items()) },
+            }
+        bytes_total = sum(value for key, value in snapshot["counters"].items() if _parse_key(key)[0] == "download_bytes_total")
+        snapshot["download_bytes_per_second"] = round(bytes_total / elapsed, 1) if elapsed > 0 else 0.0
+        return snapshot
+
+    def merge(self, snapshot : Dict) -> None:
+        """Adds the counters and histograms of a snapshot, e.g. taken in a worker process."""
+        with self._lock:
+            for string, value in snapshot["counters"].items():
+                key = _parse_key(string)
+                self._counters[key] = self._counters.get(key, 0) + value
+            for string, histogram in snapshot["histograms"].items():
+                key = _parse_key(string)
+                if key not in self._histograms:
+                    self._histograms[key] = Histogram()
+                self._histograms[key].merge(histogram)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+            self._started = time.monotonic()
+
+    def write_json(self, path : str) -> None:
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.snapshot(), file, indent=4)
+
+    def write_prometheus(self, path : str) -> None:
+        """Writes the metrics in the Prometheus text format, e.g. for the node exporter textfile collector."""
+        lines = []
+        with self._lock:
+            for kind, metrics in [("counter", self._counters), ("gauge", self._gauges)]:
+                for name in sorted(set(key[0] for key in metrics)):
+                    lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name} {kind}")
+                    lines.extend(f"{PROMETHEUS_PREFIX}{_format_key(key)} {value}" for key, value in sorted(metrics.items()) if key[0] == name)
+            for name in sorted(set(key[0] for key in self._histograms)):
+                lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name} histogram")
+                for (histogram_name, labels), histogram in sorted(self._histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                        cumulative += count
+                        lines.append(f"{PROMETHEUS_PREFIX}{_format_key((name + '_bucket', labels + (('le', str(bound)),)))} {cumulative}")
+                    lines.append(f"{PROMETHEUS_PREFIX}{_format_key((name + '_sum', labels))} {histogram.sum}")
+                    lines.append(f"{PROMETHEUS_PREFIX}{_format_key((name + '_count', labels))} {histogram.count}")
+        # Written to a temporary file first, so the collector never reads a partial file
+        with open(path + ".tmp", 'w', encoding='utf-8') as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+
+    def close(self) -> None:
+        if self._trace_file is not None:
+            self._trace_file.close()
+            self._trace_file = None
+
+
+# Metrics of the current process
+METRICS = Metrics()
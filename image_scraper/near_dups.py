@@ -0,0 +1,188 @@
+import os
+import shutil
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp", ".tif", ".tiff"}
+
+# Actions on the near-duplicates found
+REPORT = "report"
+QUARANTINE = "quarantine" # Moved to the quarantine folder of the save_path for review
+SKIP = "skip" # Removed, and its urls pointed at the kept image, as duplicate content is by the "skip" dedup mode
+
+# Number of set bits of every byte, for numpy versions without bitwise_count
+POPCOUNT_TABLE = np.array([ bin(i).count("1") for i in range(256) ], dtype=np.uint8)
+
+def popcount(values : np.ndarray) -> np.ndarray:
+    """Returns the number of set bits of each uint64."""
+    values = np.ascontiguousarray(values, dtype=np.uint64)
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    return POPCOUNT_TABLE[values.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+def perceptual_hash(path : str) -> Optional[Tuple[int, int]]:
+    """Returns the 64 bit difference hash of an image and its number of pixels, or None if the
+    file cannot be read as an image.
+
+    The image is shrunk to 9x8 grey pixels and each bit tells whether a pixel is brighter than
+    its left neighbour, so resized and recompressed copies get the same or a close hash.
+    """
+    try:
+        with Image.open(path) as image:
+            n_pixels = image.width * image.height
+            # Lets JPEG decode at a fraction of the full size
+            image.draft("L", (64, 64))
+            pixels = np.asarray(image.convert("L").resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    bits = np.packbits(pixels[:, 1:] > pixels[:, :-1])
+    return int.from_bytes(bits.tobytes(), "big"), n_pixels
+
+
+class NearDuplicateIndex:
+    """Perceptual hashes of the images saved under a save_path, to find resized and recompressed
+    copies of the same picture.
+
+    The hashes are kept in numpy arrays saved next to the images, and only new or modified
+    files are hashed when the index is updated. Near-duplicates are found by multi-index
+    hashing: the hashes are split into max_distance + 1 blocks, so hashes within max_distance
+    bits share at least one block, and only hashes sharing a block are compared.
+    """
+
+    FILE_NAME = ".near_dups.npz"
+    QUARANTINE_FOLDER = ".quarantine"
+
+    def __init__(self, directory : str):
+        self._directory : str = directory
+        self._path : str = os.path.join(directory, self.FILE_NAME)
+        self.paths : List[str] = [] # Paths relative to the directory
+        self.mtimes : np.ndarray = np.zeros(0, dtype=np.int64)
+        self.hashes : np.ndarray = np.zeros(0, dtype=np.uint64)
+        self.pixels : np.ndarray = np.zeros(0, dtype=np.int64)
+        if os.path.isfile(self._path):
+            self._load()
+
+    def _load(self) -> None:
+        with np.load(self._path, allow_pickle=False) as index:
+            # Paths are stored as one UTF-8 blob with the offset of each path, which is far
+            # smaller than a fixed width numpy string array and holds any file name
+            blob, offsets = index["paths"].tobytes(), index["path_offsets"].tolist()
+            self.paths = [ blob[start:end].decode("utf-8") for start, end in zip(offsets[:-1], offsets[1:]) ]
+            self.mtimes, self.hashes, self.pixels = index["mtimes"], index["hashes"], index["pixels"]
+
+    def save(self) -> None:
+        encoded = [ path.encode("utf-8") for path in self.paths ]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([ len(path) for path in encoded ], out=offsets[1:])
+        tmp_path = self._path + ".tmp.npz"
+        np.savez(tmp_path, paths=np.frombuffer(b"".join(encoded), dtype=np.uint8), path_offsets=offsets,
+                 mtimes=self.mtimes, hashes=self.hashes, pixels=self.pixels)
+        os.replace(tmp_path, self._path)
+
+    def _scan(self) -> Iterator[Tuple[str, int]]:
+        """Yields the relative path and modification time of the images under the directory,
+        skipping hidden files and folders such as part files and the quarantine."""
+        stack = [self._directory]
+        while len(stack) > 0:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+                        yield os.path.relpath(entry.path, self._directory), entry.stat().st_mtime_ns
+
+    def update(self, workers : int = None) -> int:
+        """Hashes the new and modified images on a process pool, forgets the removed ones and
+        saves the index. Returns the number of images hashed."""
+        files = dict(self._scan())
+        kept = [ i for i, path in enumerate(self.paths) if files.get(path) == self.mtimes[i] ]
+        known = set(self.paths[i] for i in kept)
+        new_paths = [ path for path in files if path not in known ]
+        results = []
+        if len(new_paths) > 0:
+            full_paths = [ os.path.join(self._directory, path) for path in new_paths ]
+            with ProcessPoolExecutor(max_workers=workers or None) as executor:
+                results = list(executor.map(perceptual_hash, full_paths, chunksize=64))
+        hashed = [ (path, result) for path, result in zip(new_paths, results) if result is not None ]
+        self.paths = [ self.paths[i] for i in kept ] + [ path for path, _ in hashed ]
+        self.mtimes = np.concatenate([self.mtimes[kept], np.array([ files[path] for path, _ in hashed ], dtype=np.int64)])
+        self.hashes = np.concatenate([self.hashes[kept], np.array([ result[0] for _, result in hashed ], dtype=np.uint64)])
+        self.pixels = np.concatenate([self.pixels[kept], np.array([ result[1] for _, result in hashed ], dtype=np.int64)])
+        self.save()
+        return len(hashed)
+
+    def query(self, image_hash : int, max_distance : int = 3) -> List[str]:
+        """Returns the paths of the indexed images within max_distance bits of a hash."""
+        distances = popcount(self.hashes ^ np.uint64(image_hash))
+        return [ self.paths[i] for i in np.flatnonzero(distances <= max_distance) ]
+
+    def _close_pairs(self, max_distance : int) -> np.ndarray:
+        """Returns the index pairs of the hashes within max_distance bits of each other."""
+        n = len(self.hashes)
+        bounds = np.linspace(0, 64, max_distance + 2).astype(int)
+        pairs = [np.zeros((0, 2), dtype=np.int64)]
+        for low, high in zip(bounds[:-1], bounds[1:]):
+            keys = (self.hashes >> np.uint64(low)) & np.uint64((1 << int(high - low)) - 1)
+            order = np.argsort(keys, kind="stable")
+            sorted_keys = keys[order]
+            # Compares each hash with the ones t places after it in the same block bucket,
+            # for as long as the buckets hold more than t hashes
+            active = np.arange(max(n - 1, 0))
+            t = 1
+            while len(active) > 0:
+                active = active[active + t < n]
+                active = active[sorted_keys[active] == sorted_keys[active + t]]
+                first, second = order[active], order[active + t]
+                close = popcount(self.hashes[first] ^ self.hashes[second]) <= max_distance
+                pairs.append(np.stack([np.minimum(first, second)[close], np.maximum(first, second)[close]], axis=1))
+                t += 1
+        # Pairs sharing several blocks are found once per block
+        return np.unique(np.concatenate(pairs), axis=0)
+
+    def find(self, max_distance : int = 3) -> List[List[str]]:
+        """Returns the groups of near-duplicate images, each starting with the image to keep:
+        the one with the most pixels, or the first indexed."""
+        parents = {}
+        def root(i):
+            while parents.get(i, i) != i:
+                i = parents[i]
+            return i
+        for first, second in self._close_pairs(max_distance).tolist():
+            first, second = root(first), root(second)
+            if first != second:
+                parents[max(first, second)] = min(first, second)
+        groups : Dict[int, List[int]] = {}
+        for i in parents:
+            groups.setdefault(root(i), [root(i)]).append(i)
+        return [ [ self.paths[i] for i in sorted(members, key=lambda i: (-self.pixels[i], i)) ] for members in groups.values() ]
+
+    def remove_duplicates(self, groups : List[List[str]], action : str, redirect : Callable[[str, str], None] = None) -> int:
+        """Quarantines or removes the images after the first of each group and drops them from
+        the index. Returns the number of images moved or removed. redirect is called with the
+        full paths of each removed image and of the image kept in its place, to point the
+        records of its urls at the kept image."""
+        if action not in [QUARANTINE, SKIP]:
+            return 0
+        duplicates = { path : group[0] for group in groups for path in group[1:] }
+        for path, kept_path in duplicates.items():
+            full_path = os.path.join(self._directory, path)
+            if action == QUARANTINE:
+                quarantine_path = os.path.join(self._directory, self.QUARANTINE_FOLDER, path)
+                os.makedirs(os.path.dirname(quarantine_path), exist_ok=True)
+                shutil.move(full_path, quarantine_path)
+                continue
+            if os.path.exists(full_path):
+                os.remove(full_path)
+            if redirect is not None:
+                redirect(full_path, os.path.join(self._directory, kept_path))
+        kept = [ i for i, path in enumerate(self.paths) if path not in duplicates ]
+        self.paths = [ self.paths[i] for i in kept ]
+        self.mtimes, self.hashes, self.pixels = self.mtimes[kept], self.hashes[kept], self.pixels[kept]
+        self.save()
+        return len(duplicates)
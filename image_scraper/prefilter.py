@@ -0,0 +1,134 @@
+import struct
+
+from collections import namedtuple
+from typing import List, Optional
+
+# Format and dimensions read from the first bytes of an image, the dimensions are None until
+# the bytes holding them have been read
+ImageInfo = namedtuple("ImageInfo", ["mime_type", "width", "height"])
+
+# Bytes needed to recognise the formats below
+SIGNATURE_BYTES = 12
+
+# JPEG start of frame markers, which hold the dimensions
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# JPEG markers without a length
+JPEG_STANDALONE_MARKERS = set(range(0xD0, 0xDA)) | {0x01}
+
+# Reasons to reject an image
+MIME_TYPE = "mime_type"
+DIMENSIONS = "dimensions"
+
+# Returned while more bytes are needed to decide
+PENDING = "pending"
+
+def _sniff_jpeg(data : bytes) -> ImageInfo:
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            break
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Fill byte
+            i += 1
+            continue
+        if marker in JPEG_SOF_MARKERS:
+            height, width = struct.unpack(">HH", data[i + 5:i + 9])
+            return ImageInfo("image/jpeg", width, height)
+        if marker in JPEG_STANDALONE_MARKERS:
+            i += 2
+        else:
+            i += 2 + struct.unpack(">H", data[i + 2:i + 4])[0]
+    return ImageInfo("image/jpeg", None, None)
+
+def _sniff_webp(data : bytes) -> ImageInfo:
+    chunk = data[12:16]
+    if chunk == b"VP8 " and len(data) >= 30:
+        width, height = struct.unpack("<HH", data[26:30])
+        return ImageInfo("image/webp", width & 0x3FFF, height & 0x3FFF)
+    if chunk == b"VP8L" and len(data) >= 25:
+        b0, b1, b2, b3 = data[21:25]
+        return ImageInfo("image/webp", 1 + (((b1 & 0x3F) << 8) | b0), 1 + (((b3 & 0x0F) << 10) | (b2 << 2) | ((b1 & 0xC0) >> 6)))
+    if chunk == b"VP8X" and len(data) >= 30:
+        return ImageInfo("image/webp", 1 + int.from_bytes(data[24:27], "little"), 1 + int.from_bytes(data[27:30], "little"))
+    return ImageInfo("image/webp", None, None)
+
+def sniff_image(data : bytes) -> Optional[ImageInfo]:
+    """Returns the format and dimensions of a JPEG, PNG, GIF or WebP image from the first bytes
+    of its body, or None if the bytes are not one of these formats."""
+    if data[:2] == b"\xff\xd8":
+        return _sniff_jpeg(data)
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        if len(data) >= 24 and data[12:16] == b"IHDR":
+            width, height = struct.unpack(">II", data[16:24])
+            return ImageInfo("image/png", width, height)
+        return ImageInfo("image/png", None, None)
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        if len(data) >= 10:
+            width, height = struct.unpack("<HH", data[6:10])
+            return ImageInfo("image/gif", width, height)
+        return ImageInfo("image/gif", None, None)
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return _sniff_webp(data)
+    return None
+
+
+class ImageRejected(Exception):
+    """Raised when the first bytes of an image body fail the prefilter."""
+
+    def __init__(self, reason : str):
+        super().__init__(f"Image rejected by the prefilter: {reason}")
+        self.reason : str = reason
+
+
+class ImageFilter:
+    """Screens images by their headers and first body bytes, so unwanted images are dropped
+    before the rest of the body is transferred.
+
+    Images are rejected when their format is not one of mime_types, or when they are narrower
+    than min_width or lower than min_height. Images whose dimensions are not found in the first
+    sniff_bytes bytes pass. Bodies larger than max_bytes are aborted by the downloader.
+    """
+
+    # Content types of servers that do not tell, left to the sniffed format
+    GENERIC_CONTENT_TYPES = ["application/octet-stream", "binary/octet-stream"]
+
+    def __init__(self, min_width : int = 0, min_height : int = 0, mime_types : List[str] = None, max_bytes : int = 0,
+                 sniff_bytes : int = 64 * 1024):
+        self.min_width : int = min_width
+        self.min_height : int = min_height
+        self.mime_types : Optional[List[str]] = mime_types
+        self.max_bytes : int = max_bytes
+        self.sniff_bytes : int = sniff_bytes
+
+    @staticmethod
+    def _mime_type(content_type : Optional[str]) -> str:
+        return (content_type or "").split(";")[0].strip().lower()
+
+    def check_content_type(self, content_type : Optional[str]) -> Optional[str]:
+        """Returns the reason to reject a response from its Content-Type header, or None."""
+        if not self.mime_types or content_type is None:
+            return None
+        mime_type = self._mime_type(content_type)
+        if mime_type == "" or mime_type in self.mime_types or mime_type in self.GENERIC_CONTENT_TYPES:
+            return None
+        return MIME_TYPE
+
+    def check_prefix(self, prefix : bytes, complete : bool = False, content_type : Optional[str] = None) -> Optional[str]:
+        """Returns the reason to reject an image from the first bytes of its body, None if it
+        passes, or PENDING while more bytes are needed. complete tells that prefix is the
+        whole body. Bodies of formats that cannot be sniffed, e.g. AVIF or SVG, pass when
+        their Content-Type is one of mime_types."""
+        decided = complete or len(prefix) >= self.sniff_bytes
+        info = sniff_image(prefix)
+        if info is None:
+            if not decided and len(prefix) < SIGNATURE_BYTES:
+                return PENDING
+            return MIME_TYPE if self.mime_types and self._mime_type(content_type) not in self.mime_types else None
+        if self.mime_types and info.mime_type not in self.mime_types:
+            return MIME_TYPE
+        if info.width is None:
+            return None if decided else PENDING
+        if info.width < self.min_width or info.height < self.min_height:
+            return DIMENSIONS
+        return None
@@ -0,0 +1,128 @@
+import threading
+import time
+
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional, Tuple
+
+from retry import get_host
+
+def parse_retry_after(value : Optional[str]) -> Optional[float]:
+    """Returns the seconds to wait of a Retry-After header, given in seconds or as an HTTP date."""
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def share_rate_limits(config : Dict, n : int) -> Dict:
+    """Returns the rate limits of a HostRateLimiter config for one of n processes, so that
+    together they stay within the configured rates."""
+    def share(limits : Dict) -> Dict:
+        return { key : value / n if key in ["rate", "burst", "min_rate"] else value for key, value in limits.items() }
+    shared = dict(config)
+    if "default" in config:
+        shared["default"] = share(config["default"])
+    if "hosts" in config:
+        shared["hosts"] = { host : share(limits) for host, limits in config["hosts"].items() }
+    return shared
+
+
+class TokenBucket:
+    """A token bucket refilled at rate tokens per second, holding at most burst tokens.
+
+    Up to burst tokens can be reserved ahead, so callers are told how long to wait for theirs
+    instead of polling. A throttled bucket pauses until the server's Retry-After has passed and
+    halves its rate, which then recovers to the configured rate with every granted token.
+    """
+
+    def __init__(self, rate : float, burst : float = 1, min_rate : float = 0.1):
+        self.max_rate : float = rate
+        self.rate : float = rate
+        self.burst : float = max(burst, 1)
+        self.min_rate : float = min(min_rate, rate)
+        self._tokens : float = self.burst
+        self._updated : float = time.monotonic()
+        self._throttled_until : float = 0
+
+    def reserve(self) -> Tuple[bool, float]:
+        """Tries to reserve a token. Returns whether one was reserved and how many seconds to
+        wait before using it, or before trying again when burst tokens are reserved already."""
+        now = time.monotonic()
+        if now > self._updated:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+        if self._tokens - 1 < -self.burst:
+            return False, (self._updated - now) + (1 - self.burst - self._tokens) / self.rate
+        self._tokens -= 1
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+        return True, (self._updated - now) + max(0.0, -self._tokens) / self.rate
+
+    def throttle(self, retry_after : Optional[float]) -> None:
+        """Halves the rate and pauses the bucket for retry_after seconds, or one token interval.
+        Responses to requests sent before the pause ended do not lower the rate again."""
+        now = time.monotonic()
+        if now >= self._throttled_until:
+            self.rate = max(self.min_rate, self.rate / 2)
+        pause = retry_after if retry_after is not None else 1 / self.rate
+        # A single token is available at the end of the pause
+        self._updated = max(self._updated, now + pause)
+        self._tokens = min(self._tokens, 1)
+        self._throttled_until = self._updated
+
+
+class HostRateLimiter:
+    """Thread safe token buckets per host, shared by the image downloads and the page loads.
+
+    Hosts without their own limits use the default limits, and a rate of 0 disables limiting.
+    """
+
+    def __init__(self, default : Dict = None, hosts : Dict[str, Dict] = None):
+        self._default : Dict = default or {}
+        self._hosts : Dict[str, Dict] = { host.lower() : limits for host, limits in (hosts or {}).items() }
+        self._buckets : Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, host : str) -> Optional[TokenBucket]:
+        if host not in self._buckets:
+            limits = self._hosts.get(host, self._default)
+            self._buckets[host] = TokenBucket(**limits) if limits.get("rate", 0) > 0 else None
+        return self._buckets[host]
+
+    def reserve(self, url : str) -> Tuple[bool, float]:
+        """Tries to reserve a request to the host of the url. Returns whether it was reserved and
+        how many seconds to wait before sending it, or before trying again."""
+        with self._lock:
+            bucket = self._get(get_host(url))
+            return bucket.reserve() if bucket is not None else (True, 0)
+
+    def acquire(self, url : str) -> None:
+        """Blocks until a request to the host of the url is allowed."""
+        reserved = False
+        while not reserved:
+            reserved, wait = self.reserve(url)
+            if wait > 0:
+                time.sleep(wait)
+
+    async def acquire_async(self, url : str) -> None:
+        import asyncio
+        reserved = False
+        while not reserved:
+            reserved, wait = self.reserve(url)
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+    def throttle(self, url : str, retry_after : Optional[str] = None) -> None:
+        """Slows down requests to a host that answered 429 or 503, honouring its Retry-After header."""
+        with self._lock:
+            bucket = self._get(get_host(url))
+            if bucket is not None:
+                bucket.throttle(parse_retry_after(retry_after))
+
+    def rates(self) -> Dict[str, float]:
+        """Returns the current rate of the hosts whose rate was lowered after throttling."""
+        with self._lock:
+            return { host : round(bucket.rate, 2) for host, bucket in self._buckets.items() if bucket is not None and bucket.rate < bucket.max_rate }
@@ -0,0 +1,300 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+# Error classes of retryable failures
+TIMEOUT = "timeout"
+CONNECTION = "connection"
+SERVER = "server"
+THROTTLED = "throttled"
+CIRCUIT_OPEN = "circuit_open"
+
+# Failures that count towards opening a host's circuit
+HOST_ERRORS = [TIMEOUT, CONNECTION, SERVER]
+
+def classify_status(status : int) -> Optional[str]:
+    """Returns the error class of a retryable response status."""
+    if status == 429:
+        return THROTTLED
+    if status in [500, 502, 503, 504]:
+        return SERVER
+    return None
+
+def get_host(url : str) -> str:
+    return urlsplit(url).netloc.lower()
+
+
+class Retry:
+    """The attempts made so far at a url."""
+
+    def __init__(self, url : str):
+        self.url : str = url
+        self.host : str = get_host(url)
+        self.attempt : int = 0
+        self.counts : Dict[str, int] = {}
+        self.reserved : bool = False # Whether the next attempt holds a rate limit token
+
+
+class RetryPolicy:
+    """Retry budgets per error class and jittered exponential backoff."""
+
+    DEFAULT_BUDGETS = {
+        TIMEOUT: 2,
+        CONNECTION: 2,
+        SERVER: 2,
+        THROTTLED: 3,
+        CIRCUIT_OPEN: 3,
+    }
+
+    def __init__(self, budgets : Dict[str, int] = None, base_delay : float = 0.5, max_delay : float = 30.0):
+        self.budgets : Dict[str, int] = dict(self.DEFAULT_BUDGETS, **(budgets or {}))
+        self.base_delay : float = base_delay
+        self.max_delay : float = max_delay
+
+    def backoff(self, error : str, retry : Retry) -> Optional[float]:
+        """Charges a failure to the retry budget of its error class and returns the delay before
+        the next attempt, or None once the budget is spent."""
+        retry.counts[error] = retry.counts.get(error, 0) + 1
+        if retry.counts[error] > self.budgets.get(error, 0):
+            return None
+        n_failures = sum(retry.counts.values())
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (n_failures - 1)))
+
+
+class CircuitBreaker:
+    """Stops requests to a host after consecutive failures until a cooldown has passed.
+    A single trial request is then let through, which closes the circuit if it succeeds."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold : int = 5, cooldown : float = 30.0):
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+        self.state : str = self.CLOSED
+        self.failures : int = 0
+        self.opened_at : float = 0
+
+    def wait_time(self) -> float:
+        """Returns how long to wait before requesting the host, claiming the trial request
+        when the cooldown has passed."""
+        if self.state == self.CLOSED:
+            return 0
+        remaining = self.opened_at + self._cooldown - time.monotonic()
+        if self.state == self.OPEN and remaining <= 0:
+            self.state = self.HALF_OPEN
+            return 0
+        # Waits for the trial request of a half open circuit
+        return max(remaining, 1.0)
+
+    def record(self, error : Optional[str]) -> None:
+        """Records the outcome of a request to the host."""
+        if error in HOST_ERRORS:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self._failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+        else:
+            self.failures = 0
+            self.state = self.CLOSED
+
+
+class HostCircuitBreakers:
+    """Thread safe circuit breakers per host."""
+
+    def __init__(self, failure_threshold : int = 5, cooldown : float = 30.0):
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+        self._breakers : Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, host : str) -> CircuitBreaker:
+        if host not in self._breakers:
+            self._breakers[host] = CircuitBreaker(self._failure_threshold, self._cooldown)
+        return self._breakers[host]
+
+    def wait_time(self, host : str) -> float:
+        with self._lock:
+            return self._get(host).wait_time()
+
+    def record(self, host : str, error : Optional[str]) -> None:
+        with self._lock:
+            self._get(host).record(error)
+
+    def open_hosts(self) -> Dict[str, int]:
+        """Returns the consecutive failures of hosts whose circuit is not closed."""
+        with self._lock:
+            return { host : breaker.failures for host, breaker in self._breakers.items() if breaker.state != CircuitBreaker.CLOSED }
+
+
+class RetryScheduler:
+    """Runs url attempts on a pool of worker threads.
+
+    Failed attempts are requeued with backoff instead of being retried in place, and urls of
+    hosts with an open circuit or without a rate limit token yet are deferred, so workers move
+    on to urls of healthy hosts. Passing max_pending makes submit block while that many urls
+    are waiting for a result, bounding the memory of a long stream of urls.
+
+    Passing an AdaptiveConcurrency instead of max_workers runs as many workers as its global
+    limit, and defers the urls of hosts that are at their own limit.
+
+    An attempt may return the future of its status, e.g. of a body handed to a writer pool.
+    The worker moves on, and the url finishes once the future is done.
+    """
+
+    def __init__(self, attempt : Callable[[str, int], Tuple[Union[int, Future], Optional[str]]], policy : RetryPolicy,
+                 breakers : HostCircuitBreakers, max_workers : int = 10, on_result : Callable[[str, int], None] = None,
+                 limiter = None, max_pending : int = None, concurrency = None):
+        self._attempt = attempt
+        self._policy = policy
+        self._breakers = breakers
+        self._limiter = limiter
+        self._max_workers = max_workers
+        self._max_pending = max_pending
+        self._concurrency = concurrency
+        self._on_result = on_result
+        self._heap = []
+        self._sequence = itertools.count()
+        self._pending : int = 0
+        self._closed : bool = False
+        lock = threading.Lock()
+        self._condition = threading.Condition(lock)
+        self._slot_freed = threading.Condition(lock) # Wakes a submit blocked by max_pending
+        self._workers = []
+        self._n_workers : int = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.join()
+
+    def start(self) -> None:
+        with self._condition:
+            for _ in range(self._concurrency.total.value if self._concurrency is not None else self._max_workers):
+                self._start_worker()
+
+    def _start_worker(self) -> None:
+        """Requires the condition lock."""
+        worker = threading.Thread(target=self._work, daemon=True)
+        worker.start()
+        self._workers = [ thread for thread in self._workers if thread.is_alive() ]
+        self._workers.append(worker)
+        self._n_workers += 1
+
+    def _resize(self) -> bool:
+        """Starts workers up to the concurrency limit. Returns True if the calling worker is
+        one too many and should stop."""
+        if self._concurrency is None:
+            return False
+        target = self._concurrency.total.value
+        with self._condition:
+            if self._n_workers > target:
+                self._n_workers -= 1
+                return True
+            while self._n_workers < target:
+                self._start_worker()
+        return False
+
+    def submit(self, url : str) -> None:
+        """Queues a url for download."""
+        with self._condition:
+            while self._max_pending and self._pending >= self._max_pending:
+                self._slot_freed.wait()
+            self._pending += 1
+            self._schedule(Retry(url), 0)
+
+    def join(self) -> None:
+        """Waits until every submitted url has a result and stops the workers."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        while True:
+            # Workers started while joining are joined as well
+            with self._condition:
+                if len(self._workers) == 0:
+                    break
+                worker = self._workers.pop()
+            worker.join()
+
+    def _schedule(self, retry : Retry, delay : float) -> None:
+        """Queues a retry to run after delay seconds. Requires the condition lock."""
+        heapq.heappush(self._heap, (time.monotonic() + delay, next(self._sequence), retry))
+        self._condition.notify()
+
+    def _next(self) -> Optional[Retry]:
+        """Blocks until a queued retry is due, returning None once all work is done."""
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if self._heap and self._heap[0][0] <= now:
+                    return heapq.heappop(self._heap)[2]
+                if self._closed and self._pending == 0:
+                    return None
+                timeout = self._heap[0][0] - now if self._heap else None
+                self._condition.wait(timeout)
+
+    def _requeue(self, retry : Retry, delay : float) -> None:
+        with self._condition:
+            self._schedule(retry, delay)
+
+    def _finish(self, retry : Retry, status : Union[int, Future]) -> None:
+        if isinstance(status, Future):
+            status.add_done_callback(lambda write: self._finish(retry, write.result()))
+            return
+        if self._on_result is not None:
+            self._on_result(retry.url, status)
+        with self._condition:
+            self._pending -= 1
+            self._slot_freed.notify()
+            if self._pending == 0:
+                self._condition.notify_all()
+
+    def _work(self) -> None:
+        retry = self._next()
+        while retry is not None:
+            if self._limiter is not None and not retry.reserved:
+                retry.reserved, wait = self._limiter.reserve(retry.url)
+                if wait > 0:
+                    self._requeue(retry, wait)
+                    retry = self._next()
+                    continue
+            wait = self._breakers.wait_time(retry.host)
+            if wait > 0:
+                if self._policy.backoff(CIRCUIT_OPEN, retry) is None:
+                    self._finish(retry, 503)
+                else:
+                    self._requeue(retry, wait)
+            elif self._concurrency is not None and not self._concurrency.try_acquire(retry.url):
+                wait = self._concurrency.wait_time(retry.url)
+                self._requeue(retry, wait)
+                # Pauses rather than spinning through the other urls of a busy host
+                time.sleep(wait)
+            else:
+                start = time.monotonic()
+                try:
+                    status, error = self._attempt(retry.url, retry.attempt)
+                except Exception as e:
+                    print(f"Unexpected exception at {retry.url}: {e!r}")
+                    status, error = 500, None
+                if self._concurrency is not None:
+                    self._concurrency.release(retry.url, time.monotonic() - start, error)
+                retry.reserved = False
+                self._breakers.record(retry.host, error)
+                delay = self._policy.backoff(error, retry) if error is not None else None
+                if delay is None:
+                    self._finish(retry, status)
+                else:
+                    retry.attempt += 1
+                    self._requeue(retry, delay)
+            if self._resize():
+                return
+            retry = self._next()
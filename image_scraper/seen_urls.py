@@ -0,0 +1,110 @@
+import hashlib
+import math
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+
+from typing import Iterator
+
+class SeenUrls:
+    """A persistent set of the urls handed to the downloaders of a save_path.
+
+    Urls are stored as 64 bit hashes in a SQLite table, fronted by a Bloom filter in a memory
+    mapped file. The filter answers most lookups of new urls without reading the table, and
+    its possible false positives are checked against the table, so membership is exact up to
+    64 bit hash collisions. The filter needs about 1.8 bytes per url at the default error rate.
+    """
+
+    BLOOM_FILE = ".seen_urls.bloom"
+    DB_FILE = ".seen_urls.sqlite3"
+    HEADER = struct.Struct("<4sQI")
+    MAGIC = b"SEEN"
+
+    def __init__(self, directory : str, capacity : int = 10_000_000, error_rate : float = 0.001):
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(directory, self.DB_FILE), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS urls (key INTEGER PRIMARY KEY)")
+        self._conn.commit()
+        self._n_bits = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2 / 8) * 8)
+        self._n_hashes = max(1, round(self._n_bits / capacity * math.log(2)))
+        self._file, self._bloom = self._open_bloom(os.path.join(directory, self.BLOOM_FILE))
+
+    def _open_bloom(self, path : str):
+        """Maps the Bloom filter file, rebuilding it from the table if it was sized differently."""
+        header = self.HEADER.pack(self.MAGIC, self._n_bits, self._n_hashes)
+        size = self.HEADER.size + self._n_bits // 8
+        file = open(path, "a+b")
+        file.seek(0)
+        rebuild = file.read(self.HEADER.size) != header or os.path.getsize(path) != size
+        if rebuild:
+            file.truncate(0)
+            file.truncate(size)
+        bloom = mmap.mmap(file.fileno(), size)
+        if rebuild:
+            bloom[:self.HEADER.size] = header
+            for (key,) in self._conn.execute("SELECT key FROM urls"):
+                self._set_bits(bloom, key)
+        return file, bloom
+
+    @staticmethod
+    def _key(url : str) -> int:
+        """Returns the signed 64 bit hash of a url, as stored in SQLite."""
+        return int.from_bytes(hashlib.blake2b(url.encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+
+    def _positions(self, key : int) -> Iterator[int]:
+        """Yields the filter bits of a key, derived from its two 32 bit halves."""
+        key &= 0xFFFFFFFFFFFFFFFF
+        h1, h2 = key & 0xFFFFFFFF, (key >> 32) | 1
+        for i in range(self._n_hashes):
+            yield (h1 + i * h2) % self._n_bits
+
+    def _set_bits(self, bloom : mmap.mmap, key : int) -> None:
+        for position in self._positions(key):
+            index = self.HEADER.size + (position >> 3)
+            bloom[index] |= 1 << (position & 7)
+
+    def _maybe_contains(self, key : int) -> bool:
+        for position in self._positions(key):
+            if not self._bloom[self.HEADER.size + (position >> 3)] & (1 << (position & 7)):
+                return False
+        return True
+
+    def _contains(self, key : int) -> bool:
+        if not self._maybe_contains(key):
+            return False
+        return self._conn.execute("SELECT 1 FROM urls WHERE key = ?", (key,)).fetchone() is not None
+
+    def __contains__(self, url : str) -> bool:
+        with self._lock:
+            return self._contains(self._key(url))
+
+    def add(self, url : str) -> bool:
+        """Adds a url, returning whether it was not in the set yet."""
+        key = self._key(url)
+        with self._lock:
+            if self._contains(key):
+                return False
+            # Another process may have added the url since the lookup
+            cursor = self._conn.execute("INSERT OR IGNORE INTO urls (key) VALUES (?)", (key,))
+            self._conn.commit()
+            self._set_bits(self._bloom, key)
+            return cursor.rowcount == 1
+
+    def remove(self, url : str) -> None:
+        """Removes a url, e.g. when its download failed and should be tried again in a later
+        run. Its filter bits are kept, so the lookup falls back to the table."""
+        with self._lock:
+            self._conn.execute("DELETE FROM urls WHERE key = ?", (self._key(url),))
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._bloom.flush()
+            self._bloom.close()
+            self._file.close()
+            self._conn.close()
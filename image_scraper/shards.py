@@ -0,0 +1,186 @@
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import tarfile
+import threading
+import time
+
+from collections import namedtuple
+from typing import Optional, Union
+
+from metrics import METRICS
+
+ShardEntry = namedtuple("ShardEntry", ["url", "shard", "offset", "length", "sha256", "name"])
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+# Two empty blocks end a tar archive
+END_OF_ARCHIVE = b"\0" * (2 * BLOCK_SIZE)
+
+
+class ShardIndex:
+    """An index of the images stored in the tar shards of a directory, giving random access
+    to an image by the url it was downloaded from."""
+
+    FILE_NAME = ".shards.sqlite3"
+
+    def __init__(self, directory : str):
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(directory, self.FILE_NAME), timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+                                url TEXT PRIMARY KEY,
+                                shard TEXT NOT NULL,
+                                offset INTEGER NOT NULL,
+                                length INTEGER NOT NULL,
+                                sha256 TEXT NOT NULL,
+                                name TEXT NOT NULL)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_sha256 ON entries (sha256)")
+        self._conn.commit()
+
+    def add(self, entry : ShardEntry) -> None:
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)", entry)
+            self._conn.commit()
+
+    def lookup(self, url : str) -> Optional[ShardEntry]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM entries WHERE url = ?", (url,)).fetchone()
+        return ShardEntry(*row) if row else None
+
+    def lookup_hash(self, sha256 : str) -> Optional[ShardEntry]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM entries WHERE sha256 = ? LIMIT 1", (sha256,)).fetchone()
+        return ShardEntry(*row) if row else None
+
+    def read(self, url : str) -> Optional[bytes]:
+        """Returns the image downloaded from a url, read from its shard."""
+        entry = self.lookup(url)
+        if entry is None:
+            return None
+        with open(os.path.join(self._directory, entry.shard), 'rb') as file:
+            file.seek(entry.offset)
+            return file.read(entry.length)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class ShardWriter:
+    """Appends images to size bounded tar shards, in the WebDataset layout of an image member
+    and a json member with its url per key.
+
+    Every writer appends to shards of its own, named after its host and process, so workers
+    sharing a directory never write to the same file. The end of archive blocks are written
+    after each image and overwritten by the next, so a shard is a valid tar at all times.
+    Each shard has a sidecar index.jsonl of the url, offset, length and hash of its images,
+    and the ShardIndex of the directory finds them by url. Images added with fsync are flushed
+    to the disk with the shard and its sidecar, and so is the directory entry of a new shard.
+    """
+
+    def __init__(self, directory : str, max_size : int = 1024 ** 3, index : ShardIndex = None):
+        os.makedirs(directory, exist_ok=True)
+        self._directory : str = directory
+        self._max_size : int = max_size
+        self.index : ShardIndex = index if index is not None else ShardIndex(directory)
+        self._writer_id : str = f"{socket.gethostname()}-{os.getpid()}"
+        self._lock = threading.Lock()
+        self._n_shards : int = 0
+        self._shard_name : Optional[str] = None
+        self._file = None
+        self._sidecar = None
+        self._end : int = 0 # Offset of the end of archive blocks
+
+    def _open_shard(self, fsync : bool = False) -> None:
+        """Creates the next shard of the writer, skipping the names already taken."""
+        self._close_shard()
+        while True:
+            self._shard_name = f"shard-{self._writer_id}-{self._n_shards:06d}.tar"
+            self._n_shards += 1
+            try:
+                self._file = open(os.path.join(self._directory, self._shard_name), 'xb')
+                break
+            except FileExistsError:
+                continue
+        self._sidecar = open(os.path.join(self._directory, self._shard_name + ".index.jsonl"), 'a', encoding='utf-8')
+        self._end = 0
+        if fsync:
+            with METRICS.time("fsync_seconds"):
+                fd = os.open(self._directory, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+    def _close_shard(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._sidecar.close()
+            self._file = self._sidecar = None
+
+    def _append(self, name : str, data, length : int) -> int:
+        """Writes a member at the end of the shard and returns the offset of its data."""
+        info = tarfile.TarInfo(name)
+        info.size = length
+        info.mtime = int(time.time())
+        header = info.tobuf(format=tarfile.PAX_FORMAT)
+        self._file.seek(self._end)
+        self._file.write(header)
+        offset = self._end + len(header)
+        if isinstance(data, bytes):
+            self._file.write(data)
+        else:
+            shutil.copyfileobj(data, self._file)
+        remainder = length % BLOCK_SIZE
+        if remainder:
+            self._file.write(b"\0" * (BLOCK_SIZE - remainder))
+        self._end = offset + length + (BLOCK_SIZE - remainder if remainder else 0)
+        return offset
+
+    def add(self, url : str, image : Union[str, bytes], sha256 : str, extension : str, fsync : bool = False) -> str:
+        """Appends an image, given as the path of its file or as its bytes, to the current
+        shard, starting a new shard once the current one has reached max_size. Returns the
+        path of the shard."""
+        length = len(image) if isinstance(image, bytes) else os.path.getsize(image)
+        key = sha256[:32]
+        name = f"{key}{extension}"
+        metadata = json.dumps({"url": url, "sha256": sha256}).encode("utf-8")
+        with self._lock:
+            if self._file is None or self._end >= self._max_size:
+                self._open_shard(fsync)
+            if isinstance(image, bytes):
+                offset = self._append(name, image, length)
+            else:
+                with open(image, 'rb') as image_file:
+                    offset = self._append(name, image_file, length)
+            self._append(f"{key}.json", metadata, len(metadata))
+            self._file.write(END_OF_ARCHIVE)
+            self._file.flush()
+            entry = ShardEntry(url, self._shard_name, offset, length, sha256, name)
+            self._sidecar.write(json.dumps(entry._asdict()) + "\n")
+            self._sidecar.flush()
+            if fsync:
+                with METRICS.time("fsync_seconds"):
+                    os.fsync(self._file.fileno())
+                    os.fsync(self._sidecar.fileno())
+            shard_path = os.path.join(self._directory, self._shard_name)
+        self.index.add(entry)
+        return shard_path
+
+    def add_url(self, url : str, sha256 : str) -> bool:
+        """Points a url at an image already stored with the same content. Returns False if no
+        image has that content."""
+        entry = self.index.lookup_hash(sha256)
+        if entry is None:
+            return False
+        self.index.add(entry._replace(url=url))
+        return True
+
+    def close(self) -> None:
+        with self._lock:
+            self._close_shard()
@@ -0,0 +1,118 @@
+import json
+import os
+import threading
+import time
+import validators
+
+from collections import Counter
+from typing import Dict, Iterator, List, Optional, Tuple
+
+class UrlStream:
+    """Reads the valid urls of a file with one url per line lazily and keeps track of the urls
+    in flight, so files of any size are downloaded in constant memory.
+
+    The checkpoint saves the byte offset of the first line whose url has not finished yet,
+    the statuses of the lines after it that have finished, and the status counts of all the
+    finished lines. A run started on the same file resumes from that offset, skipping the
+    lines that have finished, and the checkpoint is removed once the whole file is done.
+    """
+
+    def __init__(self, file_name : str, checkpoint_path : str = None, checkpoint_interval : float = 10):
+        self.file_name : str = file_name
+        self._checkpoint_path : str = checkpoint_path
+        self._checkpoint_interval : float = checkpoint_interval
+        self._lock = threading.Lock()
+        self._in_flight : Dict[str, List[int]] = {} # Line offsets of the urls being downloaded
+        self._finished : Dict[int, Optional[int]] = {} # Statuses of the lines finished after the checkpoint, None if invalid
+        self._resumed : Dict[int, Optional[int]] = {} # Lines that had finished after the checkpoint resumed from
+        self._offset : int = 0 # Offset of the next line to read
+        self._next : int = 0 # Offset of the first line not yet started
+        self._last_checkpoint : float = time.monotonic()
+        self.counts : Counter = Counter() # Status counts of the finished urls
+        self.n_invalid : int = 0
+        self.start_offset : int = self._load()
+
+    def _load(self) -> int:
+        """Returns the offset saved for the file, restoring its counts."""
+        if self._checkpoint_path is None or not os.path.isfile(self._checkpoint_path):
+            return 0
+        with open(self._checkpoint_path, encoding='utf-8') as file:
+            checkpoint = json.load(file)
+        if checkpoint["file"] != os.path.abspath(self.file_name) or checkpoint["offset"] > os.path.getsize(self.file_name):
+            return 0
+        self.counts = Counter({ int(status) : count for status, count in checkpoint["counts"].items() })
+        self.n_invalid = checkpoint["invalid"]
+        self._resumed = { int(line) : status for line, status in checkpoint.get("finished", {}).items() }
+        self._finished = dict(self._resumed)
+        return checkpoint["offset"]
+
+    def __iter__(self) -> Iterator[Tuple[int, str]]:
+        """Yields the offset and url of each valid line from the checkpoint on."""
+        with open(self.file_name, 'rb') as file:
+            file.seek(self.start_offset)
+            self._offset = self._next = self.start_offset
+            for line in iter(file.readline, b''):
+                offset = self._offset
+                self._offset += len(line)
+                if offset in self._resumed:
+                    # Finished and counted by the interrupted run
+                    with self._lock:
+                        self._next = self._offset
+                    continue
+                url = line.decode('utf-8', errors='replace').strip()
+                if validators.url(url):
+                    with self._lock:
+                        self._next = offset
+                    yield offset, url
+                elif url:
+                    with self._lock:
+                        self.n_invalid += 1
+                        self._finished[offset] = None
+
+    def start(self, url : str, offset : int) -> None:
+        """Records a url of the line at offset as in flight."""
+        with self._lock:
+            self._in_flight.setdefault(url, []).append(offset)
+            self._next = self._offset
+
+    def finish(self, url : str, status : int) -> None:
+        """Counts the status of an url in flight and saves a checkpoint every
+        checkpoint_interval seconds."""
+        with self._lock:
+            self.counts[status] += 1
+            offsets = self._in_flight[url]
+            self._finished[offsets.pop(0)] = status
+            if len(offsets) == 0:
+                del self._in_flight[url]
+            if time.monotonic() - self._last_checkpoint >= self._checkpoint_interval:
+                self._save()
+
+    @property
+    def n_in_flight(self) -> int:
+        with self._lock:
+            return sum(len(offsets) for offsets in self._in_flight.values())
+
+    def _save(self) -> None:
+        """Saves the checkpoint. Requires the lock."""
+        self._last_checkpoint = time.monotonic()
+        offset = min((min(offsets) for offsets in self._in_flight.values()), default=self._next)
+        # Lines finished after the offset are skipped on resume
+        self._finished = { line : status for line, status in self._finished.items() if line >= offset }
+        if self._checkpoint_path is None:
+            return
+        checkpoint = {"file": os.path.abspath(self.file_name), "offset": offset, "counts": self.counts, "invalid": self.n_invalid,
+                      "finished": self._finished}
+        tmp_path = self._checkpoint_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(checkpoint, file)
+        os.replace(tmp_path, self._checkpoint_path)
+
+    def checkpoint(self) -> None:
+        """Saves the checkpoint now."""
+        with self._lock:
+            self._save()
+
+    def complete(self) -> None:
+        """Removes the checkpoint once every url of the file has finished."""
+        if self._checkpoint_path is not None and os.path.exists(self._checkpoint_path):
+            os.remove(self._checkpoint_path)
@@ -1,13 +1,47 @@
 import time
 import functools
 
-class Tabulate:
-    #TODO
-    def __init__(self):
-        pass
+from typing import AsyncIterator, Dict
+
+from metrics import METRICS
+
+def tabulate(rows : Dict, headers=("STATUS", "TOTAL"), min_width=8) -> None:
+    """Prints a two column summary table of the given rows."""
+    if len(rows) == 0:
+        return
+    width = max(max(map(len, [str(k) for k in rows.keys()] + [headers[0]])), min_width)
+    print(f"\n {headers[0]:>{width}} | {headers[1]:<{width}}")
+    print(" {}+{}".format('='*(width+1),'='*(width+1)))
+    for k,v in rows.items():
+        print(f" {k:>{width}} | {v:<{width}}")
+
+async def merge_async_iterators(*iterators : AsyncIterator) -> AsyncIterator:
+    """Yields the items of several async iterators in the order they arrive."""
+    import asyncio
+    merged = asyncio.Queue()
+    done = object()
+    
+    async def pump(iterator):
+        try:
+            async for item in iterator:
+                await merged.put(item)
+        finally:
+            await merged.put(done)
+    
+    tasks = [ asyncio.ensure_future(pump(iterator)) for iterator in iterators ]
+    remaining = len(tasks)
+    while remaining > 0:
+        item = await merged.get()
+        if item is done:
+            remaining -= 1
+        else:
+            yield item
+    # Raises any exception from the iterators
+    await asyncio.gather(*tasks)
 
 def timer(function_without_args=None, *args, **kwargs):
-    """Decorator function that times the functions."""
+    """Decorator function that times the functions, recording the durations in the
+    function_seconds histogram. Pass verbose=True to print them as well."""
     # print(type(func_no_args), len(args), len(kwargs))
     precision = {
         's': 1,
@@ -16,19 +50,23 @@ def timer(function_without_args=None, *args, **kwargs):
     # Default args
     unit = 'ms'
     rnd = 0
+    verbose = False
     
     def _decorate(func):
         
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            start = time.time()
-            result = func(*args, **kwargs)
-            end = time.time()
-            diff = (end-start) * precision[unit]
-            if rnd:
-                diff = round(diff,rnd)
-            print(f'\'{func.__name__}\' finished in {diff} {unit}')
-            return result
+            start = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                seconds = time.monotonic() - start
+                METRICS.observe("function_seconds", seconds, function=func.__qualname__)
+                if verbose:
+                    diff = seconds * precision[unit]
+                    if rnd:
+                        diff = round(diff,rnd)
+                    print(f'\'{func.__name__}\' finished in {diff} {unit}')
         return wrapper
     
     if function_without_args:
@@ -38,5 +76,7 @@ def timer(function_without_args=None, *args, **kwargs):
         unit = kwargs['unit']
     if 'round' in kwargs:
         rnd = kwargs['round']
+    if 'verbose' in kwargs:
+        verbose = kwargs['verbose']
     
     return _decorate
\ No newline at end of file
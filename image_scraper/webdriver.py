@@ -1,17 +1,30 @@
 import asyncio
+import contextlib
 import re
 import sys
+import threading
 import time
 
-from typing import Dict
+from typing import AsyncIterator, Callable, Dict, List, Tuple
 from tqdm import tqdm
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 
 from config import Config
+from metrics import METRICS
+from rate_limit import HostRateLimiter
 
 TEST_LIMIT = 50
 
+# Returns the page height, the number of image nodes and the milliseconds since a resource last finished loading
+PAGE_STATE_SCRIPT = """
+if (window.__lastResourceLoad === undefined) {
+    window.__lastResourceLoad = performance.now();
+    new PerformanceObserver(function() { window.__lastResourceLoad = performance.now(); }).observe({entryTypes: ['resource']});
+}
+return [document.body.scrollHeight, document.images.length, performance.now() - window.__lastResourceLoad];
+"""
+
 class WaitTest:
     """A custom Wait condition object to be passed in selenium WebDriverWait object."""
     
@@ -29,6 +42,54 @@ class WaitTest:
             return False
 
 
+# Returns the new src of img elements matching a selector and src prefix, remembering those
+# already returned, so pages that remove off-screen elements can be harvested while scrolling
+HARVEST_SCRIPT = """
+var selector = arguments[0], prefix = arguments[1];
+window.__harvestedSources = window.__harvestedSources || new Set();
+var sources = [];
+document.querySelectorAll(selector).forEach(function(img) {
+    var src = img.getAttribute('src');
+    if (src && src.indexOf(prefix) === 0 && !window.__harvestedSources.has(src)) {
+        window.__harvestedSources.add(src);
+        sources.push(src);
+    }
+});
+return sources;
+"""
+
+
+class ScrollStats:
+    """Timing counters of the scroll steps of a page.
+    
+    Each step waits until new content has loaded (loading time), or until the network is idle
+    or the step's sleep has run out without new content (idle time).
+    """
+    
+    LOADED = "loaded"
+    NETWORK_IDLE = "network_idle"
+    TIMEOUT = "timeout"
+    
+    def __init__(self):
+        self.steps : List[Tuple[str, float]] = [] # (outcome, seconds waited)
+    
+    def record(self, outcome : str, elapsed : float) -> None:
+        self.steps.append((outcome, elapsed))
+    
+    def total(self, *outcomes : str) -> float:
+        """Returns the seconds waited in steps with the given outcomes."""
+        return sum(elapsed for outcome, elapsed in self.steps if outcome in outcomes)
+    
+    def count(self, outcome : str) -> int:
+        return sum(1 for step_outcome, _ in self.steps if step_outcome == outcome)
+    
+    def summary(self) -> str:
+        loading = self.total(self.LOADED)
+        idle = self.total(self.NETWORK_IDLE, self.TIMEOUT)
+        return (f"{len(self.steps)} scroll steps in {loading + idle:.1f}s "
+                f"(loading {loading:.1f}s, idle waiting {idle:.1f}s, {self.count(self.TIMEOUT)} timeouts)")
+
+
 class WebDriver(Config): 
     
     # Config variables
@@ -37,15 +98,59 @@ class WebDriver(Config):
     # self.iterate_sleep
     # self.load_sleep
     # self.webdriverwait_sleep
+    # self.poll_interval
+    # self.network_idle
+    # self.max_busy_timeouts
+    
+    poll_interval = 0.1
+    network_idle = 0.5
+    max_busy_timeouts = 2
     
-    def __init__(self, driver_config : Dict):
+    def __init__(self, driver_config : Dict, rate_limiter : HostRateLimiter = None):
         """Initialises the Driver class."""
         super().__init__(driver_config)
+        self.rate_limiter : HostRateLimiter = rate_limiter # Paces page loads with the image downloads
         self.driver = self._initialise_driver() # Selenium webdriver object
+        self.uses : int = 0 # Number of searches the browser session has been leased for
+        self.scroll_stats : ScrollStats = ScrollStats() # Scroll steps of the current page
         
     def __del__(self):
         """Deconstructs the Driver class."""
-        self.driver.close()
+        self.quit()
+    
+    def quit(self) -> None:
+        """Closes the browser session."""
+        if getattr(self, "driver", None) is not None:
+            try:
+                self.driver.quit()
+            except Exception:
+                pass
+            self.driver = None
+    
+    def configure(self, driver_config : Dict) -> None:
+        """Applies the search engine settings of a driver config to the session."""
+        Config.__init__(self, driver_config)
+    
+    def is_healthy(self) -> bool:
+        """Checks whether the browser session still responds."""
+        try:
+            return self.driver.execute_script("return 1;") == 1
+        except Exception:
+            return False
+    
+    def reset(self) -> None:
+        """Clears cookies and storage so the session can be reused by another search."""
+        try:
+            self.driver.execute_script("window.localStorage.clear(); window.sessionStorage.clear();")
+        except Exception:
+            pass
+        try:
+            self.driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+            self.driver.execute_cdp_cmd("Storage.clearDataForOrigin", {"origin": "*", "storageTypes": "all"})
+        except Exception:
+            # Only clears the cookies of the current domain
+            self.driver.delete_all_cookies()
+        self.driver.get("about:blank")
     
     
     def _initialise_driver(self):
@@ -57,7 +162,8 @@ class WebDriver(Config):
             chrome_options.add_argument('--disk-cache-size=0')
             
             try:
-                driver = webdriver.Chrome(executable_path=self.path, options=chrome_options)
+                with METRICS.time("driver_startup_seconds"):
+                    driver = webdriver.Chrome(executable_path=self.path, options=chrome_options)
                 driver.set_window_size(1920, 1080)
                 driver.delete_all_cookies()
                 return driver
@@ -69,9 +175,13 @@ class WebDriver(Config):
             raise Exception("Driver is not Chrome")
     
     
-    def get(self, url) -> None:
-        """Executes driver.get(url)"""
-        self.driver.get(url)
+    async def get(self, url) -> None:
+        """Executes driver.get(url) once the rate limiter allows it, without blocking the event loop while waiting."""
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire_async(url)
+        with METRICS.time("page_load_seconds"):
+            self.driver.get(url)
+        self.scroll_stats = ScrollStats()
     
         
     def get_page_source(self) -> str:
@@ -85,68 +195,126 @@ class WebDriver(Config):
         await asyncio.sleep(self.load_sleep)
     
     
+    def harvest_image_sources(self, selector : str, prefix : str) -> List[str]:
+        """Returns the src of image elements matching the css selector and src prefix that
+        are in the DOM now and were not returned by a previous call on the page."""
+        return self.driver.execute_script(HARVEST_SCRIPT, selector, prefix)
+    
+    def get_page_state(self) -> Tuple[int, int, float]:
+        """Returns the page height, the number of image nodes and the milliseconds since the
+        last resource finished loading."""
+        height, n_images, ms_since_load = self.driver.execute_script(PAGE_STATE_SCRIPT)
+        return height, n_images, ms_since_load
+    
+    async def wait_for_element(self, by : str, value : str, timeout : float):
+        """Waits for an element to be in the page for at most timeout seconds, returning it or None."""
+        start = time.monotonic()
+        while True:
+            elements = self.driver.find_elements(by, value)
+            if len(elements) > 0:
+                return elements[0]
+            if time.monotonic() - start >= timeout:
+                return None
+            await asyncio.sleep(self.poll_interval)
+    
+    async def wait_for_page_change(self, height : int, n_images : int, max_sleep : float) -> str:
+        """Waits until the page grows or has new image nodes, the network is idle, or max_sleep
+        seconds have passed. Records and returns the outcome."""
+        start = time.monotonic()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            elapsed = time.monotonic() - start
+            new_height, new_n_images, ms_since_load = self.get_page_state()
+            if new_height != height or new_n_images > n_images:
+                outcome = ScrollStats.LOADED
+            elif ms_since_load >= self.network_idle * 1000 and elapsed >= self.network_idle:
+                outcome = ScrollStats.NETWORK_IDLE
+            elif elapsed >= max_sleep:
+                outcome = ScrollStats.TIMEOUT
+            else:
+                continue
+            self.scroll_stats.record(outcome, elapsed)
+            METRICS.observe("scroll_step_seconds", elapsed, outcome=outcome)
+            return outcome
+    
     async def scroll_to_bottom(self) -> None:
         """Scrolls to the bottom of the page."""
-        new_height = self.driver.execute_script("return document.body.scrollHeight")
-        prev_height = 0
+        async for _ in self.iter_scroll_to_bottom():
+            pass
+    
+    async def iter_scroll_to_bottom(self) -> AsyncIterator[None]:
+        """Scrolls to the bottom of the page, yielding after each scroll step. Each step waits
+        for new content for at most load_sleep seconds, and scrolling stops once a step ends
+        with the network idle."""
+        height, n_images, _ = self.get_page_state()
         # TODO: Implement verbose
         # print("> Scrolling to the bottom of the page...")
-        while((new_height != prev_height) and (new_height < self.scroll_limit)):
-            prev_height = new_height
+        busy_timeouts = 0
+        while height < self.scroll_limit:
             self.driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-            await asyncio.sleep(self.load_sleep) # TODO: Check optimal sleep value
-            new_height = self.driver.execute_script("return document.body.scrollHeight")
-            # print("  Page height: ",new_height, sep='',end='\r',flush=True)
-        # print("\n> Scroll complete")
+            outcome = await self.wait_for_page_change(height, n_images, self.load_sleep)
+            yield
+            if outcome == ScrollStats.NETWORK_IDLE:
+                break
+            if outcome == ScrollStats.TIMEOUT:
+                # Slow pages are still loading, so gives them a few more steps
+                busy_timeouts += 1
+                if busy_timeouts > self.max_busy_timeouts:
+                    break
+            else:
+                busy_timeouts = 0
+            height, n_images, _ = self.get_page_state()
+            # print("  Page height: ",height, sep='',end='\r',flush=True)
+        print(f"> {self.scroll_stats.summary()}")
         
     async def scroll_to_element(self, expectation) -> None:
         """Scrolls down the page until an expected element has been detected."""
-        from selenium.webdriver.support import expected_conditions as EC
-        from selenium.common.exceptions import NoSuchElementException
-        
+        async for _ in self.iter_scroll_to_element(expectation):
+            pass
+    
+    async def iter_scroll_to_element(self, expectation) -> AsyncIterator[None]:
+        """Scrolls down the page until an expected element has been detected, yielding after
+        each scroll step. Scrolling stops without the element once undetect_limit steps in a
+        row have not grown the page."""
         # print("> Scrolling down the page to an element...")
-        detected = False
         count = 0
-        while not detected:
+        height = 0
+        while height < self.scroll_limit:
+            height, n_images, _ = self.get_page_state()
             self.driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-            await asyncio.sleep(self.iterate_sleep)
-            try: 
-                element = self.driver.find_element(expectation[0], expectation[1])
-                detected = True
-            except NoSuchElementException as e:
-                count += 1
-                if count < self.undetect_limit:
-                    pass
-                else:
-                    print("Webdriver Error: Exceeded undetect limit for the expectation.")
-                    print(e.msg)
-                    sys.exit()
-            except Exception as e:
-                print(e)
-                sys.exit(1)
-        print("Element found: ", end='')
-        element = self.driver.find_element(expectation[0],expectation[1])
-        print(element.get_attribute("outerHTML").replace(element.get_attribute("innerHTML"),''))
+            outcome = await self.wait_for_page_change(height, n_images, self.iterate_sleep)
+            yield
+            elements = self.driver.find_elements(expectation[0], expectation[1])
+            if len(elements) > 0:
+                print("Element found: ", end='')
+                print(elements[0].get_attribute("outerHTML").replace(elements[0].get_attribute("innerHTML"),''))
+                break
+            # Steps that load more of the page do not count towards the limit
+            count = 0 if outcome == ScrollStats.LOADED else count + 1
+            if count >= self.undetect_limit:
+                print("> Expected element not found before the page stopped growing.")
+                break
+        print(f"> {self.scroll_stats.summary()}")
         # print("> Scroll complete")    
     
-    async def click_and_get_elements(self, click_by, click_condition, save_xpath=None, save_attr=None, save_condition_regex=None, description=None) -> None:
-        """Clicks on an identified element and gets elements as string if condition is given."""
+    async def iter_click_and_get_elements(self, click_by, click_condition, save_xpath=None, save_attr=None, save_condition_regex=None, description=None) -> AsyncIterator[Tuple[str, str]]:
+        """Clicks on identified elements, yielding (element, None) for each element saved as string if
+        a condition is given and (None, exception name) for each failed click."""
         
         BY = ["id", "xpath", "link text", "partial link text", "name", "tag name", "class name", "css selector"]
         if click_by not in BY:
             raise ValueError("click_by: must be one of %r." % BY)
         
         from selenium.webdriver.support.ui import WebDriverWait
-        from selenium.common.exceptions import ElementNotInteractableException, ElementClickInterceptedException, TimeoutException
+        from selenium.common.exceptions import TimeoutException
         
         click_elements = self.driver.find_elements(click_by, click_condition)
-        save_elements = list()
-        exceptions = list()
         
         # if len(click_elements) > TEST_LIMIT:
         #     click_elements = click_elements[:TEST_LIMIT]
         disable_status = True if description is None else False
         for element in tqdm(click_elements, desc=description, disable=disable_status):
+            start = time.monotonic()
             try:
                 if not element.is_displayed() or not element.is_enabled():
                     self.driver.execute_script("arguments[0].scrollIntoView();", element)
@@ -159,25 +327,114 @@ class WebDriver(Config):
                         found_element = WebDriverWait(self.driver, self.webdriverwait_sleep).until(
                             WaitTest(save_xpath, save_attr, save_condition_regex)
                         )
-                        save_elements += [found_element.get_attribute("outerHTML").replace(found_element.get_attribute("innerHTML"),'')]
+                        METRICS.observe("thumbnail_click_seconds", time.monotonic() - start)
+                        yield found_element.get_attribute("outerHTML").replace(found_element.get_attribute("innerHTML"),''), None
                     except TimeoutException:
                         err = sys.exc_info()[0]
                         err_str = "{} : Did not find element".format(err.__name__)
-                        exceptions.append(err_str)
-            except ElementNotInteractableException as e:
-                err = sys.exc_info()[0]
-                err_str = err.__name__
-                exceptions.append(err_str)
-            except ElementClickInterceptedException as e:
-                err = sys.exc_info()[0]
-                err_str = err.__name__
-                exceptions.append(err_str)
+                        METRICS.inc("thumbnail_click_errors_total", error=err.__name__)
+                        yield None, err_str
             except Exception as e:
                 err = sys.exc_info()[0]
                 err_str = err.__name__
+                METRICS.inc("thumbnail_click_errors_total", error=err_str)
+                yield None, err_str
+    
+    async def click_and_get_elements(self, click_by, click_condition, save_xpath=None, save_attr=None, save_condition_regex=None, description=None) -> None:
+        """Clicks on an identified element and gets elements as string if condition is given."""
+        save_elements = list()
+        exceptions = list()
+        async for element, err_str in self.iter_click_and_get_elements(click_by, click_condition, save_xpath, save_attr, save_condition_regex, description):
+            if err_str is None:
+                save_elements.append(element)
+            else:
                 exceptions.append(err_str)
                 
         if (save_xpath and save_attr and save_condition_regex):
             return save_elements, exceptions
-        # return exceptions
-        # print(element.get_attribute("outerHTML").replace(element.get_attribute("innerHTML"),''))
\ No newline at end of file
+
+
+class WebDriverPool:
+    """A pool of warm browser sessions leased to searches.
+    
+    Sessions are started on demand up to pool_size, reset between searches, and replaced
+    when they fail a health check or have been used max_uses times.
+    """
+    
+    def __init__(self, driver_config : Dict, pool_size : int = 1, max_uses : int = 20, rate_limiter : HostRateLimiter = None,
+                 driver_factory : Callable[..., WebDriver] = WebDriver):
+        self._driver_config : Dict = driver_config
+        self._driver_factory : Callable[..., WebDriver] = driver_factory
+        self._rate_limiter : HostRateLimiter = rate_limiter
+        self._pool_size : int = pool_size
+        self._max_uses : int = max_uses
+        self._idle : List[WebDriver] = []
+        self._n_drivers : int = 0
+        self._condition = threading.Condition()
+    
+    def acquire(self, driver_config : Dict = None) -> WebDriver:
+        """Leases a healthy browser session, waiting for one if all sessions are leased."""
+        with self._condition:
+            while len(self._idle) == 0 and self._n_drivers >= self._pool_size:
+                self._condition.wait()
+            driver = self._idle.pop() if len(self._idle) > 0 else None
+            if driver is None:
+                self._n_drivers += 1
+        if driver is not None and not driver.is_healthy():
+            driver.quit()
+            driver = None
+        if driver is None:
+            try:
+                driver = self._driver_factory(self._driver_config, rate_limiter=self._rate_limiter)
+            except BaseException:
+                with self._condition:
+                    self._n_drivers -= 1
+                    self._condition.notify()
+                raise
+        if driver_config is not None:
+            driver.configure(driver_config)
+        driver.uses += 1
+        return driver
+    
+    def release(self, driver : WebDriver) -> None:
+        """Returns a leased session to the pool, recycling it once it is worn out or broken."""
+        recycle = driver.uses >= self._max_uses
+        if not recycle:
+            try:
+                driver.reset()
+            except Exception:
+                recycle = True
+        with self._condition:
+            if recycle:
+                driver.quit()
+                self._n_drivers -= 1
+            else:
+                self._idle.append(driver)
+            self._condition.notify()
+    
+    async def acquire_async(self, driver_config : Dict = None) -> WebDriver:
+        """Leases a session without blocking the event loop, waiting for it and starting its
+        browser on a thread."""
+        future = asyncio.get_running_loop().run_in_executor(None, self.acquire, driver_config)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # A session leased after the search was cancelled goes back to the pool
+            future.add_done_callback(lambda leased: self.release(leased.result()) if leased.exception() is None else None)
+            raise
+    
+    @contextlib.asynccontextmanager
+    async def lease(self, driver_config : Dict = None) -> AsyncIterator[WebDriver]:
+        driver = await self.acquire_async(driver_config)
+        try:
+            yield driver
+        finally:
+            self.release(driver)
+    
+    def close(self) -> None:
+        """Closes all idle sessions."""
+        with self._condition:
+            for driver in self._idle:
+                driver.quit()
+            self._n_drivers -= len(self._idle)
+            self._idle = []
@@ -0,0 +1,141 @@
+import abc
+import sqlite3
+import threading
+import time
+
+from collections import namedtuple
+from typing import Dict, Iterable, List
+
+WorkItem = namedtuple("WorkItem", ["id", "kind", "value", "attempts"])
+
+# Kinds of the work items
+URL = "url"
+QUERY = "query"
+
+# States of work items
+QUEUED = "queued"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+class WorkQueue(abc.ABC):
+    """A queue of work items shared by several workers.
+
+    Workers lease items for lease_timeout seconds and acknowledge them once done. Items whose
+    lease expires, e.g. because their worker died, are leased again to another worker, until
+    they have been leased max_attempts times.
+    """
+
+    @abc.abstractmethod
+    def put(self, values : Iterable[str], kind : str = URL) -> int:
+        """Queues the values that are not queued yet and returns how many were added."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def lease(self, worker_id : str, n : int = 1, kind : str = URL) -> List[WorkItem]:
+        """Leases up to n queued or expired items to a worker."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def heartbeat(self, worker_id : str) -> None:
+        """Extends the leases of a worker that is still working on its items."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def ack(self, worker_id : str, item : WorkItem, status : int = None, failed : bool = False) -> bool:
+        """Marks an item leased by a worker as done, or as failed. Returns False when the lease was
+        lost, e.g. it expired and the item was leased to another worker."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def release(self, worker_id : str) -> None:
+        """Queues the items still leased by a worker again, e.g. when it stops early."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def counts(self, kind : str = URL) -> Dict[str, int]:
+        """Returns the number of items per state."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class SqliteWorkQueue(WorkQueue):
+    """A work queue in a SQLite database in WAL mode, shared by the processes that open the file.
+
+    Leases are taken in IMMEDIATE transactions so two workers never lease the same item. The
+    file should be on a local disk, since SQLite locking is unreliable on network file systems.
+    """
+
+    def __init__(self, path : str, lease_timeout : float = 300, max_attempts : int = 3):
+        self._lease_timeout = lease_timeout
+        self._max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS items (
+                                id INTEGER PRIMARY KEY,
+                                kind TEXT NOT NULL,
+                                value TEXT NOT NULL,
+                                state TEXT NOT NULL DEFAULT 'queued',
+                                worker TEXT,
+                                lease_expires REAL,
+                                attempts INTEGER NOT NULL DEFAULT 0,
+                                status INTEGER,
+                                UNIQUE (kind, value))""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS items_state ON items (kind, state, lease_expires)")
+
+    def put(self, values : Iterable[str], kind : str = URL) -> int:
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.executemany("INSERT OR IGNORE INTO items (kind, value) VALUES (?, ?)", ((kind, value) for value in values))
+            self._conn.execute("COMMIT")
+            return self._conn.total_changes - before
+
+    def lease(self, worker_id : str, n : int = 1, kind : str = URL) -> List[WorkItem]:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Items leased max_attempts times kill their workers or never finish
+                self._conn.execute("UPDATE items SET state = ?, worker = NULL WHERE kind = ? AND state = ? AND lease_expires < ? AND attempts >= ?",
+                                   (FAILED, kind, LEASED, now, self._max_attempts))
+                rows = self._conn.execute("""SELECT id, kind, value, attempts FROM items
+                                             WHERE kind = ? AND (state = ? OR (state = ? AND lease_expires < ?))
+                                             ORDER BY id LIMIT ?""", (kind, QUEUED, LEASED, now, n)).fetchall()
+                self._conn.executemany("UPDATE items SET state = ?, worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+                                       [ (LEASED, worker_id, now + self._lease_timeout, row[0]) for row in rows ])
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [ WorkItem(id, kind, value, attempts + 1) for id, kind, value, attempts in rows ]
+
+    def heartbeat(self, worker_id : str) -> None:
+        with self._lock:
+            self._conn.execute("UPDATE items SET lease_expires = ? WHERE state = ? AND worker = ?",
+                               (time.time() + self._lease_timeout, LEASED, worker_id))
+
+    def ack(self, worker_id : str, item : WorkItem, status : int = None, failed : bool = False) -> bool:
+        with self._lock:
+            cursor = self._conn.execute("UPDATE items SET state = ?, worker = NULL, lease_expires = NULL, status = ? WHERE id = ? AND state = ? AND worker = ?",
+                                        (FAILED if failed else DONE, status, item.id, LEASED, worker_id))
+        return cursor.rowcount == 1
+
+    def release(self, worker_id : str) -> None:
+        with self._lock:
+            self._conn.execute("UPDATE items SET state = ?, worker = NULL, lease_expires = NULL, attempts = attempts - 1 WHERE state = ? AND worker = ?",
+                               (QUEUED, LEASED, worker_id))
+
+    def counts(self, kind : str = URL) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT state, COUNT(*) FROM items WHERE kind = ? GROUP BY state", (kind,)).fetchall()
+        return dict(rows)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,157 @@
+import collections
+import os
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Deque, Dict, Tuple
+
+from metrics import METRICS
+
+if TYPE_CHECKING:
+    import asyncio
+
+# Fsync modes
+OFF = "off" # Atomic renames only, files may be lost on power failure
+ALWAYS = "always" # Each file and its directory entry are flushed before the image counts as saved
+BATCH = "batch" # Each file is flushed before its rename, directory entries once per batch
+
+FSYNC_MODES = [OFF, ALWAYS, BATCH]
+
+class WriterPool:
+    """A bounded pool of threads that saves the fetched images, so a slow disk does not hold
+    up the network workers.
+
+    submit blocks while queue_size writes are waiting, which bounds the memory of bodies kept
+    in memory. Directory entries are flushed once per fsync_batch renames in the batch mode,
+    and whenever the queue runs empty, so a quiet pool leaves nothing unflushed. The
+    downloaders of a process share one pool of each configuration, see shared_writer_pool.
+    """
+
+    def __init__(self, workers : int = 4, queue_size : int = 64, fsync : str = OFF, fsync_batch : int = 64):
+        if fsync not in FSYNC_MODES:
+            raise ValueError("fsync: must be one of %r." % FSYNC_MODES)
+        self.fsync : str = fsync
+        self.queue_size : int = queue_size
+        self._fsync_batch : int = fsync_batch
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="writer")
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+        self._free_slots : int = queue_size
+        self._async_waiters : Deque[Tuple["asyncio.AbstractEventLoop", "asyncio.Future"]] = collections.deque()
+        self._queued : int = 0
+        self._unsynced : Dict[str, int] = {} # Renames per directory since its last fsync
+        self.closed : bool = False
+
+    def _acquire(self) -> None:
+        with self._lock:
+            while self._free_slots == 0:
+                self._slot_freed.wait()
+            self._free_slots -= 1
+
+    async def acquire_async(self) -> None:
+        """Waits for a free slot on the event loop, for a write submitted with block=False."""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._free_slots > 0 and len(self._async_waiters) == 0:
+                self._free_slots -= 1
+                return
+            future = loop.create_future()
+            self._async_waiters.append((loop, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release() # The slot was handed over as the task was cancelled
+            raise
+
+    def _release(self) -> None:
+        """Hands a freed slot to the next coroutine waiting for one, or to a waiting thread."""
+        with self._lock:
+            while len(self._async_waiters) > 0:
+                loop, future = self._async_waiters.popleft()
+                if not future.cancelled() and not loop.is_closed():
+                    loop.call_soon_threadsafe(self._hand_over, future)
+                    return
+            self._free_slots += 1
+            self._slot_freed.notify()
+
+    def _hand_over(self, future : "asyncio.Future") -> None:
+        if future.cancelled():
+            self._release()
+        else:
+            future.set_result(None)
+
+    def submit(self, write : Callable, *args, block : bool = True) -> Future:
+        """Queues a write and returns the future of its result. Passing block=False submits on
+        a slot already taken with acquire_async."""
+        if block:
+            self._acquire()
+        with self._lock:
+            self._queued += 1
+        METRICS.add("writes_queued", 1)
+        future = self._executor.submit(self._run, write, time.monotonic(), args)
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+    def _run(self, write : Callable, queued : float, args):
+        METRICS.observe("write_queue_seconds", time.monotonic() - queued)
+        METRICS.add("writes_queued", -1)
+        try:
+            with METRICS.time("write_seconds"):
+                return write(*args)
+        finally:
+            with self._lock:
+                self._queued -= 1
+                idle = self._queued == 0
+            if idle:
+                self.flush()
+
+    def renamed(self, directory : str) -> None:
+        """Flushes the directory of a renamed file as the fsync mode requires."""
+        if self.fsync == ALWAYS:
+            self._sync_directory(directory)
+        elif self.fsync == BATCH:
+            with self._lock:
+                self._unsynced[directory] = self._unsynced.get(directory, 0) + 1
+                full = self._unsynced[directory] >= self._fsync_batch
+                if full:
+                    del self._unsynced[directory]
+            if full:
+                self._sync_directory(directory)
+
+    def flush(self) -> None:
+        """Flushes the directories with renames not flushed yet."""
+        with self._lock:
+            directories, self._unsynced = list(self._unsynced), {}
+        for directory in directories:
+            self._sync_directory(directory)
+
+    def _sync_directory(self, directory : str) -> None:
+        with METRICS.time("fsync_seconds"):
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def shutdown(self) -> None:
+        self.closed = True
+        self._executor.shutdown(wait=True)
+        self.flush()
+
+
+# Writer pools of the process, by configuration
+_shared_pools : Dict[Tuple, WriterPool] = {}
+_shared_pools_lock = threading.Lock()
+
+def shared_writer_pool(workers : int = 4, queue_size : int = 64, fsync : str = OFF, fsync_batch : int = 64) -> WriterPool:
+    """Returns the writer pool of the process with the given configuration, so downloaders,
+    e.g. those of the queries of a batch, share its threads and its bound on queued bodies."""
+    key = (workers, queue_size, fsync, fsync_batch)
+    with _shared_pools_lock:
+        pool = _shared_pools.get(key)
+        if pool is None or pool.closed:
+            pool = _shared_pools[key] = WriterPool(*key)
+        return pool
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The package modules import each other as top level modules, as when run with `python image_scraper`
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "image_scraper"))
@@ -0,0 +1,73 @@
+import hashlib
+import http.server
+import re
+import threading
+
+from typing import Dict, List
+
+class ImageHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the bodies of the server's images with an ETag and Range support, or answers with
+    the status set for a path. A status of 302 redirects the path to itself."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status : int, body : bytes = b"", headers : Dict = None) -> None:
+        self.send_response(status)
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server.image_server
+        server.requests.append((self.path, dict(self.headers)))
+        status = server.statuses.get(self.path)
+        if status == 302:
+            self.send_body(302, headers={"Location": self.path})
+            return
+        if status is not None:
+            self.send_body(status)
+            return
+        body = server.images.get(self.path)
+        if body is None:
+            self.send_body(404)
+            return
+        etag = '"%s"' % hashlib.sha256(body).hexdigest()[:16]
+        headers = {"Content-Type": "image/jpeg", "ETag": etag, "Accept-Ranges": "bytes"}
+        match = re.match(r"^bytes=(\d+)-$", self.headers.get("Range", ""))
+        if match is not None and self.headers.get("If-Range") in [None, etag]:
+            start = int(match.group(1))
+            if start >= len(body):
+                self.send_body(416, headers={"Content-Range": f"bytes */{len(body)}"})
+                return
+            headers["Content-Range"] = f"bytes {start}-{len(body) - 1}/{len(body)}"
+            self.send_body(206, body[start:], headers)
+            return
+        self.send_body(200, body, headers)
+
+
+class ImageServer:
+    """A local HTTP server for the download tests, run on a thread while used as a context manager."""
+
+    def __init__(self):
+        self.images : Dict[str, bytes] = {} # Bodies by path
+        self.statuses : Dict[str, int] = {} # Statuses answered instead of a body, by path
+        self.requests : List = [] # Paths and headers of the requests received
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ImageHandler)
+        self._server.daemon_threads = True
+        self._server.image_server = self
+
+    def url(self, path : str) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}{path}"
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._server.shutdown()
+        self._server.server_close()
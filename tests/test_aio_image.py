@@ -0,0 +1,87 @@
+import aiohttp
+import asyncio
+import contextlib
+import io
+import os
+import requests
+import tempfile
+import threading
+import unittest
+from image_scraper.aio_image import AsyncImagesDownloader
+from tests.image_server import ImageServer
+
+class TestAsyncImagesDownloader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.config = {"save_path": self.tmp_dir.name, "seen_urls": {"enabled": False}, "retry": {"base_delay": 0.01}}
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def download(self, downloader, image_urls):
+        async def download_all():
+            async with aiohttp.ClientSession() as session:
+                return [ await downloader.download_url_async(session, image_url) for image_url in image_urls ]
+        with contextlib.redirect_stdout(io.StringIO()):
+            return asyncio.run(download_all())
+
+    def test_download(self):
+        with ImageServer() as server:
+            server.images = {"/a.jpg": b"\xff\xd8\xff" + b"a" * 1000, "/b.jpg": b"\xff\xd8\xff" + b"b" * 100, "/c.jpg": b"\xff\xd8\xff" + b"a" * 1000}
+            server.statuses = {"/missing.jpg": 404, "/loop.jpg": 302, "/busy.jpg": 503}
+            downloader = AsyncImagesDownloader(self.config)
+            statuses = self.download(downloader, [ server.url(path) for path in ["/a.jpg", "/b.jpg", "/c.jpg", "/missing.jpg", "/loop.jpg", "/busy.jpg"] ])
+        # The same content is saved once
+        self.assertEqual(statuses, [200, 200, 208, 404, 400, 503])
+        self.assertEqual(sorted(name for name in os.listdir(self.tmp_dir.name) if not name.startswith('.')), ["a.jpg", "b.jpg"])
+        with open(os.path.join(self.tmp_dir.name, "a.jpg"), 'rb') as file:
+            self.assertEqual(file.read(), server.images["/a.jpg"])
+        # Server errors are retried, client errors are not
+        self.assertEqual([ path for path, _ in server.requests ].count("/busy.jpg"), 3)
+        self.assertEqual(downloader.circuit_breakers.open_hosts(), {})
+
+    def test_connection_refused(self):
+        downloader = AsyncImagesDownloader(self.config)
+        self.assertEqual(self.download(downloader, ["http://127.0.0.1:1/a.jpg"]), [503])
+
+    def test_stale_partial_file(self):
+        with ImageServer() as server:
+            server.images = {"/a.jpg": b"\xff\xd8\xff" + b"a" * 100}
+            image_url = server.url("/a.jpg")
+            downloader = AsyncImagesDownloader(self.config)
+            part_path = os.path.join(self.tmp_dir.name, ".stale.part")
+            with open(part_path, 'wb') as part_file:
+                part_file.write(b"\xff\xd8\xff" + b"b" * 200)
+            downloader.manifest.start(image_url, part_path, etag=requests.get(image_url).headers['ETag'])
+            self.assertEqual(self.download(downloader, [image_url]), [200])
+            self.assertEqual([ headers.get("Range") for _, headers in server.requests[1:] ], ["bytes=203-", None])
+        self.assertFalse(os.path.exists(part_path))
+        self.assertTrue(downloader.manifest.is_complete(image_url))
+
+    def test_disk_is_used_off_the_event_loop(self):
+        calls = []
+        def record(method):
+            def wrapper(*args, **kwargs):
+                calls.append((method.__name__, threading.current_thread() is threading.main_thread()))
+                return method(*args, **kwargs)
+            return wrapper
+        with ImageServer() as server:
+            # Larger than the spool, so the body is spilled to its part file while it is read
+            server.images = {"/a.jpg": b"\xff\xd8\xff" + b"a" * 100_000}
+            downloader = AsyncImagesDownloader({**self.config, "chunk_size": 1024, "writer": {"spool_size": 1024}})
+            downloader.manifest.start = record(downloader.manifest.start)
+            downloader.manifest.is_complete = record(downloader.manifest.is_complete)
+            open_part_file = downloader.open_part_file
+            def open_recorded(*args):
+                part_file = open_part_file(*args)
+                part_file.spill = record(part_file.spill)
+                return part_file
+            downloader.open_part_file = record(open_recorded)
+            self.assertEqual(self.download(downloader, [server.url("/a.jpg")]), [200])
+        self.assertEqual({ name for name, _ in calls }, {"is_complete", "open_recorded", "start", "spill"})
+        # The event loop runs on the main thread
+        self.assertFalse(any(on_loop for _, on_loop in calls))
+
+if __name__ == "__main__":
+    unittest.main()
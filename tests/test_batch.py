@@ -0,0 +1,88 @@
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+from image_scraper.batch import BatchScraper
+from image_scraper.image import ImagesDownloader
+from image_scraper.main import ScraperConfig, read_queries, scrape_batch
+from image_scraper.work_queue import DONE, FAILED, LEASED, QUERY, URL, SqliteWorkQueue
+from tests.image_server import ImageServer
+
+def fake_search(engine, query, driver_config):
+    """Returns the results of the query in the driver config, as a search in a worker process would."""
+    if query not in driver_config["results"]:
+        raise RuntimeError(f"No results for {query}")
+    return driver_config["results"][query], {}, {"counters": {}, "histograms": {}}
+
+
+class TestBatchScraper(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.image_config = {"save_path": self.tmp_dir.name, "concurrency": 2, "retry": {"base_delay": 0.01}, "seen_urls": {"enabled": True, "capacity": 1000}}
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_read_queries(self):
+        file_name = os.path.join(self.tmp_dir.name, "queries.txt")
+        with open(file_name, 'w', encoding='utf-8') as file:
+            file.write("cats\n\n# Skipped\n  dogs  \n")
+        self.assertEqual(read_queries(file_name), ["cats", "dogs"])
+
+    def test_run(self):
+        with ImageServer() as server:
+            server.images = { f"/{i}.jpg" : b"\xff\xd8\xff" + bytes([i]) * 100 for i in range(4) }
+            results = {
+                "cats": [server.url("/0.jpg"), server.url("/1.jpg")],
+                # The first url was found by the other query as well
+                "dogs": [server.url("/0.jpg"), server.url("/2.jpg"), server.url("/3.jpg")],
+            }
+            downloaders = []
+            def create_downloader(query, shared):
+                downloaders.append(ImagesDownloader(self.image_config, subfolder=query, shared=shared))
+                return downloaders[-1]
+            batch = BatchScraper({"Google": {"max_concurrency": 2, "results": results}}, self.image_config, create_downloader,
+                                 workers=2, search=fake_search)
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                batch.run(["cats", "dogs", "birds"], webdriver_config={})
+        saved = { query : sorted(name for name in os.listdir(os.path.join(self.tmp_dir.name, query)) if not name.startswith('.')) for query in results }
+        self.assertEqual(sorted(sum(saved.values(), [])), ["0.jpg", "1.jpg", "2.jpg", "3.jpg"])
+        self.assertEqual(sum(status_codes[200] for status_codes in batch._status_codes.values()), 4)
+        self.assertEqual(sum(status_codes[208] for status_codes in batch._status_codes.values()), 1)
+        self.assertIn("Search failed for 'birds'", output.getvalue())
+        # The queries share the indexes of the save_path
+        self.assertIs(downloaders[0].dedup_index, downloaders[1].dedup_index)
+        self.assertIs(downloaders[0].seen_index, downloaders[1].seen_index)
+        self.assertIsNotNone(downloaders[0].seen_index)
+        # The manifest of each query is closed once its downloads are done
+        self.assertEqual([downloader.manifest for downloader in downloaders], [None, None])
+
+    def test_run_leases_queries_from_the_work_queue(self):
+        work_queue = SqliteWorkQueue(os.path.join(self.tmp_dir.name, "queue.db"))
+        work_queue.put(["cats", "dogs", "birds", "fish"], kind=QUERY)
+        # Leased by a worker of another process
+        work_queue.lease("other", kind=QUERY)
+        with ImageServer() as server:
+            server.images = { f"/{i}.jpg" : b"\xff\xd8\xff" + bytes([i]) * 100 for i in range(2) }
+            results = {"dogs": [server.url("/0.jpg")], "birds": [server.url("/1.jpg")]}
+            batch = BatchScraper({"Google": {"max_concurrency": 2, "results": results}}, self.image_config,
+                                 lambda query, shared: ImagesDownloader(self.image_config, subfolder=query, shared=shared),
+                                 workers=2, search=fake_search, work_queue=work_queue, worker_id="worker", poll_interval=0.1)
+            with contextlib.redirect_stdout(io.StringIO()):
+                batch.run([], webdriver_config={})
+        self.assertEqual(work_queue.counts(kind=QUERY), {LEASED: 1, DONE: 2, FAILED: 1})
+        self.assertEqual(work_queue.counts(kind=URL), {})
+        self.assertEqual(sorted(batch._status_codes), ["birds", "dogs"])
+        work_queue.close()
+
+    def test_async_engine_is_rejected(self):
+        args = argparse.Namespace(engine="async", google=True, pinterest=False, workers=1, export_urls=False, revalidate=False,
+                                  queries_file=os.devnull)
+        with self.assertRaises(ValueError):
+            scrape_batch(ScraperConfig(), args)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+from image_scraper.canonical import canonicalize_url, rewrite_url
+
+class TestCanonicalizeUrl(unittest.TestCase):
+    
+    def test_generic(self):
+        self.assertEqual(canonicalize_url("HTTPS://Example.COM:443/a/Cat.JPG?w=600&utm_source=feed&fbclid=abc&h=400#top"),
+                         "https://example.com/a/Cat.JPG?h=400&w=600")
+        self.assertEqual(canonicalize_url("http://example.com:8080"), "http://example.com:8080/")
+        self.assertEqual(canonicalize_url("https://example.com/img?name=a%20b&x"), "https://example.com/img?name=a%20b&x")
+    
+    def test_ipv6_host(self):
+        self.assertEqual(canonicalize_url("http://[::1]:8080/a.jpg"), "http://[::1]:8080/a.jpg")
+        self.assertEqual(canonicalize_url("HTTPS://[2001:DB8::1]:443/a.jpg"), "https://[2001:db8::1]/a.jpg")
+    
+    def test_rewrite_keeps_other_urls(self):
+        # Only search engine links are rewritten, the url to download is left as it was found
+        url = "http://[::1]:8080/a.jpg?w=600&utm_source=feed&h=400"
+        self.assertEqual(rewrite_url(url), url)
+    
+    def test_rewrite_pinterest(self):
+        self.assertEqual(rewrite_url("https://i.pinimg.com/236x/b6/a6/96/b6a6967be1057c68440fd3f510f513af--cat-photos.jpg"),
+                         "https://i.pinimg.com/originals/b6/a6/96/b6a6967be1057c68440fd3f510f513af.jpg")
+    
+    def test_pinterest(self):
+        expected = "https://i.pinimg.com/originals/b6/a6/96/b6a6967be1057c68440fd3f510f513af.jpg"
+        for url in ["https://i.pinimg.com/236x/b6/a6/96/b6a6967be1057c68440fd3f510f513af--cat-photos.jpg",
+                    "https://i.pinimg.com/736x/b6/a6/96/b6a6967be1057c68440fd3f510f513af.jpg",
+                    "https://i.pinimg.com/originals/b6/a6/96/b6a6967be1057c68440fd3f510f513af.jpg?utm_medium=share"]:
+            self.assertEqual(canonicalize_url(url), expected)
+        self.assertEqual(canonicalize_url("https://i.pinimg.com/75x75_RS/avatar.jpg"), "https://i.pinimg.com/75x75_RS/avatar.jpg")
+    
+    def test_google_result_link(self):
+        url = "https://www.google.com/imgres?imgurl=https%3A%2F%2Fexample.com%2Fcat.jpg%3Futm_campaign%3Dx&imgrefurl=https%3A%2F%2Fexample.com"
+        self.assertEqual(canonicalize_url(url), "https://example.com/cat.jpg")
+        
+if __name__ == "__main__":
+    unittest.main()
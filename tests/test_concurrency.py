@@ -0,0 +1,105 @@
+import asyncio
+import threading
+import time
+import unittest
+import image_scraper.concurrency as concurrency
+import image_scraper.retry as retry
+
+class TestConcurrency(unittest.TestCase):
+
+    def test_aimd_limit(self):
+        limit = concurrency.AimdLimit(initial=4, max_limit=6)
+        # Grows by about one per limit requests while fully used
+        for _ in range(5):
+            limit.in_flight = limit.value - 1
+            limit.record(0.1)
+        self.assertEqual(limit.value, 5)
+        # But not while requests are left unsent
+        limit.in_flight = 0
+        for _ in range(20):
+            limit.record(0.1)
+        self.assertEqual(limit.value, 5)
+        for _ in range(50):
+            limit.in_flight = limit.value - 1
+            limit.record(0.1)
+        self.assertEqual(limit.value, 6)
+        limit.record(0.1, congested=True)
+        self.assertEqual(limit.value, 3)
+        # Errors of the same overload are counted once
+        limit.record(0.1, congested=True)
+        self.assertEqual(limit.value, 3)
+        # Latency far above the baseline lowers the limit gently
+        limit = concurrency.AimdLimit(initial=10, max_limit=20)
+        limit.record(0.1)
+        for _ in range(30):
+            limit.record(1.0, cooldown=0)
+        self.assertLess(limit.value, 10)
+        self.assertGreaterEqual(limit.value, 1)
+
+    def test_host_limits(self):
+        adaptive = concurrency.AdaptiveConcurrency(max_in_flight=3, max_per_host=2, initial=3, host_initial=2)
+        self.assertTrue(adaptive.try_acquire("https://a.com/1.jpg"))
+        self.assertTrue(adaptive.try_acquire("https://a.com/2.jpg"))
+        self.assertFalse(adaptive.try_acquire("https://a.com/3.jpg"))
+        self.assertTrue(adaptive.try_acquire("https://b.com/1.jpg"))
+        # The global limit is reached
+        self.assertFalse(adaptive.try_acquire("https://c.com/1.jpg"))
+        adaptive.release("https://a.com/1.jpg", 0.1, retry.THROTTLED)
+        self.assertEqual(adaptive.hosts["a.com"].value, 1)
+        self.assertEqual(adaptive.total.value, 3)
+        self.assertFalse(adaptive.try_acquire("https://a.com/3.jpg"))
+        self.assertTrue(adaptive.try_acquire("https://c.com/1.jpg"))
+        self.assertEqual(list(adaptive.limits()), ["All hosts", "a.com", "b.com", "c.com"])
+
+    def test_idle_hosts_are_evicted(self):
+        adaptive = concurrency.AdaptiveConcurrency(max_in_flight=100, max_hosts=3)
+        self.assertTrue(adaptive.try_acquire("https://busy.com/1.jpg"))
+        for i in range(10):
+            url = f"https://host{i}.com/1.jpg"
+            self.assertTrue(adaptive.try_acquire(url))
+            adaptive.release(url, 0.1)
+        # The host with a request in flight keeps its limit
+        self.assertEqual(list(adaptive.hosts), ["busy.com", "host8.com", "host9.com"])
+        # The summary lists the top hosts only
+        self.assertEqual(list(adaptive.limits(top=2)), ["All hosts", "busy.com", "host8.com", "Other hosts"])
+
+    def test_acquire_async(self):
+        adaptive = concurrency.AdaptiveConcurrency(max_in_flight=2, max_per_host=2, initial=2, host_initial=2)
+        running, peak = [0], [0]
+        async def download(url):
+            await adaptive.acquire_async(url)
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+            await asyncio.sleep(0.001)
+            running[0] -= 1
+            adaptive.release(url, 0.001)
+        async def main():
+            await asyncio.gather(*(download(f"https://a.com/{i}.jpg") for i in range(20)))
+        asyncio.run(main())
+        self.assertEqual(peak[0], 2)
+        self.assertEqual(adaptive.total.in_flight, 0)
+
+    def test_scheduler_follows_limit(self):
+        adaptive = concurrency.AdaptiveConcurrency(max_in_flight=8, max_per_host=8, initial=2, host_initial=8)
+        running, peak = [0], [0]
+        lock = threading.Lock()
+        def attempt(url, n):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.002)
+            with lock:
+                running[0] -= 1
+            return 200, None
+        results = []
+        policy = retry.RetryPolicy()
+        breakers = retry.HostCircuitBreakers()
+        with retry.RetryScheduler(attempt, policy, breakers, on_result=lambda url, status: results.append(status), concurrency=adaptive) as scheduler:
+            for i in range(200):
+                scheduler.submit(f"https://a.com/{i}.jpg")
+        self.assertEqual(len(results), 200)
+        self.assertGreater(adaptive.total.peak, 2)
+        self.assertLessEqual(peak[0], 8)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+import os
+import tempfile
+import unittest
+from image_scraper.dedup import DedupIndex
+
+class TestDedupIndex(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.directory = self.tmp_dir.name
+        self.index = DedupIndex(self.directory)
+    
+    def tearDown(self):
+        self.index.close()
+        self.tmp_dir.cleanup()
+    
+    def test_lookup(self):
+        file_path = os.path.join(self.directory, "query", "image.jpg")
+        os.makedirs(os.path.dirname(file_path))
+        open(file_path, 'wb').close()
+        
+        self.assertIsNone(self.index.lookup_hash("abc"))
+        self.index.add("abc", file_path, url="https://example.com/image.jpg")
+        self.assertEqual(self.index.lookup_hash("abc"), file_path)
+        self.assertEqual(self.index.lookup_url("https://example.com/image.jpg"), file_path)
+        
+        self.index.add_url("abc", "https://example.com/copy.jpg")
+        self.assertEqual(self.index.lookup_url("https://example.com/copy.jpg"), file_path)
+        
+    def test_removed_file_is_not_a_duplicate(self):
+        file_path = os.path.join(self.directory, "image.jpg")
+        open(file_path, 'wb').close()
+        self.index.add("abc", file_path, url="https://example.com/image.jpg")
+        os.remove(file_path)
+        self.assertIsNone(self.index.lookup_hash("abc"))
+        self.assertIsNone(self.index.lookup_url("https://example.com/image.jpg"))
+        
+if __name__ == "__main__":
+    unittest.main()
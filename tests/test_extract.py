@@ -0,0 +1,54 @@
+import os
+import unittest
+from image_scraper.extract import PARSERS, PINTEREST_THUMBNAIL_PREFIX, HtmlPage, extract_google_image_urls, pinterest_original_url
+
+TEST_FILES = os.path.join(os.path.dirname(__file__), "test_files")
+
+def read_test_file(file_name):
+    with open(os.path.join(TEST_FILES, file_name), encoding='utf-8') as file:
+        return file.read()
+
+class TestExtract(unittest.TestCase):
+    
+    def test_extract_google_image_urls(self):
+        source_html = read_test_file("google_search.html")
+        expected = [
+            "https://upload.wikimedia.org/wikipedia/commons/3/3a/Cat03.jpg",
+            "https://cdn.wallpapersafari.com/30/58/J7ou90.jpg",
+            "https://i.insider.com/5bef05d501b12d357f353ed4?width=600&format=jpeg&auto=webp",
+            "https://images.example.org/photos/kitten%20on%20sofa.png",
+            "https://i.pinimg.com/736x/b6/a6/96/b6a6967be1057c68440fd3f510f513af.jpg",
+            "http://www.example.com/static/img/cat-hero.webp",
+        ]
+        self.assertEqual(extract_google_image_urls(source_html), expected)
+        
+    def test_extract_google_image_urls_without_data(self):
+        self.assertEqual(extract_google_image_urls("<html><body><div class=\"BUooTd\"></div></body></html>"), [])
+        
+    def test_pinterest_original_url(self):
+        thumbnail_url = "https://i.pinimg.com/236x/b6/a6/96/b6a6967be1057c68440fd3f510f513af--cat-photos.jpg"
+        self.assertEqual(pinterest_original_url(thumbnail_url), "https://i.pinimg.com/originals/b6/a6/96/b6a6967be1057c68440fd3f510f513af.jpg")
+        
+    def test_html_page_parsers(self):
+        google_html = read_test_file("google_search.html")
+        pinterest_html = read_test_file("pinterest_board.html")
+        for parser in PARSERS:
+            with self.subTest(parser=parser):
+                self.assertEqual(HtmlPage(google_html, parser=parser).count_class("div", "BUooTd"), 6)
+                page = HtmlPage(pinterest_html, parser=parser)
+                self.assertEqual(page.image_sources(PINTEREST_THUMBNAIL_PREFIX, container_class="Collection"), [
+                    "https://i.pinimg.com/236x/b6/a6/96/b6a6967be1057c68440fd3f510f513af--cat-photos.jpg",
+                    "https://i.pinimg.com/236x/0c/3e/5d/0c3e5d8f6a7b9c1d2e3f4a5b6c7d8e9f.png",
+                    "https://i.pinimg.com/236x/b6/a6/96/b6a6967be1057c68440fd3f510f513af--kittens.jpg",
+                ])
+                self.assertEqual(len(page.image_sources(PINTEREST_THUMBNAIL_PREFIX)), 4)
+                # Search results carry tracking parameters and no board container
+                page = HtmlPage(read_test_file("pinterest_search.html"), parser=parser)
+                self.assertEqual({ pinterest_original_url(src) for src in page.image_sources(PINTEREST_THUMBNAIL_PREFIX) }, {
+                    "https://i.pinimg.com/originals/b6/a6/96/b6a6967be1057c68440fd3f510f513af.jpg",
+                    "https://i.pinimg.com/originals/0c/3e/5d/0c3e5d8f6a7b9c1d2e3f4a5b6c7d8e9f.png",
+                    "https://i.pinimg.com/originals/7d/1a/42/7d1a42c9e8b7f6a5d4c3b2a1f0e9d8c7.jpg",
+                })
+        
+if __name__ == "__main__":
+    unittest.main()
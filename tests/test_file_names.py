@@ -0,0 +1,42 @@
+import os
+import tempfile
+import threading
+import unittest
+from image_scraper.file_names import FileNameIndex
+
+class TestFileNameIndex(unittest.TestCase):
+    
+    def test_allocate(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for file_name in ["image.jpg", "image(1).jpg", "image(4).jpg", "other.png"]:
+                open(os.path.join(directory, file_name), 'wb').close()
+            index = FileNameIndex(directory)
+            
+            allocated = [ os.path.basename(index.allocate(name)) for name in ["image.jpg", "image.jpg", "image(1).jpg", "new.jpg", "new.jpg", "other.png"] ]
+            expected = ["image(5).jpg", "image(6).jpg", "image(7).jpg", "new.jpg", "new(1).jpg", "other(1).png"]
+            self.assertEqual(allocated, expected)
+    
+    def test_concurrent_allocations_are_unique(self):
+        with tempfile.TemporaryDirectory() as directory:
+            index = FileNameIndex(directory)
+            allocated = []
+            def allocate():
+                for _ in range(200):
+                    allocated.append(index.allocate("image.jpg"))
+            threads = [ threading.Thread(target=allocate) for _ in range(8) ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(allocated), len(set(allocated)))
+
+    def test_claim_skips_names_of_other_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # Two workers list the directory before either has saved a file
+            first, second = FileNameIndex(directory), FileNameIndex(directory)
+            place = lambda path: open(path, 'xb').close()
+            self.assertEqual(os.path.basename(first.claim("image.jpg", place)), "image.jpg")
+            self.assertEqual(os.path.basename(second.claim("image.jpg", place)), "image(1).jpg")
+
+if __name__ == "__main__":
+    unittest.main()
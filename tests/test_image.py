@@ -0,0 +1,150 @@
+import contextlib
+import io
+import os
+import requests
+import tempfile
+import unittest
+from image_scraper.image import ALREADY_REPORTED, ImagesDownloader
+from image_scraper.shards import ShardIndex
+from image_scraper.work_queue import DONE, SqliteWorkQueue
+from tests.image_server import ImageServer
+from tests.test_near_dups import save_image
+
+class TestImagesDownloader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.config = {"save_path": self.tmp_dir.name, "seen_urls": {"enabled": False}, "retry": {"base_delay": 0.01}}
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def download(self, downloader, image_url):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return downloader.download_image(image_url)
+
+    def test_stale_partial_file(self):
+        with ImageServer() as server:
+            server.images = {"/a.jpg": b"\xff\xd8\xff" + b"a" * 100}
+            image_url = server.url("/a.jpg")
+            etag = requests.get(image_url).headers['ETag']
+            downloader = ImagesDownloader(self.config)
+            # The partial file of an earlier run is longer than the image now is
+            part_path = os.path.join(self.tmp_dir.name, ".stale.part")
+            with open(part_path, 'wb') as part_file:
+                part_file.write(b"\xff\xd8\xff" + b"b" * 200)
+            downloader.manifest.start(image_url, part_path, etag=etag)
+            self.assertEqual(self.download(downloader, image_url), 200)
+            self.assertEqual([ headers.get("Range") for _, headers in server.requests[1:] ], ["bytes=203-", None])
+        self.assertFalse(os.path.exists(part_path))
+        with open(os.path.join(self.tmp_dir.name, "a.jpg"), 'rb') as file:
+            self.assertEqual(file.read(), server.images["/a.jpg"])
+        self.assertTrue(downloader.manifest.is_complete(image_url))
+
+    def test_seen_urls(self):
+        config = dict(self.config, seen_urls={"enabled": True, "capacity": 1000})
+        image_url = "http://127.0.0.1:8080/a.jpg?w=600&utm_source=feed"
+        downloader = ImagesDownloader(config)
+        # The url found is downloaded, not its canonical form
+        self.assertEqual(downloader.accept_url(image_url), image_url)
+        self.assertIsNone(downloader.accept_url("http://127.0.0.1:8080/a.jpg?w=600"))
+        # The run stops before the download finishes, so the next run downloads the url
+        downloader.seen_index.close()
+        downloader = ImagesDownloader(config)
+        self.assertEqual(downloader.accept_url(image_url), image_url)
+        downloader.record_result(image_url, 429)
+        downloader.seen_index.close()
+        downloader = ImagesDownloader(config)
+        self.assertEqual(downloader.accept_url(image_url), image_url)
+        downloader.record_result(image_url, 200)
+        downloader.seen_index.close()
+        downloader = ImagesDownloader(config)
+        self.assertIsNone(downloader.accept_url(image_url))
+        downloader.seen_index.close()
+
+    def test_skipped_near_duplicate_is_not_downloaded_again(self):
+        for name, size, quality in [("cat.jpg", (640, 480), 90), ("cat_small.jpg", (160, 120), 40)]:
+            save_image(os.path.join(self.tmp_dir.name, name), seed=1, size=size, quality=quality)
+        with ImageServer() as server:
+            for name in ["cat.jpg", "cat_small.jpg"]:
+                with open(os.path.join(self.tmp_dir.name, name), 'rb') as file:
+                    server.images["/" + name] = file.read()
+                os.remove(os.path.join(self.tmp_dir.name, name))
+            config = dict(self.config, near_dedup={"action": "skip", "workers": 1})
+            with contextlib.redirect_stdout(io.StringIO()):
+                ImagesDownloader(config).download_queue([server.url("/cat.jpg"), server.url("/cat_small.jpg")])
+            self.assertEqual(sorted(name for name in os.listdir(self.tmp_dir.name) if not name.startswith(".")), ["cat.jpg"])
+            n_requests = len(server.requests)
+            # The removed copy is recorded as the kept image
+            self.assertEqual(self.download(ImagesDownloader(config), server.url("/cat_small.jpg")), ALREADY_REPORTED)
+            self.assertEqual(len(server.requests), n_requests)
+
+    def test_resume_stream_with_seen_urls(self):
+        config = dict(self.config, seen_urls={"enabled": True, "capacity": 1000})
+        with ImageServer() as server:
+            server.images = { f"/{i}.jpg" : b"\xff\xd8\xff" + bytes([i]) * 100 for i in range(4) }
+            file_name = os.path.join(self.tmp_dir.name, "urls.txt")
+            with open(file_name, 'w') as file:
+                file.write("".join(server.url(f"/{i}.jpg") + "\n" for i in range(4)))
+            downloader = ImagesDownloader(config)
+            url_stream = downloader.create_url_stream(file_name)
+            lines = iter(url_stream)
+            for _ in range(3):
+                offset, url = next(lines)
+                url_stream.start(downloader.accept_url(url), offset)
+            # The run stops while the second url is in flight
+            for url in [server.url("/0.jpg"), server.url("/2.jpg")]:
+                status = self.download(downloader, url)
+                downloader.record_result(url, status)
+                url_stream.finish(url, status)
+            url_stream.checkpoint()
+            downloader.seen_index.close()
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                ImagesDownloader(config).download_file(file_name)
+        self.assertEqual(sorted(path for path, _ in server.requests), ["/0.jpg", "/1.jpg", "/2.jpg", "/3.jpg"])
+        self.assertEqual(sorted(name for name in os.listdir(self.tmp_dir.name) if name.endswith(".jpg")), ["0.jpg", "1.jpg", "2.jpg", "3.jpg"])
+        # The urls finished before the interrupt keep their status
+        self.assertRegex(output.getvalue(), r"OK \| 4 ")
+        self.assertNotIn("Already Reported", output.getvalue())
+
+    def test_shards_with_spooled_bodies(self):
+        config = dict(self.config, shards={"enabled": True}, writer={"spool_size": 1000, "fsync": "always"})
+        with ImageServer() as server:
+            server.images = {"/small.jpg": b"\xff\xd8\xff" + b"a" * 100, "/large.jpg": b"\xff\xd8\xff" + b"b" * 5000}
+            with contextlib.redirect_stdout(io.StringIO()):
+                ImagesDownloader(config).download_queue([server.url("/small.jpg"), server.url("/large.jpg")])
+        index = ShardIndex(self.tmp_dir.name)
+        for path, image in server.images.items():
+            self.assertEqual(index.read(server.url(path)), image)
+        # The resumable bodies leave no part file behind once they are in a shard
+        self.assertEqual([ name for name in os.listdir(self.tmp_dir.name) if name.endswith(".part") ], [])
+
+    def test_workers_sharing_a_folder_keep_both_images(self):
+        with ImageServer() as server:
+            server.images = {"/cats/a.jpg": b"\xff\xd8\xff" + b"c" * 100, "/dogs/a.jpg": b"\xff\xd8\xff" + b"d" * 100}
+            # Downloaders of two processes, each with its own file name index
+            workers = [ ImagesDownloader(self.config) for _ in range(2) ]
+            for worker in workers:
+                worker.file_names # Lists the folder before either image is saved
+            for worker, path in zip(workers, server.images):
+                self.assertEqual(self.download(worker, server.url(path)), 200)
+        saved = {}
+        for name in ["a.jpg", "a(1).jpg"]:
+            with open(os.path.join(self.tmp_dir.name, name), 'rb') as file:
+                saved[name] = file.read()
+        self.assertEqual(sorted(saved.values()), sorted(server.images.values()))
+
+    def test_work_queue_items_of_the_same_url_are_all_acked(self):
+        with ImageServer() as server:
+            server.images = {"/a.jpg": b"\xff\xd8\xff" + b"a" * 100}
+            work_queue = SqliteWorkQueue(os.path.join(self.tmp_dir.name, "queue.db"))
+            # Both items are rewritten to the same url
+            work_queue.put([server.url("/a.jpg"), " " + server.url("/a.jpg")])
+            with contextlib.redirect_stdout(io.StringIO()):
+                ImagesDownloader(self.config).download_work_queue(work_queue, "worker", poll_interval=0.1)
+            self.assertEqual(work_queue.counts(), {DONE: 2})
+            work_queue.close()
+        self.assertEqual(len(server.requests), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+import os
+import tempfile
+import unittest
+from image_scraper.manifest import RunManifest
+
+class TestRunManifest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.directory = self.tmp_dir.name
+        self.manifest = RunManifest(self.directory)
+        self.url = "https://example.com/image.jpg"
+    
+    def tearDown(self):
+        self.manifest.close()
+        self.tmp_dir.cleanup()
+    
+    def test_partial_then_complete(self):
+        part_path = os.path.join(self.directory, ".abc.part")
+        self.manifest.start(self.url, part_path, etag='"v1"')
+        entry = self.manifest.get(self.url)
+        self.assertEqual(entry.part_path, part_path)
+        self.assertEqual(entry.etag, '"v1"')
+        self.assertFalse(entry.complete)
+        self.assertFalse(self.manifest.is_complete(self.url))
+        
+        file_path = os.path.join(self.directory, "image.jpg")
+        open(file_path, 'wb').close()
+        self.manifest.complete(self.url, file_path, etag='"v1"', last_modified="Wed, 21 Oct 2015 07:28:00 GMT")
+        entry = self.manifest.get(self.url)
+        self.assertEqual(entry.path, file_path)
+        self.assertIsNone(entry.part_path)
+        self.assertEqual(entry.last_modified, "Wed, 21 Oct 2015 07:28:00 GMT")
+        self.assertTrue(self.manifest.is_complete(self.url))
+        
+        os.remove(file_path)
+        self.assertFalse(self.manifest.is_complete(self.url))
+    
+    def test_unknown_url(self):
+        self.assertIsNone(self.manifest.get(self.url))
+        self.assertFalse(self.manifest.is_complete(self.url))
+        
+if __name__ == "__main__":
+    unittest.main()
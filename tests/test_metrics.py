@@ -0,0 +1,64 @@
+import json
+import os
+import tempfile
+import unittest
+import image_scraper.metrics as metrics
+import image_scraper.utils as utils
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram_quantiles(self):
+        histogram = metrics.Histogram(buckets=(1, 2, 4))
+        for value in [0.5] * 50 + [1.5] * 40 + [3] * 10:
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [50, 40, 10, 0])
+        self.assertAlmostEqual(histogram.quantile(0.5), 1.0)
+        self.assertAlmostEqual(histogram.quantile(0.9), 2.0)
+        self.assertTrue(2 < histogram.quantile(0.99) <= 4)
+
+    def test_snapshot_and_merge(self):
+        worker = metrics.Metrics()
+        worker.inc("download_results_total", status=200)
+        worker.inc("download_bytes_total", 1000)
+        worker.observe("page_load_seconds", 0.3)
+        snapshot = json.loads(json.dumps(worker.snapshot()))
+        parent = metrics.Metrics()
+        parent.inc("download_results_total", status=200)
+        parent.merge(snapshot)
+        merged = parent.snapshot()
+        self.assertEqual(merged["counters"]['download_results_total{status="200"}'], 2)
+        self.assertEqual(merged["histograms"]["page_load_seconds"]["count"], 1)
+        self.assertGreater(merged["download_bytes_per_second"], 0)
+
+    def test_exports(self):
+        run = metrics.Metrics()
+        run.add("downloads_in_flight", 1)
+        with run.time("parse_seconds", engine="Google"):
+            pass
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "image_scraper.prom")
+            run.write_prometheus(path)
+            with open(path) as file:
+                text = file.read()
+            run.open_trace(os.path.join(directory, "trace.jsonl"))
+            run.trace(url="https://a.com/1.jpg", status=200)
+            run.trace(url="https://a.com/2.jpg", status=404)
+            run.close()
+            with open(os.path.join(directory, "trace.jsonl")) as file:
+                records = [ json.loads(line) for line in file ]
+        self.assertIn("# TYPE image_scraper_downloads_in_flight gauge", text)
+        self.assertIn('image_scraper_parse_seconds_bucket{engine="Google",le="+Inf"} 1', text)
+        self.assertIn('image_scraper_parse_seconds_count{engine="Google"} 1', text)
+        self.assertEqual([ record["status"] for record in records ], [200, 404])
+
+    def test_timer(self):
+        @utils.timer
+        def work():
+            return 1
+        utils.METRICS.reset()
+        self.assertEqual(work(), 1)
+        histograms = utils.METRICS.snapshot()["histograms"]
+        self.assertEqual(histograms['function_seconds{function="TestMetrics.test_timer.<locals>.work"}']["count"], 1)
+
+if __name__ == "__main__":
+    unittest.main()
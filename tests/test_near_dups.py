@@ -0,0 +1,64 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from PIL import Image
+import image_scraper.near_dups as near_dups
+
+def save_image(path, seed, size=(256, 192), quality=90):
+    pixels = np.random.default_rng(seed).integers(0, 256, (12, 16, 3), dtype=np.uint8)
+    Image.fromarray(pixels).resize(size, Image.BILINEAR).save(path, quality=quality)
+
+class TestNearDups(unittest.TestCase):
+
+    def test_popcount(self):
+        values = np.array([0, 1, 0xFF, 2**64 - 1], dtype=np.uint64)
+        self.assertEqual(near_dups.popcount(values).tolist(), [0, 1, 8, 64])
+
+    def test_close_pairs(self):
+        rng = np.random.default_rng(0)
+        hashes = rng.integers(0, 2**63, 800, dtype=np.int64).astype(np.uint64)
+        # Plants copies of the first hashes with up to 4 bits flipped
+        flips = [ sum(np.uint64(1) << np.uint64(bit) for bit in rng.choice(64, n, replace=False)) for n in [0, 1, 2, 3, 4] ]
+        hashes = np.concatenate([hashes, hashes[:5] ^ np.array(flips, dtype=np.uint64)])
+        index = near_dups.NearDuplicateIndex(tempfile.gettempdir())
+        index.hashes = hashes
+        brute_force = [ (i, j) for i in range(len(hashes)) for j in range(i + 1, len(hashes))
+                        if bin(int(hashes[i]) ^ int(hashes[j])).count("1") <= 3 ]
+        self.assertEqual([ tuple(pair) for pair in index._close_pairs(3).tolist() ], brute_force)
+        self.assertEqual(len(brute_force), 4)
+
+    def test_find_and_quarantine(self):
+        with tempfile.TemporaryDirectory() as directory:
+            os.makedirs(os.path.join(directory, "cats"))
+            save_image(os.path.join(directory, "cats", "cat.jpg"), seed=1, size=(640, 480))
+            save_image(os.path.join(directory, "cats", "cat_small.jpg"), seed=1, size=(160, 120), quality=40)
+            save_image(os.path.join(directory, "dog.png"), seed=2)
+            index = near_dups.NearDuplicateIndex(directory)
+            self.assertEqual(index.update(workers=1), 3)
+            groups = index.find(max_distance=3)
+            self.assertEqual(groups, [[os.path.join("cats", "cat.jpg"), os.path.join("cats", "cat_small.jpg")]])
+            self.assertEqual(index.remove_duplicates(groups, near_dups.QUARANTINE), 1)
+            self.assertTrue(os.path.isfile(os.path.join(directory, ".quarantine", "cats", "cat_small.jpg")))
+            # Saved images are not hashed again
+            index = near_dups.NearDuplicateIndex(directory)
+            self.assertEqual(index.update(workers=1), 0)
+            self.assertEqual(sorted(index.paths), [os.path.join("cats", "cat.jpg"), "dog.png"])
+            self.assertEqual(index.find(), [])
+
+    def test_skip_redirects_and_odd_file_names(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # File names may hold newlines
+            save_image(os.path.join(directory, "cat\n1.jpg"), seed=1, size=(640, 480))
+            save_image(os.path.join(directory, "cat\n2.jpg"), seed=1, size=(160, 120), quality=40)
+            index = near_dups.NearDuplicateIndex(directory)
+            index.update(workers=1)
+            self.assertEqual(sorted(near_dups.NearDuplicateIndex(directory).paths), ["cat\n1.jpg", "cat\n2.jpg"])
+            redirected = []
+            self.assertEqual(index.remove_duplicates(index.find(), near_dups.SKIP, redirect=lambda *paths: redirected.append(paths)), 1)
+            self.assertEqual(redirected, [(os.path.join(directory, "cat\n2.jpg"), os.path.join(directory, "cat\n1.jpg"))])
+            self.assertEqual(os.listdir(directory).count("cat\n2.jpg"), 0)
+            self.assertEqual(near_dups.NearDuplicateIndex(directory).paths, ["cat\n1.jpg"])
+
+if __name__ == "__main__":
+    unittest.main()
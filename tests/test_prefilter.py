@@ -0,0 +1,65 @@
+import struct
+import tempfile
+import unittest
+import image_scraper.prefilter as prefilter
+from image_scraper.image import ImageRejected, PartFile
+
+def jpeg(width, height):
+    app0 = b"\xff\xe0" + struct.pack(">H", 16) + b"JFIF\x00" + b"\x00" * 9
+    sof = b"\xff\xc0" + struct.pack(">HBHHB", 11, 8, height, width, 1) + b"\x00" * 3
+    return b"\xff\xd8" + app0 + sof + b"\x00" * 100
+
+def png(width, height):
+    return b"\x89PNG\r\n\x1a\n" + struct.pack(">I", 13) + b"IHDR" + struct.pack(">II", width, height) + b"\x00" * 100
+
+class TestPrefilter(unittest.TestCase):
+
+    def test_sniff_image(self):
+        self.assertEqual(prefilter.sniff_image(jpeg(640, 480)), ("image/jpeg", 640, 480))
+        self.assertEqual(prefilter.sniff_image(png(32, 16)), ("image/png", 32, 16))
+        self.assertEqual(prefilter.sniff_image(b"GIF89a" + struct.pack("<HH", 1, 1)), ("image/gif", 1, 1))
+        vp8x = b"RIFF\x00\x00\x00\x00WEBPVP8X" + b"\x00" * 8 + (799).to_bytes(3, "little") + (599).to_bytes(3, "little")
+        self.assertEqual(prefilter.sniff_image(vp8x), ("image/webp", 800, 600))
+        # The dimensions of a JPEG come after its other segments
+        self.assertEqual(prefilter.sniff_image(jpeg(640, 480)[:20]), ("image/jpeg", None, None))
+        self.assertIsNone(prefilter.sniff_image(b"<!DOCTYPE html><html>"))
+
+    def test_check_prefix(self):
+        image_filter = prefilter.ImageFilter(min_width=100, min_height=100, mime_types=["image/jpeg", "image/png"], sniff_bytes=64)
+        self.assertIsNone(image_filter.check_prefix(jpeg(640, 480)))
+        self.assertEqual(image_filter.check_prefix(png(32, 32)), prefilter.DIMENSIONS)
+        self.assertEqual(image_filter.check_prefix(b"GIF89a\x00\x01\x00\x01"), prefilter.MIME_TYPE)
+        self.assertEqual(image_filter.check_prefix(b"<html><body>Not found</body></html>"), prefilter.MIME_TYPE)
+        self.assertEqual(image_filter.check_prefix(jpeg(640, 480)[:20]), prefilter.PENDING)
+        self.assertIsNone(image_filter.check_prefix(jpeg(640, 480)[:20], complete=True))
+        self.assertEqual(image_filter.check_content_type("text/html; charset=utf-8"), prefilter.MIME_TYPE)
+        self.assertIsNone(image_filter.check_content_type("application/octet-stream"))
+
+    def test_check_prefix_of_unsniffed_formats(self):
+        image_filter = prefilter.ImageFilter(mime_types=["image/avif", "image/svg+xml"], sniff_bytes=64)
+        avif = b"\x00\x00\x00\x1cftypavif" + b"\x00" * 100
+        svg = b"<svg xmlns=\"http://www.w3.org/2000/svg\" width=\"64\" height=\"64\"></svg>"
+        self.assertIsNone(image_filter.check_prefix(avif, content_type="image/avif"))
+        self.assertIsNone(image_filter.check_prefix(svg, complete=True, content_type="image/svg+xml; charset=utf-8"))
+        # Only the declared type vouches for a body the sniffer does not know
+        self.assertEqual(image_filter.check_prefix(avif, content_type="application/octet-stream"), prefilter.MIME_TYPE)
+        self.assertEqual(image_filter.check_prefix(svg, complete=True), prefilter.MIME_TYPE)
+
+    def test_part_file_rejects_early(self):
+        image_filter = prefilter.ImageFilter(min_width=100, min_height=100)
+        with tempfile.TemporaryDirectory() as directory:
+            part_file = PartFile(directory, image_filter=image_filter)
+            # The image module imports the prefilter as a top level module
+            with self.assertRaises(ImageRejected) as context:
+                part_file.write(png(16, 16)[:10])
+                part_file.write(png(16, 16)[10:])
+            self.assertEqual(context.exception.reason, prefilter.DIMENSIONS)
+            self.assertEqual(part_file.size, len(png(16, 16)))
+            part_file.release()
+            part_file = PartFile(directory, image_filter=image_filter)
+            part_file.write(jpeg(640, 480))
+            part_file.finish()
+            part_file.discard()
+
+if __name__ == "__main__":
+    unittest.main()
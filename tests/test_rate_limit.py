@@ -0,0 +1,50 @@
+import time
+import unittest
+from email.utils import formatdate
+import image_scraper.rate_limit as rate_limit
+
+class TestRateLimit(unittest.TestCase):
+    
+    def test_parse_retry_after(self):
+        self.assertEqual(rate_limit.parse_retry_after("120"), 120)
+        self.assertIsNone(rate_limit.parse_retry_after(None))
+        self.assertIsNone(rate_limit.parse_retry_after("soon"))
+        self.assertAlmostEqual(rate_limit.parse_retry_after(formatdate(time.time() + 30, usegmt=True)), 30, delta=2)
+    
+    def test_token_bucket(self):
+        bucket = rate_limit.TokenBucket(rate=10, burst=2)
+        waits = [ bucket.reserve() for _ in range(5) ]
+        # Two burst tokens, then two reserved ahead at the bucket rate
+        self.assertEqual([ reserved for reserved, _ in waits ], [True, True, True, True, False])
+        self.assertAlmostEqual(waits[2][1], 0.1, delta=0.01)
+        self.assertAlmostEqual(waits[3][1], 0.2, delta=0.01)
+        self.assertAlmostEqual(waits[4][1], 0.1, delta=0.01)
+    
+    def test_throttle(self):
+        bucket = rate_limit.TokenBucket(rate=10, burst=1)
+        bucket.throttle(2)
+        bucket.throttle(2)
+        # Throttles during a pause do not lower the rate again
+        self.assertEqual(bucket.rate, 5)
+        reserved, wait = bucket.reserve()
+        self.assertTrue(reserved)
+        self.assertAlmostEqual(wait, 2, delta=0.05)
+    
+    def test_host_limits(self):
+        limiter = rate_limit.HostRateLimiter(default={"rate": 0}, hosts={"Slow.com": {"rate": 1, "burst": 1}})
+        self.assertEqual(limiter.reserve("https://fast.com/1.jpg"), (True, 0))
+        self.assertEqual(limiter.reserve("https://slow.com/1.jpg"), (True, 0))
+        self.assertAlmostEqual(limiter.reserve("https://slow.com/2.jpg")[1], 1, delta=0.05)
+        limiter.throttle("https://slow.com/3.jpg", "1")
+        self.assertEqual(limiter.rates(), {"slow.com": 0.5})
+        
+    def test_share_rate_limits(self):
+        config = {"default": {"rate": 4, "burst": 2, "min_rate": 1}, "hosts": {"www.google.com": {"rate": 1}, "example.com": {"rate": 0}}}
+        self.assertEqual(rate_limit.share_rate_limits(config, 2), {
+            "default": {"rate": 2, "burst": 1, "min_rate": 0.5},
+            "hosts": {"www.google.com": {"rate": 0.5}, "example.com": {"rate": 0}},
+        })
+        self.assertEqual(rate_limit.share_rate_limits({}, 2), {})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+import image_scraper.retry as retry
+
+class TestRetry(unittest.TestCase):
+    
+    def test_backoff_budget(self):
+        policy = retry.RetryPolicy(budgets={retry.TIMEOUT: 2}, base_delay=1, max_delay=3)
+        attempts = retry.Retry("https://example.com/image.jpg")
+        self.assertEqual(attempts.host, "example.com")
+        delays = [ policy.backoff(retry.TIMEOUT, attempts) for _ in range(3) ]
+        self.assertTrue(0 <= delays[0] <= 1)
+        self.assertTrue(0 <= delays[1] <= 2)
+        self.assertIsNone(delays[2])
+        
+    def test_circuit_breaker(self):
+        breaker = retry.CircuitBreaker(failure_threshold=2, cooldown=0)
+        breaker.record(retry.CONNECTION)
+        self.assertEqual(breaker.state, retry.CircuitBreaker.CLOSED)
+        breaker.record(retry.SERVER)
+        self.assertEqual(breaker.state, retry.CircuitBreaker.OPEN)
+        # Cooldown has passed so a single trial request is let through
+        self.assertEqual(breaker.wait_time(), 0)
+        self.assertEqual(breaker.state, retry.CircuitBreaker.HALF_OPEN)
+        self.assertGreater(breaker.wait_time(), 0)
+        breaker.record(None)
+        self.assertEqual(breaker.state, retry.CircuitBreaker.CLOSED)
+        
+    def test_scheduler_requeues_failures(self):
+        failures = {"https://a.com/1.jpg": 2, "https://b.com/2.jpg": 0, "https://c.com/3.jpg": 5}
+        def attempt(url, n):
+            if failures[url] > n:
+                return 503, retry.SERVER
+            return 200, None
+        results = {}
+        def on_result(url, status):
+            results[url] = status
+        policy = retry.RetryPolicy(budgets={retry.SERVER: 3}, base_delay=0.001)
+        breakers = retry.HostCircuitBreakers(failure_threshold=10)
+        with retry.RetryScheduler(attempt, policy, breakers, max_workers=2, on_result=on_result) as scheduler:
+            for url in failures:
+                scheduler.submit(url)
+        self.assertEqual(results, {"https://a.com/1.jpg": 200, "https://b.com/2.jpg": 200, "https://c.com/3.jpg": 503})
+
+    def test_scheduler_bounds_pending(self):
+        pending = []
+        max_seen = []
+        def attempt(url, n):
+            max_seen.append(len(pending))
+            return 200, None
+        def on_result(url, status):
+            pending.remove(url)
+        policy = retry.RetryPolicy()
+        breakers = retry.HostCircuitBreakers()
+        with retry.RetryScheduler(attempt, policy, breakers, max_workers=4, on_result=on_result, max_pending=3) as scheduler:
+            for i in range(100):
+                pending.append(f"https://example.com/{i}.jpg")
+                scheduler.submit(f"https://example.com/{i}.jpg")
+        self.assertEqual(len(pending), 0)
+        self.assertLessEqual(max(max_seen), 4)
+
+if __name__ == "__main__":
+    unittest.main()
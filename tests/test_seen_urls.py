@@ -0,0 +1,40 @@
+import os
+import tempfile
+import unittest
+from image_scraper.seen_urls import SeenUrls
+
+class TestSeenUrls(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.directory = self.tmp_dir.name
+        self.urls = [ f"https://example.com/{i}.jpg" for i in range(100) ]
+    
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+    
+    def test_add_and_persist(self):
+        seen = SeenUrls(self.directory, capacity=1000)
+        self.assertTrue(all(seen.add(url) for url in self.urls))
+        self.assertFalse(seen.add(self.urls[0]))
+        self.assertNotIn("https://example.com/other.jpg", seen)
+        seen.remove(self.urls[1])
+        seen.close()
+        
+        seen = SeenUrls(self.directory, capacity=1000)
+        self.assertIn(self.urls[0], seen)
+        self.assertNotIn(self.urls[1], seen)
+        seen.close()
+    
+    def test_filter_is_rebuilt_when_resized(self):
+        seen = SeenUrls(self.directory, capacity=1000)
+        for url in self.urls:
+            seen.add(url)
+        seen.close()
+        seen = SeenUrls(self.directory, capacity=10)
+        self.assertTrue(all(url in seen for url in self.urls))
+        self.assertEqual(os.path.getsize(os.path.join(self.directory, SeenUrls.BLOOM_FILE)), SeenUrls.HEADER.size + 18)
+        seen.close()
+        
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import json
+import os
+import tarfile
+import tempfile
+import threading
+import unittest
+import unittest.mock
+import image_scraper.shards as shards
+
+def write_image(directory, name, data):
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as file:
+        file.write(data)
+    return path
+
+class TestShards(unittest.TestCase):
+
+    def test_add_and_read(self):
+        with tempfile.TemporaryDirectory() as directory:
+            writer = shards.ShardWriter(os.path.join(directory, "cats"), max_size=4096)
+            images = { f"https://example.com/{i}.jpg" : bytes([i]) * (1000 + i) for i in range(10) }
+            def add(urls):
+                for url in urls:
+                    path = write_image(directory, os.path.basename(url), images[url])
+                    writer.add(url, path, f"{len(images[url]):064x}", ".jpg")
+            urls = list(images)
+            threads = [ threading.Thread(target=add, args=(urls[i::2],)) for i in range(2) ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            # Every image is read back from its offset
+            index = shards.ShardIndex(os.path.join(directory, "cats"))
+            for url, data in images.items():
+                self.assertEqual(index.read(url), data)
+            self.assertIsNone(index.read("https://example.com/missing.jpg"))
+            # Shards are bounded and each is a valid tar with its sidecar
+            tar_names = sorted(name for name in os.listdir(os.path.join(directory, "cats")) if name.endswith(".tar"))
+            self.assertGreater(len(tar_names), 1)
+            n_images = 0
+            for tar_name in tar_names:
+                tar_path = os.path.join(directory, "cats", tar_name)
+                with tarfile.open(tar_path) as tar:
+                    members = tar.getnames()
+                with open(tar_path + ".index.jsonl", encoding='utf-8') as sidecar:
+                    entries = [ json.loads(line) for line in sidecar ]
+                self.assertEqual(len(members), 2 * len(entries))
+                self.assertEqual(set(members), set(entry["name"] for entry in entries) | set(entry["name"][:-4] + ".json" for entry in entries))
+                n_images += len(entries)
+            self.assertEqual(n_images, len(images))
+            # A duplicate url points at the stored content
+            self.assertTrue(writer.add_url("https://mirror.com/0.jpg", f"{1000:064x}"))
+            self.assertFalse(writer.add_url("https://mirror.com/new.jpg", f"{1:064x}"))
+            self.assertEqual(index.read("https://mirror.com/0.jpg"), images["https://example.com/0.jpg"])
+            writer.close()
+            index.close()
+            writer.index.close()
+
+    def test_add_bytes_with_fsync(self):
+        with tempfile.TemporaryDirectory() as directory:
+            writer = shards.ShardWriter(directory)
+            with unittest.mock.patch.object(shards.os, "fsync", wraps=os.fsync) as fsync:
+                writer.add("https://example.com/a.jpg", b"a" * 100, "a" * 64, ".jpg", fsync=True)
+                # The directory entry of the new shard, the shard and its sidecar
+                self.assertEqual(fsync.call_count, 3)
+                writer.add("https://example.com/b.jpg", b"b" * 100, "b" * 64, ".jpg", fsync=True)
+                self.assertEqual(fsync.call_count, 5)
+                writer.add("https://example.com/c.jpg", b"c" * 100, "c" * 64, ".jpg")
+                self.assertEqual(fsync.call_count, 5)
+            writer.close()
+            self.assertEqual(shards.ShardIndex(directory).read("https://example.com/b.jpg"), b"b" * 100)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,26 @@
+import os
+import subprocess
+import sys
+import unittest
+import image_scraper.main as main
+
+PACKAGE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "image_scraper")
+
+class TestStartup(unittest.TestCase):
+
+    def test_main_imports_no_heavy_modules(self):
+        heavy = ["selenium", "requests", "aiohttp", "lxml", "bs4", "numpy", "PIL", "validators"]
+        code = f"import sys; sys.path.insert(0, {PACKAGE!r}); import main; print(','.join(m for m in {heavy!r} if m in sys.modules))"
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), "")
+
+    def test_downloader_imports_requests_on_its_first_request(self):
+        code = f"import sys; sys.path.insert(0, {PACKAGE!r}); import main, image, aio_image; print('requests' in sys.modules)"
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), "False")
+
+    def test_config_is_cached(self):
+        self.assertIs(main.ScraperConfig().config, main.ScraperConfig().config)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+import os
+import tempfile
+import unittest
+import image_scraper.url_stream as url_stream
+
+class TestUrlStream(unittest.TestCase):
+
+    def test_checkpoint_and_resume(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "urls.txt")
+            urls = [ f"https://example.com/{i}.jpg" for i in range(6) ]
+            with open(file_name, 'w') as file:
+                file.write("\n".join(urls[:3] + ["not a url"] + urls[3:]) + "\n")
+            checkpoint_path = os.path.join(directory, ".urls.txt.checkpoint.json")
+            stream = url_stream.UrlStream(file_name, checkpoint_path=checkpoint_path)
+            lines = iter(stream)
+            for _ in range(4):
+                offset, url = next(lines)
+                stream.start(url, offset)
+            # The second url is still in flight when the run stops
+            for url in [urls[0], urls[2], urls[3]]:
+                stream.finish(url, 200)
+            self.assertEqual(stream.n_in_flight, 1)
+            stream.checkpoint()
+            self.assertEqual(stream.n_invalid, 1)
+
+            stream = url_stream.UrlStream(file_name, checkpoint_path=checkpoint_path)
+            self.assertEqual(stream.start_offset, len(urls[0]) + 1)
+            # The lines that finished after the offset are counted and not read again
+            self.assertEqual(stream.counts, {200: 3})
+            self.assertEqual(stream.n_invalid, 1)
+            resumed = []
+            for offset, url in stream:
+                stream.start(url, offset)
+                stream.finish(url, 200)
+                resumed.append(url)
+            self.assertEqual(resumed, [urls[1], urls[4], urls[5]])
+            self.assertEqual(stream.counts, {200: 6})
+            self.assertEqual(stream.n_invalid, 1)
+            stream.complete()
+            self.assertFalse(os.path.exists(checkpoint_path))
+
+if __name__ == "__main__":
+    unittest.main()
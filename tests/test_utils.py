@@ -0,0 +1,19 @@
+import asyncio
+import unittest
+from image_scraper.utils import merge_async_iterators
+
+class TestUtils(unittest.TestCase):
+    
+    def test_merge_async_iterators(self):
+        async def numbers(start, delay):
+            for i in range(start, start + 3):
+                await asyncio.sleep(delay)
+                yield i
+        async def merge():
+            return [ i async for i in merge_async_iterators(numbers(0, 0.01), numbers(10, 0.025)) ]
+        merged = asyncio.run(merge())
+        self.assertEqual(sorted(merged), [0, 1, 2, 10, 11, 12])
+        self.assertEqual(merged[:2], [0, 1])
+        
+if __name__ == "__main__":
+    unittest.main()
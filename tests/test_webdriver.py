@@ -0,0 +1,176 @@
+import asyncio
+import threading
+import unittest
+import image_scraper.webdriver as webdriver
+from image_scraper.rate_limit import HostRateLimiter
+
+class FakeSeleniumDriver:
+    """Stands in for a selenium driver, answering the scripts of WebDriver."""
+
+    def __init__(self):
+        self.healthy : bool = True
+        self.quit_called : bool = False
+        self.page_states = [[1000, 10, 0]] # Answers of the page state script, the last one repeated
+        self.n_polls : int = 0
+        self.element_after : int = 1 # Finds of an element until it is in the page
+        self.n_finds : int = 0
+
+    def execute_script(self, script, *args):
+        if script == webdriver.PAGE_STATE_SCRIPT:
+            self.n_polls += 1
+            return self.page_states.pop(0) if len(self.page_states) > 1 else self.page_states[0]
+        if script == "return 1;":
+            if not self.healthy:
+                raise ConnectionError("Session lost")
+            return 1
+
+    def find_elements(self, by, value):
+        self.n_finds += 1
+        return ["<h1>"] if self.n_finds >= self.element_after else []
+
+    def execute_cdp_cmd(self, command, params):
+        pass
+
+    def get(self, url):
+        self.url = url
+
+    def quit(self):
+        self.quit_called = True
+
+
+class FakeWebDriver(webdriver.WebDriver):
+
+    def _initialise_driver(self):
+        return FakeSeleniumDriver()
+
+
+class TestWebDriverPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = webdriver.WebDriverPool({}, pool_size=2, max_uses=3, driver_factory=FakeWebDriver)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_lease_and_return(self):
+        async def lease():
+            async with self.pool.lease({"load_sleep": 1}) as driver:
+                self.assertEqual(driver.load_sleep, 1)
+                return driver
+        first = asyncio.run(lease())
+        # The idle session is reused
+        self.assertIs(asyncio.run(lease()), first)
+        self.assertEqual(first.uses, 2)
+
+    def test_waits_without_blocking_the_loop(self):
+        leased = [ self.pool.acquire() for _ in range(2) ]
+        ticks = []
+        async def tick():
+            while True:
+                ticks.append(None)
+                await asyncio.sleep(0.01)
+        async def main():
+            ticker = asyncio.ensure_future(tick())
+            # The pool is full until a session is returned from another thread
+            threading.Timer(0.1, self.pool.release, [leased[0]]).start()
+            driver = await self.pool.acquire_async()
+            ticker.cancel()
+            return driver
+        self.assertIs(asyncio.run(main()), leased[0])
+        self.assertGreater(len(ticks), 3)
+
+    def test_recycles_worn_and_broken_sessions(self):
+        driver = self.pool.acquire()
+        for _ in range(2):
+            self.pool.release(driver)
+            self.assertIs(self.pool.acquire(), driver)
+        # A session used max_uses times is closed on release
+        self.pool.release(driver)
+        self.assertIsNone(driver.driver)
+        replacement = self.pool.acquire()
+        self.assertIsNot(replacement, driver)
+        # A session that lost its browser is replaced on the next lease
+        self.pool.release(replacement)
+        selenium_driver = replacement.driver
+        selenium_driver.healthy = False
+        self.assertIsNot(self.pool.acquire(), replacement)
+        self.assertTrue(selenium_driver.quit_called)
+
+class TestWaitForPageChange(unittest.TestCase):
+
+    def setUp(self):
+        self.driver = FakeWebDriver({"poll_interval": 0.01, "network_idle": 0.05, "scroll_limit": 100000})
+        self.page = self.driver.driver
+
+    def wait(self, max_sleep : float = 1) -> str:
+        return asyncio.run(self.driver.wait_for_page_change(1000, 10, max_sleep))
+
+    def test_loaded(self):
+        # The page grows on the third poll
+        self.page.page_states = [[1000, 10, 0], [1000, 10, 0], [1500, 10, 0]]
+        self.assertEqual(self.wait(), webdriver.ScrollStats.LOADED)
+        self.assertEqual(self.page.n_polls, 3)
+        self.page.page_states = [[1000, 11, 0]]
+        self.assertEqual(self.wait(), webdriver.ScrollStats.LOADED)
+
+    def test_network_idle(self):
+        # Nothing has loaded for a second, so the wait ends after network_idle instead of max_sleep
+        self.page.page_states = [[1000, 10, 1000]]
+        self.assertEqual(self.wait(max_sleep=5), webdriver.ScrollStats.NETWORK_IDLE)
+        self.assertLess(self.driver.scroll_stats.total(webdriver.ScrollStats.NETWORK_IDLE), 1)
+
+    def test_timeout(self):
+        # Resources keep loading without changing the page
+        self.page.page_states = [[1000, 10, 0]]
+        self.assertEqual(self.wait(max_sleep=0.1), webdriver.ScrollStats.TIMEOUT)
+        self.assertGreaterEqual(self.driver.scroll_stats.total(webdriver.ScrollStats.TIMEOUT), 0.1)
+        self.assertEqual(self.driver.scroll_stats.count(webdriver.ScrollStats.TIMEOUT), 1)
+
+    def test_scroll_stops_when_idle(self):
+        self.driver.load_sleep = 0.1
+        self.page.page_states = [[1000, 10, 0], [2000, 20, 0], [2000, 20, 0], [2000, 20, 1000]]
+        outcomes = []
+        async def scroll():
+            async for _ in self.driver.iter_scroll_to_bottom():
+                outcomes.append(self.driver.scroll_stats.steps[-1][0])
+        asyncio.run(scroll())
+        self.assertEqual(outcomes, [webdriver.ScrollStats.LOADED, webdriver.ScrollStats.NETWORK_IDLE])
+
+    def test_scroll_to_element_stops_once_the_page_stops_growing(self):
+        self.driver.undetect_limit, self.driver.iterate_sleep = 3, 0.01
+        self.page.element_after = 100
+        # More steps grow the page than the limit, before it stops growing
+        outcomes = [webdriver.ScrollStats.LOADED] * 12 + [webdriver.ScrollStats.NETWORK_IDLE] * 10
+        async def wait_for_page_change(height, n_images, max_sleep):
+            return outcomes.pop(0)
+        self.driver.wait_for_page_change = wait_for_page_change
+        asyncio.run(self.driver.scroll_to_element(("tag name", "h1")))
+        self.assertEqual(len(outcomes), 7)
+
+    def test_get_waits_for_the_rate_limit_without_blocking_the_loop(self):
+        self.driver.rate_limiter = HostRateLimiter(default={"rate": 10})
+        ticks = []
+        async def tick():
+            while True:
+                ticks.append(None)
+                await asyncio.sleep(0.01)
+        async def main():
+            ticker = asyncio.ensure_future(tick())
+            # The second page load waits 0.1s for its token
+            await self.driver.get("https://www.google.com/search?q=cats")
+            await self.driver.get("https://www.google.com/search?q=dogs")
+            ticker.cancel()
+        asyncio.run(main())
+        self.assertEqual(self.page.url, "https://www.google.com/search?q=dogs")
+        self.assertGreater(len(ticks), 3)
+
+    def test_wait_for_element(self):
+        # The title is only rendered after the page scripts have run
+        self.page.element_after = 3
+        self.assertEqual(asyncio.run(self.driver.wait_for_element("tag name", "h1", 1)), "<h1>")
+        self.assertEqual(self.page.n_finds, 3)
+        self.page.element_after = 100
+        self.assertIsNone(asyncio.run(self.driver.wait_for_element("tag name", "h1", 0.05)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import tempfile
+import time
+import unittest
+from image_scraper.work_queue import DONE, FAILED, LEASED, QUEUED, SqliteWorkQueue, WorkQueue
+
+class TestSqliteWorkQueue(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "queue.sqlite3")
+        self.queue = SqliteWorkQueue(self.path, lease_timeout=60, max_attempts=2)
+        self.urls = [ f"https://example.com/{i}.jpg" for i in range(5) ]
+    
+    def tearDown(self):
+        self.queue.close()
+        self.tmp_dir.cleanup()
+    
+    def test_put_is_idempotent(self):
+        self.assertEqual(self.queue.put(self.urls), 5)
+        self.assertEqual(self.queue.put(self.urls[:2]), 0)
+        self.assertEqual(self.queue.counts(), {QUEUED: 5})
+    
+    def test_workers_lease_distinct_items(self):
+        self.queue.put(self.urls)
+        other = SqliteWorkQueue(self.path)
+        first = self.queue.lease("a", 3)
+        second = other.lease("b", 3)
+        other.close()
+        self.assertEqual([ item.value for item in first + second ], self.urls)
+        self.assertTrue(self.queue.ack("a", first[0], status=200))
+        self.assertTrue(self.queue.ack("a", first[1], status=404, failed=True))
+        self.assertEqual(self.queue.counts(), {DONE: 1, FAILED: 1, LEASED: 3})
+    
+    def test_expired_leases_are_leased_again(self):
+        self.queue.close()
+        self.queue = SqliteWorkQueue(self.path, lease_timeout=0.01, max_attempts=2)
+        self.queue.put(self.urls[:1])
+        self.assertEqual(len(self.queue.lease("dead")), 1)
+        time.sleep(0.02)
+        item, = self.queue.lease("alive")
+        self.assertEqual(item.attempts, 2)
+        time.sleep(0.02)
+        # Items that were leased max_attempts times are given up
+        self.assertEqual(self.queue.lease("alive"), [])
+        self.assertEqual(self.queue.counts(), {FAILED: 1})
+    
+    def test_ack_requires_the_lease(self):
+        self.queue.close()
+        self.queue = SqliteWorkQueue(self.path, lease_timeout=0.01, max_attempts=2)
+        self.queue.put(self.urls[:1])
+        item, = self.queue.lease("slow")
+        time.sleep(0.02)
+        self.queue.lease("fast")
+        # The slow worker lost its lease, so its result does not end the lease of the other worker
+        self.assertFalse(self.queue.ack("slow", item, status=404, failed=True))
+        self.assertEqual(self.queue.counts(), {LEASED: 1})
+        self.assertTrue(self.queue.ack("fast", item, status=200))
+        self.assertFalse(self.queue.ack("fast", item, status=200))
+        self.assertEqual(self.queue.counts(), {DONE: 1})
+    
+    def test_interface_is_abstract(self):
+        with self.assertRaises(TypeError):
+            WorkQueue()
+    
+    def test_release(self):
+        self.queue.put(self.urls)
+        self.queue.lease("a", 2)
+        self.queue.release("a")
+        self.assertEqual(self.queue.counts(), {QUEUED: 5})
+        
+if __name__ == "__main__":
+    unittest.main()
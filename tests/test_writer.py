@@ -0,0 +1,119 @@
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+import image_scraper.retry as retry
+import image_scraper.writer as writer
+from image_scraper.image import ImagesDownloader, PartFile
+
+class TestWriter(unittest.TestCase):
+
+    def test_part_file_spool(self):
+        with tempfile.TemporaryDirectory() as directory:
+            part_file = PartFile(directory, spool_size=8)
+            part_file.write(b"1234")
+            self.assertFalse(os.path.exists(part_file.path))
+            full_file_path = os.path.join(directory, "a.jpg")
+            part_file.commit(full_file_path)
+            with open(full_file_path, 'rb') as file:
+                self.assertEqual(file.read(), b"1234")
+            # A body outgrowing the spool is written to disk
+            part_file = PartFile(directory, spool_size=8)
+            part_file.write(b"123456789")
+            self.assertTrue(os.path.exists(part_file.path))
+            part_file.release()
+            self.assertFalse(os.path.exists(part_file.path))
+            # A resumable body is kept for a Range request
+            part_file = PartFile(directory, spool_size=8)
+            part_file.write(b"1234")
+            part_file.resumable = True
+            part_file.release()
+            with open(part_file.path, 'rb') as file:
+                self.assertEqual(file.read(), b"1234")
+
+    def test_pool_bounds_queue(self):
+        pool = writer.WriterPool(workers=1, queue_size=2)
+        started, release = threading.Event(), threading.Event()
+        def write(n):
+            started.set()
+            release.wait()
+            return n
+        futures = [pool.submit(write, 0)]
+        started.wait()
+        futures.append(pool.submit(write, 1))
+        blocked = threading.Thread(target=lambda: futures.append(pool.submit(write, 2)))
+        blocked.start()
+        blocked.join(0.1)
+        # Both slots are taken until a write is done
+        self.assertTrue(blocked.is_alive())
+        release.set()
+        blocked.join()
+        pool.shutdown()
+        self.assertEqual([ future.result() for future in futures ], [0, 1, 2])
+
+    def test_async_slots_share_the_bound(self):
+        pool = writer.WriterPool(workers=1, queue_size=1)
+        release = threading.Event()
+        pool.submit(release.wait)
+        ticks = []
+        async def tick():
+            while True:
+                ticks.append(None)
+                await asyncio.sleep(0.01)
+        async def main():
+            ticker = asyncio.ensure_future(tick())
+            # The only slot is taken by a thread until its write is done
+            threading.Timer(0.1, release.set).start()
+            await pool.acquire_async()
+            ticker.cancel()
+            return pool.submit(lambda: 200, block=False)
+        self.assertEqual(asyncio.run(main()).result(), 200)
+        self.assertGreater(len(ticks), 3)
+        pool.shutdown()
+        self.assertEqual(pool._free_slots, 1)
+
+    def test_downloaders_share_the_pool(self):
+        with tempfile.TemporaryDirectory() as directory:
+            config = {"save_path": directory, "seen_urls": {"enabled": False}, "writer": {"workers": 2, "fsync": writer.BATCH}}
+            downloaders = [ ImagesDownloader(config, subfolder=str(i)) for i in range(50) ]
+            self.assertEqual(len({ id(downloader.writer_pool) for downloader in downloaders }), 1)
+            self.assertIsNot(ImagesDownloader(dict(config, writer={"workers": 3})).writer_pool, downloaders[0].writer_pool)
+            # A pool that was shut down is replaced
+            downloaders[0].writer_pool.shutdown()
+            self.assertFalse(ImagesDownloader(config).writer_pool.closed)
+
+    def test_fsync_batch(self):
+        with self.assertRaises(ValueError):
+            writer.WriterPool(fsync="sometimes")
+        with tempfile.TemporaryDirectory() as directory:
+            pool = writer.WriterPool(fsync=writer.BATCH, fsync_batch=3)
+            synced = []
+            pool._sync_directory = synced.append
+            for _ in range(4):
+                pool.renamed(directory)
+            self.assertEqual(synced, [directory])
+            pool.flush()
+            self.assertEqual(synced, [directory, directory])
+            pool.flush()
+            self.assertEqual(len(synced), 2)
+            pool.shutdown()
+
+    def test_scheduler_waits_for_writes(self):
+        pool = writer.WriterPool(workers=2)
+        release = threading.Event()
+        def write(url):
+            release.wait()
+            return 200
+        results = []
+        scheduler = retry.RetryScheduler(lambda url, n: (pool.submit(write, url), None), retry.RetryPolicy(), retry.HostCircuitBreakers(),
+                                         max_workers=2, on_result=lambda url, status: results.append(status))
+        with scheduler:
+            for i in range(5):
+                scheduler.submit(f"https://a.com/{i}.jpg")
+            release.set()
+        pool.shutdown()
+        self.assertEqual(results, [200] * 5)
+
+if __name__ == "__main__":
+    unittest.main()